@@ -1,24 +1,34 @@
-from typing import Dict, Tuple, Union
+import functools
+import itertools
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy
 import scipy.ndimage
 import skimage
+from loading_classes import ObjectIndex
+from parallel_utils import map_in_processes
 
 
-def linear_costes_threshold_calculation(
-    first_image: numpy.ndarray,
-    second_image: numpy.ndarray,
-    scale_max: int = 255,
-    fast_costes: str = "Accurate",
+def get_costes_regression(
+    first_image: numpy.ndarray, second_image: numpy.ndarray
 ) -> Tuple[float, float]:
     """
-    Finds the Costes Automatic Threshold for colocalization using a linear algorithm.
-    Candiate thresholds are gradually decreased until Pearson R falls below 0.
-    If "Fast" mode is enabled the "steps" between tested thresholds will be increased
-    when Pearson R is much greater than 0. The other mode is "Accurate" which
-    will always step down by the same amount.
+    Fit the orthogonal regression line y = a * x + b of the voxels that are nonzero
+    in either image, along which the Costes thresholds are searched.
+
+    Parameters
+    ----------
+    first_image : numpy.ndarray
+        The first image.
+    second_image : numpy.ndarray
+        The second image.
+
+    Returns
+    -------
+    Tuple[float, float]
+        The slope a and intercept b of the regression line.
     """
-    i_step = 1 / scale_max  # Step size for the threshold as a float
     non_zero = (first_image > 0) | (second_image > 0)
     xvar = numpy.var(first_image[non_zero], axis=0, ddof=1)
     yvar = numpy.var(second_image[non_zero], axis=0, ddof=1)
@@ -37,6 +47,179 @@ def linear_costes_threshold_calculation(
     )
     a = num / denom
     b = ymean - a * xmean
+    return a, b
+
+
+class CostesCorrelation:
+    """
+    The Pearson R of the voxels below a Costes threshold of either image,
+    for any candidate threshold.
+    The voxels below a threshold t are those with first_image < t
+    or second_image < a * t + b, so for a positive slope each voxel is below every
+    threshold above min(x, (y - b) / a).
+    The voxels are sorted once by that key and the sums of x, y, x², y² and xy
+    are accumulated in that order, so each candidate threshold is a binary search
+    instead of a new masked copy of the images.
+    The voxels are counted with the same comparisons as the masks,
+    and the correlation is NaN when either image is constant like scipy.stats.pearsonr.
+    Other slopes fall back to masking the images for each threshold.
+
+    Parameters
+    ----------
+    first_image : numpy.ndarray
+        The first image.
+    second_image : numpy.ndarray
+        The second image.
+    a : float
+        The slope of the regression line.
+    b : float
+        The intercept of the regression line.
+
+    Methods
+    -------
+    get_below_threshold_count(threshold)
+        Retrieves the number of voxels below a threshold of either image.
+    get_correlation(threshold)
+        Retrieves the number of voxels below a threshold of either image
+        and their Pearson R.
+    """
+
+    def __init__(
+        self,
+        first_image: numpy.ndarray,
+        second_image: numpy.ndarray,
+        a: float,
+        b: float,
+    ):
+        self.a = a
+        self.b = b
+        self.x = numpy.ravel(first_image).astype(numpy.float64)
+        self.y = numpy.ravel(second_image).astype(numpy.float64)
+        self.sorted = bool(numpy.isfinite(a) and numpy.isfinite(b) and a > 0)
+        if not self.sorted:
+            return
+        with numpy.errstate(over="ignore"):
+            keys = numpy.minimum(self.x, (self.y - b) / a)
+        order = numpy.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.x = self.x[order]
+        self.y = self.y[order]
+        # centering keeps the differences of the sums accurate
+        x = self.x - self.x.mean()
+        y = self.y - self.y.mean()
+        self.sums = {
+            name: numpy.concatenate(([0.0], numpy.cumsum(values)))
+            for name, values in (
+                ("x", x),
+                ("y", y),
+                ("xx", x * x),
+                ("yy", y * y),
+                ("xy", x * y),
+            )
+        }
+        # a prefix is constant when its running minimum equals its running maximum
+        self.x_constant = numpy.minimum.accumulate(self.x) == numpy.maximum.accumulate(
+            self.x
+        )
+        self.y_constant = numpy.minimum.accumulate(self.y) == numpy.maximum.accumulate(
+            self.y
+        )
+
+    def _is_below(self, position: int, threshold: float) -> bool:
+        return bool(
+            self.x[position] < threshold
+            or self.y[position] < (self.a * threshold) + self.b
+        )
+
+    def get_below_threshold_count(self, threshold: float) -> int:
+        """
+        Get the number of voxels below a threshold of either image.
+
+        Parameters
+        ----------
+        threshold : float
+            The threshold of the first image,
+            the threshold of the second image is a * threshold + b.
+
+        Returns
+        -------
+        int
+            The number of voxels below the thresholds.
+        """
+        if not self.sorted:
+            return int(
+                numpy.count_nonzero(
+                    (self.x < threshold) | (self.y < (self.a * threshold) + self.b)
+                )
+            )
+        count = int(numpy.searchsorted(self.keys, threshold, side="left"))
+        # the keys are rounded, so the voxels at the boundary are compared exactly
+        while count < len(self.keys) and self._is_below(count, threshold):
+            count += 1
+        while count > 0 and not self._is_below(count - 1, threshold):
+            count -= 1
+        return count
+
+    def get_correlation(self, threshold: float) -> Tuple[int, float]:
+        """
+        Get the Pearson R of the voxels below a threshold of either image.
+
+        Parameters
+        ----------
+        threshold : float
+            The threshold of the first image,
+            the threshold of the second image is a * threshold + b.
+
+        Returns
+        -------
+        Tuple[int, float]
+            The number of voxels below the thresholds and their Pearson R,
+            which is NaN for fewer than 2 voxels or a constant image.
+        """
+        count = self.get_below_threshold_count(threshold)
+        if count < 2:
+            return count, numpy.nan
+        if not self.sorted:
+            below = (self.x < threshold) | (self.y < (self.a * threshold) + self.b)
+            x = self.x[below]
+            y = self.y[below]
+            if x.min() == x.max() or y.min() == y.max():
+                return count, numpy.nan
+            x = x - x.mean()
+            y = y - y.mean()
+            sum_xy = numpy.sum(x * y)
+            sum_xx = numpy.sum(x * x)
+            sum_yy = numpy.sum(y * y)
+        else:
+            if self.x_constant[count - 1] or self.y_constant[count - 1]:
+                return count, numpy.nan
+            sum_x, sum_y, sum_xx, sum_yy, sum_xy = (
+                self.sums[name][count] for name in ("x", "y", "xx", "yy", "xy")
+            )
+            sum_xy = sum_xy - sum_x * sum_y / count
+            sum_xx = sum_xx - sum_x * sum_x / count
+            sum_yy = sum_yy - sum_y * sum_y / count
+        correlation = sum_xy / numpy.sqrt(sum_xx * sum_yy)
+        return count, float(numpy.clip(correlation, -1.0, 1.0))
+
+
+def linear_costes_threshold_calculation(
+    first_image: numpy.ndarray,
+    second_image: numpy.ndarray,
+    scale_max: int = 255,
+    fast_costes: str = "Accurate",
+) -> Tuple[float, float]:
+    """
+    Finds the Costes Automatic Threshold for colocalization using a linear algorithm.
+    Candiate thresholds are gradually decreased until Pearson R falls below 0.
+    If "Fast" mode is enabled the "steps" between tested thresholds will be increased
+    when Pearson R is much greater than 0. The other mode is "Accurate" which
+    will always step down by the same amount.
+    The voxels are sorted once so each candidate is evaluated in logarithmic time.
+    """
+    i_step = 1 / scale_max  # Step size for the threshold as a float
+    a, b = get_costes_regression(first_image, second_image)
+    costes_correlation = CostesCorrelation(first_image, second_image, a, b)
 
     # Start at 1 step above the maximum value
     img_max = max(first_image.max(), second_image.max())
@@ -46,8 +229,6 @@ def linear_costes_threshold_calculation(
     first_image_max = first_image.max()
     second_image_max = second_image.max()
 
-    # Initialise without a threshold
-    costReg, _ = scipy.stats.pearsonr(first_image, second_image)
     thr_first_image_c = i
     thr_second_image_c = (a * i) + b
     while i > first_image_max and (a * i) + b > second_image_max:
@@ -55,32 +236,30 @@ def linear_costes_threshold_calculation(
     while i > i_step:
         thr_first_image_c = i
         thr_second_image_c = (a * i) + b
-        combt = (first_image < thr_first_image_c) | (second_image < thr_second_image_c)
-        try:
-            # Only run pearsonr if the input has changed.
-            if (positives := numpy.count_nonzero(combt)) != num_true:
-                costReg, _ = scipy.stats.pearsonr(
-                    first_image[combt], second_image[combt]
-                )
-                num_true = positives
-
-            if costReg <= 0:
+        positives, correlation = costes_correlation.get_correlation(i)
+        # Only update the correlation if the input has changed.
+        if positives != num_true:
+            if positives < 2:
+                # Pearson R is undefined for fewer than 2 values
                 break
-            elif fast_costes == "Accurate" or i < i_step * 10:
-                i -= i_step
-            elif costReg > 0.45:
-                # We're way off, step down 10x
-                i -= i_step * 10
-            elif costReg > 0.35:
-                # Still far from 0, step 5x
-                i -= i_step * 5
-            elif costReg > 0.25:
-                # Step 2x
-                i -= i_step * 2
-            else:
-                i -= i_step
-        except ValueError:
+            costReg = correlation
+            num_true = positives
+
+        if costReg <= 0:
             break
+        elif fast_costes == "Accurate" or i < i_step * 10:
+            i -= i_step
+        elif costReg > 0.45:
+            # We're way off, step down 10x
+            i -= i_step * 10
+        elif costReg > 0.35:
+            # Still far from 0, step 5x
+            i -= i_step * 5
+        elif costReg > 0.25:
+            # Step 2x
+            i -= i_step * 2
+        else:
+            i -= i_step
     return thr_first_image_c, thr_second_image_c
 
 
@@ -94,24 +273,10 @@ def bisection_costes_threshold_calculation(
     We're looking for the first point at 0, and R value can become highly variable
     at lower thresholds in some samples. Therefore the candidate tested in each
     loop is 1/6th of the window size below the maximum value (as opposed to the midpoint).
+    The voxels are sorted once so each candidate is evaluated in logarithmic time.
     """
-
-    non_zero = (first_image > 0) | (second_image > 0)
-    xvar = numpy.var(first_image[non_zero], axis=0, ddof=1)
-    yvar = numpy.var(second_image[non_zero], axis=0, ddof=1)
-
-    xmean = numpy.mean(first_image[non_zero], axis=0)
-    ymean = numpy.mean(second_image[non_zero], axis=0)
-
-    z = first_image[non_zero] + second_image[non_zero]
-    zvar = numpy.var(z, axis=0, ddof=1)
-
-    covar = 0.5 * (zvar - (xvar + yvar))
-
-    denom = 2 * covar
-    num = (yvar - xvar) + numpy.sqrt((yvar - xvar) * (yvar - xvar) + 4 * (covar**2))
-    a = num / denom
-    b = ymean - a * xmean
+    a, b = get_costes_regression(first_image, second_image)
+    costes_correlation = CostesCorrelation(first_image, second_image, a, b)
 
     # Initialise variables
     left = 1
@@ -123,24 +288,15 @@ def bisection_costes_threshold_calculation(
 
     while lastmid != mid:
         thr_first_image_c = mid / scale_max
-        thr_second_image_c = (a * thr_first_image_c) + b
-        combt = (first_image < thr_first_image_c) | (second_image < thr_second_image_c)
-        if numpy.count_nonzero(combt) <= 2:
+        positives, costReg = costes_correlation.get_correlation(thr_first_image_c)
+        if positives <= 2:
             # Can't run meaningful pearson with only 2 values.
             left = mid - 1
-        else:
-            try:
-                costReg, _ = scipy.stats.pearsonr(
-                    first_image[combt], second_image[combt]
-                )
-                if costReg < 0:
-                    left = mid - 1
-                elif costReg >= 0:
-                    right = mid + 1
-                    valid = mid
-            except ValueError:
-                # Catch misc Pearson errors with low sample numbers
-                left = mid - 1
+        elif costReg < 0:
+            left = mid - 1
+        elif costReg >= 0:
+            right = mid + 1
+            valid = mid
         lastmid = mid
         if right - left > 6:
             mid = ((right - left) // (6 / 5)) + left
@@ -176,11 +332,89 @@ def select_objects_from_label(
     return label_image
 
 
+def get_matched_crop_bboxes(
+    bboxes1: numpy.ndarray,
+    bboxes2: numpy.ndarray,
+    image_shape: Tuple[int, ...],
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Plan the crop windows of many pairs of objects at once so that the two
+    windows of each pair have the same size.
+    On every axis the smaller box of a pair grows by the difference in size,
+    first towards the start of the image as far as the image allows
+    and then towards the end.
+
+    Parameters
+    ----------
+    bboxes1 : numpy.ndarray
+        The bounding boxes of the first objects of the pairs, one row of
+        (min_z, min_y, min_x, max_z, max_y, max_x) per pair where the max is exclusive.
+    bboxes2 : numpy.ndarray
+        The bounding boxes of the second objects of the pairs, in the same format.
+    image_shape : Tuple[int, ...]
+        The shape of the image the windows are cropped from.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        The crop windows of the first and the second objects, in the same format.
+
+    Raises
+    ------
+    ValueError
+        If a window does not fit in the image.
+    """
+    bboxes1 = numpy.asarray(bboxes1, dtype=numpy.int64).reshape(-1, 6)
+    bboxes2 = numpy.asarray(bboxes2, dtype=numpy.int64).reshape(-1, 6)
+    if bboxes1.shape != bboxes2.shape:
+        raise ValueError(
+            f"Got {len(bboxes1)} first and {len(bboxes2)} second bounding boxes"
+        )
+    image_shape = numpy.asarray(image_shape[:3], dtype=numpy.int64)
+    sizes1 = bboxes1[:, 3:] - bboxes1[:, :3]
+    sizes2 = bboxes2[:, 3:] - bboxes2[:, :3]
+    window_sizes = numpy.maximum(sizes1, sizes2)
+    if numpy.any(window_sizes > image_shape):
+        raise ValueError("Cannot expand box by the requested amount")
+
+    def grow(bboxes: numpy.ndarray, sizes: numpy.ndarray) -> numpy.ndarray:
+        expand_by = window_sizes - sizes
+        expand_down = numpy.minimum(expand_by, bboxes[:, :3])
+        return numpy.concatenate(
+            (bboxes[:, :3] - expand_down, bboxes[:, 3:] + expand_by - expand_down),
+            axis=1,
+        )
+
+    return grow(bboxes1, sizes1), grow(bboxes2, sizes2)
+
+
+def get_crop_slices(bboxes: numpy.ndarray) -> List[Tuple[slice, slice, slice]]:
+    """
+    Convert crop windows to the slices that crop them from an image.
+
+    Parameters
+    ----------
+    bboxes : numpy.ndarray
+        The crop windows, one row of (min_z, min_y, min_x, max_z, max_y, max_x) each.
+
+    Returns
+    -------
+    List[Tuple[slice, slice, slice]]
+        The slices of each window.
+    """
+    return [
+        (slice(z1, z2), slice(y1, y2), slice(x1, x2))
+        for z1, y1, x1, z2, y2, x2 in numpy.asarray(bboxes).tolist()
+    ]
+
+
 def expand_box(
     min_coor: int, max_coord: int, current_min: int, current_max: int, expand_by: int
-) -> Union[Tuple[int, int], ValueError]:
+) -> Tuple[int, int]:
     """
     Expand the bounding box of an object in a 3D image.
+    The box grows towards the minimum coordinate as far as possible
+    and then towards the maximum coordinate.
 
     Parameters
     ----------
@@ -197,22 +431,19 @@ def expand_box(
 
     Returns
     -------
-    Union[Tuple[int, int], ValueError]
+    Tuple[int, int]
         The new minimum and maximum coordinates of the bounding box.
-        Raises ValueError if the expansion is not possible.
+
+    Raises
+    ------
+    ValueError
+        If the expansion is not possible.
     """
 
     if max_coord - min_coor - (current_max - current_min) < expand_by:
-        return ValueError("Cannot expand box by the requested amount")
-    while expand_by > 0:
-        if current_min > min_coor:
-            current_min -= 1
-            expand_by -= 1
-        elif current_max < max_coord:
-            current_max += 1
-            expand_by -= 1
-
-    return current_min, current_max
+        raise ValueError("Cannot expand box by the requested amount")
+    expand_down = min(expand_by, current_min - min_coor)
+    return current_min - expand_down, current_max + expand_by - expand_down
 
 
 def new_crop_border(
@@ -267,76 +498,16 @@ def new_crop_border(
     -------
     Tuple[Tuple[Union[int, float], Union[int, float], Union[int, float], Union[int, float], Union[int, float], Union[int, float]], Tuple[Union[int, float], Union[int, float], Union[int, float], Union[int, float], Union[int, float], Union[int, float]]]
         The new bounding boxes of the two objects.
+
     Raises
+    ------
     ValueError
         If the expansion is not possible.
     """
-    i1z1, i1y1, i1x1, i1z2, i1y2, i1x2 = bbox1
-    i2z1, i2y1, i2x1, i2z2, i2y2, i2x2 = bbox2
-    z_range1 = i1z2 - i1z1
-    y_range1 = i1y2 - i1y1
-    x_range1 = i1x2 - i1x1
-    z_range2 = i2z2 - i2z1
-    y_range2 = i2y2 - i2y1
-    x_range2 = i2x2 - i2x1
-    z_diff = numpy.abs(z_range1 - z_range2)
-    y_diff = numpy.abs(y_range1 - y_range2)
-    x_diff = numpy.abs(x_range1 - x_range2)
-    min_z_coord = 0
-    max_z_coord = image.shape[0]
-    min_y_coord = 0
-    max_y_coord = image.shape[1]
-    min_x_coord = 0
-    max_x_coord = image.shape[2]
-    if z_range1 < z_range2:
-        i1z1, i1z2 = expand_box(
-            min_coor=min_z_coord,
-            max_coord=max_z_coord,
-            current_min=i1z1,
-            current_max=i1z2,
-            expand_by=z_diff,
-        )
-    elif z_range1 > z_range2:
-        i2z1, i2z2 = expand_box(
-            min_coor=min_z_coord,
-            max_coord=max_z_coord,
-            current_min=i2z1,
-            current_max=i2z2,
-            expand_by=z_diff,
-        )
-    if y_range1 < y_range2:
-        i1y1, i1y2 = expand_box(
-            min_coor=min_y_coord,
-            max_coord=max_y_coord,
-            current_min=i1y1,
-            current_max=i1y2,
-            expand_by=y_diff,
-        )
-    elif y_range1 > y_range2:
-        i2y1, i2y2 = expand_box(
-            min_coor=min_y_coord,
-            max_coord=max_y_coord,
-            current_min=i2y1,
-            current_max=i2y2,
-            expand_by=y_diff,
-        )
-    if x_range1 < x_range2:
-        i1x1, i1x2 = expand_box(
-            min_coor=min_x_coord,
-            max_coord=max_x_coord,
-            current_min=i1x1,
-            current_max=i1x2,
-            expand_by=x_diff,
-        )
-    elif x_range1 > x_range2:
-        i2x1, i2x2 = expand_box(
-            min_coor=min_x_coord,
-            max_coord=max_x_coord,
-            current_min=i2x1,
-            current_max=i2x2,
-            expand_by=x_diff,
-        )
-    return (i1z1, i1y1, i1x1, i1z2, i1y2, i1x2), (i2z1, i2y1, i2x1, i2z2, i2y2, i2x2)
+    new_bboxes1, new_bboxes2 = get_matched_crop_bboxes(
+        numpy.asarray(bbox1), numpy.asarray(bbox2), image.shape
+    )
+    return tuple(new_bboxes1[0].tolist()), tuple(new_bboxes2[0].tolist())
 
 
 # crop the image to the bbox of the mask
@@ -601,3 +772,414 @@ def measure_3D_colocalization(
     results["MIN.MANDERS.COEFF.COSTES.M2"] = numpy.min(C2)
     results["MAX.MANDERS.COEFF.COSTES.M2"] = numpy.max(C2)
     return results
+
+
+COLOCALIZATION_ENGINES = ["crop", "labeled"]
+COLOCALIZATION_COEFFICIENTS = [
+    "CORRELATION.COEFF",
+    "MANDERS.COEFF.M1",
+    "MANDERS.COEFF.M2",
+    "OVERLAP.COEFF",
+    "K1",
+    "K2",
+    "MANDERS.COEFF.COSTES.M1",
+    "MANDERS.COEFF.COSTES.M2",
+]
+# the features of measure_3D_colocalization in order
+COLOCALIZATION_FEATURE_NAMES = [
+    f"{statistic}.{coefficient}"
+    for coefficient in COLOCALIZATION_COEFFICIENTS
+    for statistic in ["MEAN", "MEDIAN", "MIN", "MAX"]
+]
+# the channel images of a worker process, attached from shared memory
+_shared_channel_images = {}
+_shared_memory_blocks = []
+
+
+def get_channel_pairs(channels: List[str]) -> List[Tuple[str, str]]:
+    """
+    Get every pair of channels, in the order of the channels.
+
+    Parameters
+    ----------
+    channels : List[str]
+        The channels, e.g. ["DNA", "AGP", "ER"].
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        The channel pairs, e.g. [("DNA", "AGP"), ("DNA", "ER"), ("AGP", "ER")].
+    """
+    return list(itertools.combinations(channels, 2))
+
+
+def get_colocalization_columns(
+    object_ids: numpy.ndarray, channel_pairs: List[Tuple[str, str]]
+) -> Dict[str, numpy.ndarray]:
+    """
+    Preallocate the output columns of the colocalization of several channel pairs.
+
+    Parameters
+    ----------
+    object_ids : numpy.ndarray
+        The object IDs to measure.
+    channel_pairs : List[Tuple[str, str]]
+        The channel pairs to measure.
+
+    Returns
+    -------
+    Dict[str, numpy.ndarray]
+        The object_id column and one NaN filled column per channel pair and feature,
+        named {channel1}.{channel2}_{feature}.
+    """
+    columns = {"object_id": numpy.asarray(object_ids)}
+    for channel1, channel2 in channel_pairs:
+        for feature in COLOCALIZATION_FEATURE_NAMES:
+            columns[f"{channel1}.{channel2}_{feature}"] = numpy.full(
+                len(object_ids), numpy.nan
+            )
+    return columns
+
+
+def measure_object_colocalization_pairs(
+    slices: Tuple[slice, ...],
+    channel_images: Dict[str, numpy.ndarray],
+    channel_pairs: List[Tuple[str, str]],
+    thr: int = 15,
+    fast_costes: str = "Accurate",
+) -> Dict[str, float]:
+    """
+    Calculate the colocalization coefficients of several channel pairs for one object,
+    cropping its bounding box from each channel once.
+
+    Parameters
+    ----------
+    slices : Tuple[slice, ...]
+        The slices of the bounding box of the object.
+    channel_images : Dict[str, numpy.ndarray]
+        The image of each channel.
+    channel_pairs : List[Tuple[str, str]]
+        The channel pairs to measure.
+    thr : int, optional
+        The threshold for the Manders' coefficients, by default 15
+    fast_costes : str, optional
+        The mode for Costes' threshold calculation, by default "Accurate"
+
+    Returns
+    -------
+    Dict[str, float]
+        The output features, named {channel1}.{channel2}_{feature}.
+    """
+    pair_channels = dict.fromkeys(itertools.chain.from_iterable(channel_pairs))
+    cropped_images = {
+        channel: numpy.ascontiguousarray(channel_images[channel][slices])
+        for channel in pair_channels
+    }
+    features = {}
+    for channel1, channel2 in channel_pairs:
+        colocalization_features = measure_3D_colocalization(
+            cropped_image_1=cropped_images[channel1],
+            cropped_image_2=cropped_images[channel2],
+            thr=thr,
+            fast_costes=fast_costes,
+        )
+        features.update(
+            {
+                f"{channel1}.{channel2}_{feature}": value
+                for feature, value in colocalization_features.items()
+            }
+        )
+    return features
+
+
+def attach_shared_channel_images(shared_image_specs: Dict[str, tuple]) -> None:
+    """
+    Attach the channel images placed in shared memory, run once per worker process.
+
+    Parameters
+    ----------
+    shared_image_specs : Dict[str, tuple]
+        The shared memory name, shape and dtype of each channel image.
+    """
+    for channel, (name, shape, dtype) in shared_image_specs.items():
+        shared_memory_block = shared_memory.SharedMemory(name=name)
+        # the block has to stay open while the image is in use
+        _shared_memory_blocks.append(shared_memory_block)
+        _shared_channel_images[channel] = numpy.ndarray(
+            shape, dtype=dtype, buffer=shared_memory_block.buf
+        )
+
+
+def measure_shared_object_colocalization_pairs(
+    slices: Tuple[slice, ...],
+    channel_pairs: List[Tuple[str, str]],
+    thr: int = 15,
+    fast_costes: str = "Accurate",
+) -> Dict[str, float]:
+    """
+    Calculate the colocalization coefficients of one object in a worker process
+    from the channel images attached by attach_shared_channel_images.
+
+    Parameters
+    ----------
+    slices : Tuple[slice, ...]
+        The slices of the bounding box of the object.
+    channel_pairs : List[Tuple[str, str]]
+        The channel pairs to measure.
+    thr : int, optional
+        The threshold for the Manders' coefficients, by default 15
+    fast_costes : str, optional
+        The mode for Costes' threshold calculation, by default "Accurate"
+
+    Returns
+    -------
+    Dict[str, float]
+        The output features, named {channel1}.{channel2}_{feature}.
+    """
+    return measure_object_colocalization_pairs(
+        slices,
+        channel_images=_shared_channel_images,
+        channel_pairs=channel_pairs,
+        thr=thr,
+        fast_costes=fast_costes,
+    )
+
+
+def measure_3D_colocalization_all_pairs(
+    object_index: ObjectIndex,
+    channel_images: Dict[str, numpy.ndarray],
+    channel_pairs: Optional[List[Tuple[str, str]]] = None,
+    thr: int = 15,
+    fast_costes: str = "Accurate",
+    n_processes: int = 1,
+) -> Dict[str, numpy.ndarray]:
+    """
+    Calculate the colocalization coefficients of several channel pairs for every object.
+    The bounding box of each object is cropped from each channel once
+    and every pair is measured from the shared crops,
+    which are the same crops prepare_two_images_for_colocalization gives for an object.
+    With several processes the channel images are copied once into shared memory
+    that every worker reads, so the images are never pickled,
+    and each worker measures whole objects including their Costes search.
+
+    Parameters
+    ----------
+    object_index : ObjectIndex
+        The index of the objects to measure.
+    channel_images : Dict[str, numpy.ndarray]
+        The image of each channel.
+    channel_pairs : Optional[List[Tuple[str, str]]], optional
+        The channel pairs to measure, by default None which measures every pair
+        of the channels
+    thr : int, optional
+        The threshold for the Manders' coefficients, by default 15
+    fast_costes : str, optional
+        The mode for Costes' threshold calculation, by default "Accurate"
+    n_processes : int, optional
+        The number of processes measuring the objects, by default 1
+
+    Returns
+    -------
+    Dict[str, numpy.ndarray]
+        The object_id column and one column per channel pair and feature,
+        named {channel1}.{channel2}_{feature}.
+    """
+    if channel_pairs is None:
+        channel_pairs = get_channel_pairs(list(channel_images.keys()))
+    pair_channels = list(dict.fromkeys(itertools.chain.from_iterable(channel_pairs)))
+    object_ids = object_index.object_ids
+    columns = get_colocalization_columns(object_ids, channel_pairs)
+    # every pair is measured on the same object so its windows are its bounding box
+    crop_bboxes, _ = get_matched_crop_bboxes(
+        object_index.bboxes, object_index.bboxes, object_index.shape
+    )
+    object_slices = get_crop_slices(crop_bboxes)
+    if n_processes <= 1:
+        object_features = (
+            measure_object_colocalization_pairs(
+                slices,
+                channel_images=channel_images,
+                channel_pairs=channel_pairs,
+                thr=thr,
+                fast_costes=fast_costes,
+            )
+            for slices in object_slices
+        )
+        for position, features in enumerate(object_features):
+            for feature, value in features.items():
+                columns[feature][position] = value
+        return columns
+
+    shared_memory_blocks = []
+    try:
+        shared_image_specs = {}
+        for channel in pair_channels:
+            image = channel_images[channel]
+            shared_memory_block = shared_memory.SharedMemory(
+                create=True, size=max(image.nbytes, 1)
+            )
+            shared_memory_blocks.append(shared_memory_block)
+            numpy.ndarray(
+                image.shape, dtype=image.dtype, buffer=shared_memory_block.buf
+            )[...] = image
+            shared_image_specs[channel] = (
+                shared_memory_block.name,
+                image.shape,
+                image.dtype.str,
+            )
+        object_features = map_in_processes(
+            functools.partial(
+                measure_shared_object_colocalization_pairs,
+                channel_pairs=channel_pairs,
+                thr=thr,
+                fast_costes=fast_costes,
+            ),
+            object_slices,
+            n_processes=n_processes,
+            initializer=attach_shared_channel_images,
+            initargs=(shared_image_specs,),
+        )
+        for position, features in enumerate(object_features):
+            for feature, value in features.items():
+                columns[feature][position] = value
+    finally:
+        for shared_memory_block in shared_memory_blocks:
+            shared_memory_block.close()
+            shared_memory_block.unlink()
+    return columns
+
+
+def measure_3D_colocalization_labeled(
+    object_index: ObjectIndex,
+    channel_images: Dict[str, numpy.ndarray],
+    channel_pairs: Optional[List[Tuple[str, str]]] = None,
+    thr: int = 15,
+    fast_costes: str = "Accurate",
+) -> Dict[str, numpy.ndarray]:
+    """
+    Calculate the colocalization coefficients of several channel pairs for every object
+    from the voxels of each object.
+    The voxels of all objects are gathered once per channel through the object index,
+    and the sums behind the correlation, Manders', overlap and K coefficients
+    are labeled reductions over the object segments, so all objects are measured at once.
+    Only the Costes thresholds are searched per object.
+    Unlike measure_3D_colocalization_all_pairs, which measures the bounding box crop
+    of each object, the coefficients are calculated over the voxels of the object only.
+
+    Parameters
+    ----------
+    object_index : ObjectIndex
+        The index of the objects to measure.
+    channel_images : Dict[str, numpy.ndarray]
+        The image of each channel.
+    channel_pairs : Optional[List[Tuple[str, str]]], optional
+        The channel pairs to measure, by default None which measures every pair
+        of the channels
+    thr : int, optional
+        The threshold for the Manders' coefficients as a percentage of the maximum
+        intensity of each object, by default 15
+    fast_costes : str, optional
+        The mode for Costes' threshold calculation, by default "Accurate"
+
+    Returns
+    -------
+    Dict[str, numpy.ndarray]
+        The object_id column and one column per channel pair and feature,
+        named {channel1}.{channel2}_{feature}.
+    """
+    if channel_pairs is None:
+        channel_pairs = get_channel_pairs(list(channel_images.keys()))
+    pair_channels = list(dict.fromkeys(itertools.chain.from_iterable(channel_pairs)))
+    voxel_offsets = object_index.voxel_offsets
+    segment_starts = voxel_offsets[:-1]
+    counts = numpy.diff(voxel_offsets)
+    segments = numpy.repeat(numpy.arange(len(counts)), counts)
+
+    def segment_sum(array: numpy.ndarray) -> numpy.ndarray:
+        return numpy.add.reduceat(array, segment_starts)
+
+    # gather the voxels of all objects grouped by object once per channel
+    channel_values = {
+        channel: numpy.ravel(channel_images[channel])[
+            object_index.voxel_indices
+        ].astype(numpy.float64)
+        for channel in pair_channels
+    }
+    channel_maxima = {
+        channel: numpy.maximum.reduceat(values, segment_starts)
+        for channel, values in channel_values.items()
+    }
+
+    columns = get_colocalization_columns(object_index.object_ids, channel_pairs)
+    for channel1, channel2 in channel_pairs:
+        x = channel_values[channel1]
+        y = channel_values[channel2]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            # Pearson correlation coefficient of the voxels of each object
+            x_centered = x - (segment_sum(x) / counts)[segments]
+            y_centered = y - (segment_sum(y) / counts)[segments]
+            corr = segment_sum(x_centered * y_centered) / numpy.sqrt(
+                segment_sum(x_centered**2) * segment_sum(y_centered**2)
+            )
+            del x_centered, y_centered
+
+            # Manders' coefficients with a threshold relative to each object maximum
+            x_above = x >= ((thr / 100) * channel_maxima[channel1])[segments]
+            y_above = y >= ((thr / 100) * channel_maxima[channel2])[segments]
+            combined_thresh = x_above & y_above
+            M1 = segment_sum(numpy.where(combined_thresh, x, 0)) / segment_sum(
+                numpy.where(x_above, x, 0)
+            )
+            M2 = segment_sum(numpy.where(combined_thresh, y, 0)) / segment_sum(
+                numpy.where(y_above, y, 0)
+            )
+
+            # overlap coefficient
+            fpsq = segment_sum(numpy.where(combined_thresh, x * x, 0))
+            spsq = segment_sum(numpy.where(combined_thresh, y * y, 0))
+            product_sum = segment_sum(numpy.where(combined_thresh, x * y, 0))
+            overlap = product_sum / numpy.sqrt(fpsq * spsq)
+            K1 = product_sum / fpsq
+            K2 = product_sum / spsq
+
+            # Costes' thresholds are searched for each object
+            thr_first_image_c = numpy.zeros(len(counts))
+            thr_second_image_c = numpy.zeros(len(counts))
+            for position, start in enumerate(segment_starts):
+                first_values = x[start : voxel_offsets[position + 1]]
+                second_values = y[start : voxel_offsets[position + 1]]
+                if (
+                    channel_maxima[channel1][position] > 255
+                    or channel_maxima[channel2][position] > 255
+                ):
+                    scale = 65535
+                else:
+                    scale = 255
+                if fast_costes == "Accurate":
+                    thresholds = bisection_costes_threshold_calculation(
+                        first_values, second_values, scale
+                    )
+                else:
+                    thresholds = linear_costes_threshold_calculation(
+                        first_values, second_values, scale, fast_costes
+                    )
+                thr_first_image_c[position], thr_second_image_c[position] = thresholds
+            thr_first_image_c = thr_first_image_c[segments]
+            thr_second_image_c = thr_second_image_c[segments]
+            combined_thresh_c = (x > thr_first_image_c) & (y > thr_second_image_c)
+            C1 = segment_sum(numpy.where(combined_thresh_c, x, 0)) / segment_sum(
+                numpy.where(x >= thr_first_image_c, x, 0)
+            )
+            C2 = segment_sum(numpy.where(combined_thresh_c, y, 0)) / segment_sum(
+                numpy.where(y >= thr_second_image_c, y, 0)
+            )
+
+        # every coefficient is a single value per object,
+        # so its mean, median, minimum and maximum are the same
+        coefficients = dict(
+            zip(COLOCALIZATION_COEFFICIENTS, [corr, M1, M2, overlap, K1, K2, C1, C2])
+        )
+        for coefficient, values in coefficients.items():
+            for statistic in ["MEAN", "MEDIAN", "MIN", "MAX"]:
+                columns[f"{channel1}.{channel2}_{statistic}.{coefficient}"] = values
+    return columns
@@ -1,11 +1,15 @@
-from typing import Tuple, Union
+import itertools
+from typing import Dict, List, Tuple, Union
 
 import cucim.skimage.measure
 import cupy
 import cupyx
 import cupyx.scipy.ndimage
+import numpy
 import scipy
 import skimage
+from colocalization_utils import expand_box, get_crop_slices, get_matched_crop_bboxes
+from loading_classes import ObjectIndex
 
 
 def linear_costes_gpu(
@@ -225,22 +229,19 @@ def expand_box_gpu(
     -------
     Tuple[Union[int, float], Union[int, float]]
         The new minimum and maximum coordinates of the bounding box.
+
     Raises
     ------
     ValueError
         If the bounding box cannot be expanded by the requested amount.
     """
-    if max_coord - min_coor - (current_max - current_min) < expand_by:
-        return ValueError("Cannot expand box by the requested amount")
-    while expand_by > 0:
-        if current_min > min_coor:
-            current_min -= 1
-            expand_by -= 1
-        elif current_max < max_coord:
-            current_max += 1
-            expand_by -= 1
-
-    return current_min, current_max
+    return expand_box(
+        min_coor=min_coor,
+        max_coord=max_coord,
+        current_min=current_min,
+        current_max=current_max,
+        expand_by=expand_by,
+    )
 
 
 def new_crop_border_gpu(
@@ -295,76 +296,19 @@ def new_crop_border_gpu(
     -------
     Tuple[Tuple[Union[int, float], Union[int, float], Union[int, float], Union[int, float], Union[int, float], Union[int, float]], Tuple[Union[int, float], Union[int, float], Union[int, float], Union[int, float], Union[int, float], Union[int, float]]]
         The new bounding boxes of the two objects.
+
     Raises
+    ------
     ValueError
         If the expansion is not possible.
     """
-    i1z1, i1y1, i1x1, i1z2, i1y2, i1x2 = bbox1
-    i2z1, i2y1, i2x1, i2z2, i2y2, i2x2 = bbox2
-    z_range1 = i1z2 - i1z1
-    y_range1 = i1y2 - i1y1
-    x_range1 = i1x2 - i1x1
-    z_range2 = i2z2 - i2z1
-    y_range2 = i2y2 - i2y1
-    x_range2 = i2x2 - i2x1
-    z_diff = cupy.abs(z_range1 - z_range2)
-    y_diff = cupy.abs(y_range1 - y_range2)
-    x_diff = cupy.abs(x_range1 - x_range2)
-    min_z_coord = 0
-    max_z_coord = image.shape[0]
-    min_y_coord = 0
-    max_y_coord = image.shape[1]
-    min_x_coord = 0
-    max_x_coord = image.shape[2]
-    if z_range1 < z_range2:
-        i1z1, i1z2 = expand_box_gpu(
-            min_coor=min_z_coord,
-            max_coord=max_z_coord,
-            current_min=i1z1,
-            current_max=i1z2,
-            expand_by=z_diff,
-        )
-    elif z_range1 > z_range2:
-        i2z1, i2z2 = expand_box_gpu(
-            min_coor=min_z_coord,
-            max_coord=max_z_coord,
-            current_min=i2z1,
-            current_max=i2z2,
-            expand_by=z_diff,
-        )
-    if y_range1 < y_range2:
-        i1y1, i1y2 = expand_box_gpu(
-            min_coor=min_y_coord,
-            max_coord=max_y_coord,
-            current_min=i1y1,
-            current_max=i1y2,
-            expand_by=y_diff,
-        )
-    elif y_range1 > y_range2:
-        i2y1, i2y2 = expand_box_gpu(
-            min_coor=min_y_coord,
-            max_coord=max_y_coord,
-            current_min=i2y1,
-            current_max=i2y2,
-            expand_by=y_diff,
-        )
-    if x_range1 < x_range2:
-        i1x1, i1x2 = expand_box_gpu(
-            min_coor=min_x_coord,
-            max_coord=max_x_coord,
-            current_min=i1x1,
-            current_max=i1x2,
-            expand_by=x_diff,
-        )
-    elif x_range1 > x_range2:
-        i2x1, i2x2 = expand_box_gpu(
-            min_coor=min_x_coord,
-            max_coord=max_x_coord,
-            current_min=i2x1,
-            current_max=i2x2,
-            expand_by=x_diff,
-        )
-    return (i1z1, i1y1, i1x1, i1z2, i1y2, i1x2), (i2z1, i2y1, i2x1, i2z2, i2y2, i2x2)
+    # the bounding boxes of cucim are device scalars
+    new_bboxes1, new_bboxes2 = get_matched_crop_bboxes(
+        numpy.array([int(x) for x in bbox1]),
+        numpy.array([int(x) for x in bbox2]),
+        image.shape,
+    )
+    return tuple(new_bboxes1[0].tolist()), tuple(new_bboxes2[0].tolist())
 
 
 # crop the image to the bbox of the mask
@@ -637,3 +581,62 @@ def measure_3D_colocalization_gpu(
     results["MIN.MANDERS.COEFF.COSTES.M2"] = cupy.min(C2).get()
     results["MAX.MANDERS.COEFF.COSTES.M2"] = cupy.max(C2).get()
     return results
+
+
+def measure_3D_colocalization_all_pairs_gpu(
+    object_index: ObjectIndex,
+    channel_images: Dict[str, numpy.ndarray],
+    channel_pairs: List[Tuple[str, str]],
+    thr: int = 15,
+    fast_costes: str = "Accurate",
+) -> Dict[str, numpy.ndarray]:
+    """
+    Calculate the colocalization coefficients of several channel pairs for every object
+    on the GPU.
+    The bounding box of each object is cropped from each channel and copied
+    to the GPU once, and every pair is measured from the shared crops.
+
+    Parameters
+    ----------
+    object_index : ObjectIndex
+        The index of the objects to measure.
+    channel_images : Dict[str, numpy.ndarray]
+        The image of each channel.
+    channel_pairs : List[Tuple[str, str]]
+        The channel pairs to measure.
+    thr : int, optional
+        The threshold for the Manders' coefficients, by default 15
+    fast_costes : str, optional
+        The mode for Costes' threshold calculation, by default "Accurate"
+
+    Returns
+    -------
+    Dict[str, numpy.ndarray]
+        The object_id column and one column per channel pair and feature,
+        named {channel1}.{channel2}_{feature}.
+    """
+    pair_channels = list(dict.fromkeys(itertools.chain.from_iterable(channel_pairs)))
+    columns = {"object_id": numpy.asarray(object_index.object_ids)}
+    # every pair is measured on the same object so its windows are its bounding box
+    crop_bboxes, _ = get_matched_crop_bboxes(
+        object_index.bboxes, object_index.bboxes, object_index.shape
+    )
+    for position, slices in enumerate(get_crop_slices(crop_bboxes)):
+        cropped_images = {
+            channel: cupy.asarray(channel_images[channel][slices])
+            for channel in pair_channels
+        }
+        for channel1, channel2 in channel_pairs:
+            colocalization_features = measure_3D_colocalization_gpu(
+                cropped_image_1=cropped_images[channel1],
+                cropped_image_2=cropped_images[channel2],
+                thr=thr,
+                fast_costes=fast_costes,
+            )
+            for feature, value in colocalization_features.items():
+                column = columns.setdefault(
+                    f"{channel1}.{channel2}_{feature}",
+                    numpy.full(len(object_index.object_ids), numpy.nan),
+                )
+                column[position] = value
+    return columns
@@ -1,5 +1,7 @@
 import argparse
+from typing import Optional
 
+from area_size_shape_utils import SURFACE_AREA_METHODS
 from errors import ProcessorTypeError
 
 
@@ -15,8 +17,24 @@ def check_for_missing_args(**kwargs):
         )
 
 
-def parse_featurization_args():
-    argparser = argparse.ArgumentParser()
+def parse_integer_list(value: str) -> list:
+    try:
+        return [int(item) for item in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Expected comma separated integers, got '{value}'"
+        )
+
+
+def add_image_set_arguments(argparser: argparse.ArgumentParser) -> None:
+    """
+    Add the arguments that select the image set and the processor.
+
+    Parameters
+    ----------
+    argparser : argparse.ArgumentParser
+        The parser to add the arguments to.
+    """
     argparser.add_argument(
         "--well_fov",
         type=str,
@@ -30,23 +48,232 @@ def parse_featurization_args():
         help="Patient ID, e.g. 'NF0014'",
     )
     argparser.add_argument(
-        "--channel",
+        "--processor_type",
         type=str,
         default=None,
-        help="Channel to process, e.g. 'DNA'",
+        help="Type of processor to use, e.g. 'CPU' or 'GPU'",
+    )
+
+
+def add_featurization_option_arguments(
+    argparser: argparse.ArgumentParser,
+    channel_output_default: Optional[str] = None,
+) -> None:
+    """
+    Add the options of the feature extraction shared by the per feature scripts
+    and the image set script.
+
+    Parameters
+    ----------
+    argparser : argparse.ArgumentParser
+        The parser to add the arguments to.
+    channel_output_default : Optional[str], optional
+        The default of the Intensity, Granularity and Colocalization outputs,
+        by default None which runs each channel or channel pair separately
+    """
+    argparser.add_argument(
+        "--image_backend",
+        type=str,
+        default="imread",
+        choices=["imread", "memmap"],
+        help=(
+            "How the images are read, 'imread' decodes each image into memory and "
+            "'memmap' memory maps them, writing an uncompressed copy of each "
+            "compressed tiff to data/{patient}/memmap_cache/"
+        ),
     )
     argparser.add_argument(
-        "--compartment",
+        "--save_quantized_images",
+        action="store_true",
+        help=(
+            "Save the gray level quantized channels used by Texture next to the "
+            "images and reuse them in later runs"
+        ),
+    )
+    argparser.add_argument(
+        "--save_object_indices",
+        action="store_true",
+        help=(
+            "Save the object index of each compartment mask to a sidecar file in "
+            "zstack_images/{well_fov}/object_index/ and reuse it in later runs"
+        ),
+    )
+    argparser.add_argument(
+        "--n_processes",
+        type=int,
+        default=1,
+        help="Number of processes to use for the per object work that runs in parallel",
+    )
+    argparser.add_argument(
+        "--surface_area_method",
+        type=str,
+        default="marching_cubes",
+        choices=SURFACE_AREA_METHODS,
+        help=(
+            "Surface area method for AreaSizeShape, 'marching_cubes' or the faster "
+            "but less exact 'voxel_faces'"
+        ),
+    )
+    separately_help = (
+        " By default each channel is run separately"
+        if channel_output_default is None
+        else ""
+    )
+    for feature in ["Intensity", "Granularity"]:
+        argparser.add_argument(
+            f"--{feature.lower()}_output",
+            type=str,
+            default=channel_output_default,
+            choices=["per_channel", "wide"],
+            help=(
+                f"Measure all {feature} channels of a compartment together and write "
+                "either one file per channel or a single wide file." + separately_help
+            ),
+        )
+    argparser.add_argument(
+        "--colocalization_output",
+        type=str,
+        default=channel_output_default,
+        choices=["per_channel", "wide"],
+        help=(
+            "Measure all Colocalization channel pairs of a compartment together and "
+            "write either one file per channel pair or a single wide file."
+            + separately_help.replace("channel", "channel pair")
+        ),
+    )
+    argparser.add_argument(
+        "--intensity_engine",
+        type=str,
+        default="standard",
+        choices=["standard", "vectorized"],
+        help=(
+            "Intensity engine, 'standard' measures each channel as before and the CPU "
+            "only 'vectorized' measures every statistic over the voxels of all objects "
+            "at once, writing features with a '_Vectorized' suffix"
+        ),
+    )
+    argparser.add_argument(
+        "--granularity_crop_mode",
         type=str,
         default=None,
-        help="Compartment to process, e.g. 'Nuclei'",
+        choices=["object", "region"],
+        help=(
+            "Measure Granularity in crops of each object ('object') or of each "
+            "organoid ('region') over --n_processes processes instead of the whole image"
+        ),
     )
     argparser.add_argument(
-        "--processor_type",
+        "--colocalization_engine",
+        type=str,
+        default="crop",
+        choices=["crop", "labeled"],
+        help=(
+            "Colocalization engine, 'crop' measures the bounding box of each object and "
+            "the CPU only 'labeled' measures the voxels of all objects at once"
+        ),
+    )
+    argparser.add_argument(
+        "--neighbors_distances",
+        type=parse_integer_list,
+        default="10",
+        help="Comma separated Neighbors distance thresholds in pixels, e.g. '5,10,20'",
+    )
+    argparser.add_argument(
+        "--neighbors_engine",
+        type=str,
+        default="kdtree",
+        choices=["crop", "kdtree"],
+        help=(
+            "Neighbors engine, 'kdtree' counts the neighbors of all objects at once and "
+            "'crop' counts the labels in the crop of each object"
+        ),
+    )
+    argparser.add_argument(
+        "--adjacency_graph",
+        action="store_true",
+        help=(
+            "Also write the edge list of the touching objects of the Neighbors "
+            "compartments to Object_Adjacency_Graph_{compartment}.parquet"
+        ),
+    )
+    argparser.add_argument(
+        "--texture_distances",
+        type=parse_integer_list,
+        default="3",
+        help="Comma separated Texture distances in pixels, e.g. '1,3,5'",
+    )
+    argparser.add_argument(
+        "--texture_gray_levels",
+        type=parse_integer_list,
+        default="256",
+        help="Comma separated numbers of Texture gray levels, e.g. '64,256'",
+    )
+    argparser.add_argument(
+        "--texture_normalization",
+        type=str,
+        default="object",
+        choices=["object", "global"],
+        help=(
+            "Texture gray level scaling, 'object' scales each object to its maximum and "
+            "'global' scales the channel once to its minimum and maximum"
+        ),
+    )
+
+
+def get_featurization_option_values(args: argparse.Namespace) -> dict:
+    """
+    Get the values of the arguments added by add_featurization_option_arguments.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The parsed arguments.
+
+    Returns
+    -------
+    dict
+        The value of each featurization option.
+    """
+    return {
+        "image_backend": args.image_backend,
+        "save_quantized_images": args.save_quantized_images,
+        "save_object_indices": args.save_object_indices,
+        "n_processes": args.n_processes,
+        "surface_area_method": args.surface_area_method,
+        "intensity_output": args.intensity_output,
+        "intensity_engine": args.intensity_engine,
+        "granularity_output": args.granularity_output,
+        "granularity_crop_mode": args.granularity_crop_mode,
+        "colocalization_output": args.colocalization_output,
+        "colocalization_engine": args.colocalization_engine,
+        "neighbors_distances": args.neighbors_distances,
+        "neighbors_engine": args.neighbors_engine,
+        "adjacency_graph": args.adjacency_graph,
+        "texture_distances": args.texture_distances,
+        "texture_gray_levels": args.texture_gray_levels,
+        "texture_normalization": args.texture_normalization,
+    }
+
+
+def parse_featurization_args():
+    argparser = argparse.ArgumentParser()
+    add_image_set_arguments(argparser)
+    argparser.add_argument(
+        "--channel",
         type=str,
         default=None,
-        help="Type of processor to use, e.g. 'CPU' or 'GPU'",
+        help=(
+            "Channel to process, e.g. 'DNA', or for Intensity and Granularity several "
+            "channels separated by '.'. Colocalization measures every pair of the channels"
+        ),
+    )
+    argparser.add_argument(
+        "--compartment",
+        type=str,
+        default=None,
+        help="Compartment to process, e.g. 'Nuclei'",
     )
+    add_featurization_option_arguments(argparser, channel_output_default="per_channel")
 
     args = argparser.parse_args()
     well_fov = args.well_fov
@@ -69,4 +296,41 @@ def parse_featurization_args():
         "channel": channel,
         "compartment": compartment,
         "processor_type": processor_type,
+        **get_featurization_option_values(args),
+    }
+
+
+def parse_image_set_featurization_args():
+    argparser = argparse.ArgumentParser()
+    add_image_set_arguments(argparser)
+    argparser.add_argument(
+        "--features",
+        type=str,
+        default="all",
+        help=(
+            "Comma separated feature types to process, e.g. 'Intensity,Texture'. "
+            "Defaults to 'all' which processes every feature type"
+        ),
+    )
+    add_featurization_option_arguments(argparser)
+
+    args = argparser.parse_args()
+    well_fov = args.well_fov
+    patient = args.patient
+    processor_type = args.processor_type
+    features = args.features
+    check_for_missing_args(
+        well_fov=well_fov,
+        patient=patient,
+        processor_type=processor_type,
+    )
+    if processor_type not in ["CPU", "GPU"]:
+        raise ProcessorTypeError("Processor type not recognized. Use 'CPU' or 'GPU'.")
+    features = None if features == "all" else features.split(",")
+    return {
+        "well_fov": well_fov,
+        "patient": patient,
+        "processor_type": processor_type,
+        "features": features,
+        **get_featurization_option_values(args),
     }
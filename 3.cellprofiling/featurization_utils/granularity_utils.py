@@ -1,4 +1,5 @@
-from typing import Dict
+import functools
+from typing import Dict, List, Optional, Tuple
 
 import cucim
 import cucim.skimage.morphology
@@ -10,7 +11,8 @@ import pandas
 import scipy
 import skimage
 import tqdm
-from loading_classes import ImageSetLoader, ObjectLoader
+from loading_classes import ImageSetLoader, ObjectIndex, ObjectLoader
+from parallel_utils import map_in_processes
 
 
 def granularity_feature(length):
@@ -18,56 +20,481 @@ def granularity_feature(length):
     return C_GRANULARITY % (length)
 
 
-class ObjectGranularityRecord:
+MORPHOLOGY_BACKENDS = ["skimage", "decomposed"]
+GRANULARITY_CROP_MODES = ["object", "region"]
+
+
+def get_footprint_rows(footprint: numpy.ndarray) -> Dict[tuple, tuple]:
     """
-    This class is used to store the information about the object.
+    Describe a 3D footprint as centered runs along its last axis.
+    A ball is the union of one line segment along x for each of its (z, y) rows.
 
     Parameters
     ----------
-    object_loader : ObjectLoader
-        The object loader that contains the image and label image.
-    object_index : int
-        The index of the object to be measured.
-    Attributes
+    footprint : numpy.ndarray
+        The 3D footprint with an odd size along each axis.
+
+    Returns
+    -------
+    Dict[int, tuple]
+        For each z offset from the center, the (y offset, half width)
+        of each run along x in that plane.
+
+    Raises
+    ------
+    ValueError
+        If the footprint has an even size or a row that is not a centered run.
+    """
+    footprint = numpy.asarray(footprint, dtype=bool)
+    if footprint.ndim != 3 or any(size % 2 == 0 for size in footprint.shape):
+        raise ValueError(
+            f"The footprint has to be 3D with odd sizes, got shape {footprint.shape}"
+        )
+    radius_z, radius_y, radius_x = (size // 2 for size in footprint.shape)
+    rows = {}
+    for z in range(footprint.shape[0]):
+        z_rows = []
+        for y in range(footprint.shape[1]):
+            row = footprint[z, y]
+            if not row.any():
+                continue
+            half_width = int(row.sum()) // 2
+            expected_row = numpy.zeros_like(row)
+            expected_row[radius_x - half_width : radius_x + half_width + 1] = True
+            if not numpy.array_equal(row, expected_row):
+                raise ValueError(
+                    "Only footprints made of centered runs along the last axis "
+                    "can be decomposed, such as balls"
+                )
+            z_rows.append((y - radius_y, half_width))
+        if z_rows:
+            rows[z - radius_z] = tuple(z_rows)
+    return rows
+
+
+def decomposed_grey_morphology(
+    image,
+    footprint: numpy.ndarray,
+    operation: str = "erosion",
+):
+    """
+    Flat grey erosion or dilation by a footprint made of centered runs along x,
+    such as a ball.
+    The footprint is the union of its rows, so the result is the minimum or maximum
+    over the rows of the shifted 1D filters along x.
+    Every distinct run width is filtered once with a linear time 1D filter,
+    every distinct plane profile is combined once over y and
+    the planes are then combined over z.
+    The result is identical to skimage.morphology.erosion and dilation
+    with their default reflect mode.
+    CuPy arrays are processed on the GPU.
+
+    Parameters
+    ----------
+    image : numpy.ndarray or cupy.ndarray
+        The 3D image.
+    footprint : numpy.ndarray
+        The 3D footprint.
+    operation : str, optional
+        "erosion" or "dilation", by default "erosion"
+
+    Returns
+    -------
+    numpy.ndarray or cupy.ndarray
+        The eroded or dilated image.
+    """
+    if operation not in ["erosion", "dilation"]:
+        raise ValueError(
+            f"Operation {operation} is not supported. Use 'erosion' or 'dilation'."
+        )
+    on_gpu = isinstance(image, cupy.ndarray)
+    array_module = cupy if on_gpu else numpy
+    ndimage = cupyx.scipy.ndimage if on_gpu else scipy.ndimage
+    if operation == "erosion":
+        filter1d = ndimage.minimum_filter1d
+        combine = array_module.minimum
+    else:
+        filter1d = ndimage.maximum_filter1d
+        combine = array_module.maximum
+
+    rows = get_footprint_rows(footprint)
+    radius_z, radius_y = footprint.shape[0] // 2, footprint.shape[1] // 2
+    shape_z, shape_y = image.shape[0], image.shape[1]
+    # reflect mode along z and y, the 1D filters reflect along x
+    padded = array_module.pad(
+        image, ((radius_z, radius_z), (radius_y, radius_y), (0, 0)), mode="symmetric"
+    )
+    line_filtered = {
+        half_width: filter1d(padded, size=2 * half_width + 1, axis=-1, mode="reflect")
+        for half_width in sorted({w for z_rows in rows.values() for _, w in z_rows})
+    }
+    del padded
+
+    plane_filtered = {}
+    for z_rows in set(rows.values()):
+        plane = None
+        for y_offset, half_width in z_rows:
+            shifted = line_filtered[half_width][
+                :, radius_y + y_offset : radius_y + y_offset + shape_y
+            ]
+            if plane is None:
+                plane = shifted.copy()
+            else:
+                combine(plane, shifted, out=plane)
+        plane_filtered[z_rows] = plane
+    del line_filtered
+
+    result = None
+    for z_offset, z_rows in rows.items():
+        shifted = plane_filtered[z_rows][
+            radius_z + z_offset : radius_z + z_offset + shape_z
+        ]
+        if result is None:
+            result = shifted.copy()
+        else:
+            combine(result, shifted, out=result)
+    return result
+
+
+def grey_morphology(
+    image,
+    footprint,
+    operation: str = "erosion",
+    backend: str = "decomposed",
+):
+    """
+    Flat grey erosion or dilation of a 3D image with a selectable backend.
+
+    Parameters
+    ----------
+    image : numpy.ndarray or cupy.ndarray
+        The 3D image.
+    footprint : numpy.ndarray or cupy.ndarray
+        The 3D footprint.
+    operation : str, optional
+        "erosion" or "dilation", by default "erosion"
+    backend : str, optional
+        "skimage" or "decomposed", by default "decomposed".
+        "skimage" uses skimage.morphology on the CPU,
+        CuPy arrays are copied to the host and back.
+        "decomposed" gives the same result with decomposed_grey_morphology,
+        which is much faster for large balls and runs CuPy arrays on the GPU.
+
+    Returns
+    -------
+    numpy.ndarray or cupy.ndarray
+        The eroded or dilated image.
+    """
+    if backend not in MORPHOLOGY_BACKENDS:
+        raise ValueError(
+            f"Morphology backend {backend} is not supported. "
+            f"Use one of {MORPHOLOGY_BACKENDS}."
+        )
+    if isinstance(footprint, cupy.ndarray):
+        footprint = footprint.get()
+    if backend == "decomposed":
+        return decomposed_grey_morphology(image, footprint, operation=operation)
+    skimage_function = (
+        skimage.morphology.erosion
+        if operation == "erosion"
+        else skimage.morphology.dilation
+    )
+    if isinstance(image, cupy.ndarray):
+        # the cucim erosion and dilation raise a jitify runtime error
+        # so they run on the host
+        return cupy.asarray(skimage_function(image.get(), footprint=footprint))
+    return skimage_function(image, footprint=footprint)
+
+
+def resample_image(
+    image: numpy.ndarray,
+    scale: numpy.ndarray,
+    output_shape: tuple,
+    order: int = 1,
+    z_start: int = 0,
+) -> numpy.ndarray:
+    """
+    Resample an image so that each output voxel index is multiplied by a per axis scale
+    to find its input coordinate.
+    The resampling is separable so no dense coordinate grids are created,
+    and gives the same values as scipy.ndimage.map_coordinates on the equivalent grid.
+
+    Parameters
     ----------
-    object_index : int
-        The index of the object to be measured.
-    labels : numpy.ndarray
-        The labels of the object in the image.
     image : numpy.ndarray
-        The image of the object.
-    nobjects : int
-        The number of objects in the image.
-    range : numpy.ndarray
-        The range of the object labels.
-    current_mean : float
-        The current mean intensity of the object.
-    start_mean : float
-        The starting mean intensity of the object.
-    Methods
+        The 3D image to resample.
+    scale : numpy.ndarray
+        The input coordinate step of each axis per output voxel.
+    output_shape : tuple
+        The shape of the resampled image.
+    order : int, optional
+        The spline interpolation order, by default 1
+    z_start : int, optional
+        The first output z slice, to resample a slab of the output, by default 0
+
+    Returns
     -------
-    __init__(object_loader, object_index)
-        Initializes the ObjectRecord with the object loader and object index.
+    numpy.ndarray
+        The resampled image with the dtype of the input image.
     """
+    scale = numpy.asarray(scale, dtype=float)
+    return scipy.ndimage.affine_transform(
+        image,
+        numpy.diag(scale),
+        offset=(scale[0] * z_start, 0, 0),
+        output_shape=output_shape,
+        order=order,
+    )
 
-    def __init__(self, object_loader, object_index):
-        self.object_index = object_index
-        self.labels = object_loader.label_image.copy()
-        # select the object
-        self.labels[self.labels != object_index] = 0
-        self.image = object_loader.image.copy()
-        self.image[self.labels != object_index] = 0
 
-        self.nobjects = len(numpy.unique(self.labels))
-        if self.nobjects != 0:
-            self.current_mean = scipy.ndimage.mean(self.image, self.labels)
+def get_upsampled_object_means(
+    image: numpy.ndarray,
+    label_image: numpy.ndarray,
+    object_ids: numpy.ndarray,
+    voxel_counts: numpy.ndarray,
+    scale: numpy.ndarray,
+    z_chunk_size: int = 8,
+) -> numpy.ndarray:
+    """
+    Get the mean of each object in a downsampled image upsampled to the shape
+    of the label image.
+    The image is upsampled a slab of z slices at a time so that the full size
+    image is never held in memory.
 
-            self.start_mean = numpy.maximum(self.current_mean, numpy.finfo(float).eps)
-        else:
-            raise ValueError(
-                f"No objects found in the image for object index {object_index}"
+    Parameters
+    ----------
+    image : numpy.ndarray
+        The downsampled 3D image.
+    label_image : numpy.ndarray
+        The full size labeled image.
+    object_ids : numpy.ndarray
+        The object IDs to measure.
+    voxel_counts : numpy.ndarray
+        The number of voxels of each object.
+    scale : numpy.ndarray
+        The downsampled coordinate step of each axis per full size voxel.
+    z_chunk_size : int, optional
+        The number of z slices upsampled at a time, by default 8
+
+    Returns
+    -------
+    numpy.ndarray
+        The mean of each object.
+    """
+    object_sums = numpy.zeros(len(object_ids))
+    for z_start in range(0, label_image.shape[0], z_chunk_size):
+        label_slab = label_image[z_start : z_start + z_chunk_size]
+        upsampled_slab = resample_image(
+            image,
+            scale,
+            output_shape=label_slab.shape,
+            order=1,
+            z_start=z_start,
+        )
+        object_sums += scipy.ndimage.sum_labels(
+            upsampled_slab, labels=label_slab, index=object_ids
+        )
+    return object_sums / voxel_counts
+
+
+def measure_granularity_spectra(
+    label_image: numpy.ndarray,
+    channel_images: Dict[str, numpy.ndarray],
+    object_ids: numpy.ndarray,
+    voxel_counts: numpy.ndarray,
+    radius: int = 10,
+    granular_spectrum_length: int = 16,
+    subsample_size: float = 0.25,
+    morphology_backend: str = "decomposed",
+) -> Dict[str, list]:
+    """
+    Calculate the granularity spectrum of each object of a labeled image
+    in one or more channels.
+    Every labeled voxel is part of the mask, but only the given objects are measured,
+    so the image can be a crop holding neighbouring objects.
+
+    Parameters
+    ----------
+    label_image : numpy.ndarray
+        The labeled image.
+    channel_images : Dict[str, numpy.ndarray]
+        The image of each channel to measure, with the shape of the labeled image.
+    object_ids : numpy.ndarray
+        The object IDs to measure.
+    voxel_counts : numpy.ndarray
+        The number of voxels of each object.
+    radius : int, optional
+        The radius of the ball used for morphological operations, by default 10
+    granular_spectrum_length : int, optional
+        The length of the granular spectrum, by default 16
+    subsample_size : float, optional
+        The size of the image subsample, by default 0.25
+    morphology_backend : str, optional
+        The backend of the erosions and dilations, by default "decomposed"
+
+    Returns
+    -------
+    Dict[str, list]
+        The object_id, channel, feature and value of every measurement.
+    """
+    # downsample for computational speed
+    # the scales map the output voxels to input coordinates
+    orig_shape = numpy.array(label_image.shape)
+    new_shape = orig_shape * subsample_size
+    downsampled_shape = tuple(int(size) for size in numpy.ceil(new_shape))
+    downsample_scale = numpy.full(3, 1 / subsample_size)
+    upsample_scale = (new_shape - 1) / (orig_shape - 1)
+
+    # the mask and structuring elements are shared by every channel
+    # 0.9 is a threshold to determine if the pixel is part of the object
+    mask = (
+        resample_image(
+            label_image.astype(float), downsample_scale, downsampled_shape, order=3
+        )
+        > 0.9
+    )
+    back_mask = (
+        resample_image(mask.astype(float), downsample_scale, downsampled_shape, order=3)
+        > 0.9
+    )
+    back_footprint = skimage.morphology.ball(radius, dtype=bool)
+    footprint = skimage.morphology.ball(1, dtype=bool)
+
+    object_measurements = {"object_id": [], "channel": [], "feature": [], "value": []}
+    for channel, image_object in channel_images.items():
+        pixels = resample_image(image_object, downsample_scale, downsampled_shape)
+
+        back_pixels = resample_image(pixels, downsample_scale, downsampled_shape)
+        back_pixels_mask = numpy.zeros_like(back_pixels)
+        back_pixels_mask[back_mask == True] = back_pixels[back_mask == True]
+        back_pixels = grey_morphology(
+            back_pixels_mask,
+            back_footprint,
+            operation="erosion",
+            backend=morphology_backend,
+        )
+
+        back_pixels_mask = numpy.zeros_like(back_pixels)
+        back_pixels_mask[back_mask == True] = back_pixels[back_mask == True]
+
+        back_pixels = grey_morphology(
+            back_pixels_mask,
+            back_footprint,
+            operation="dilation",
+            backend=morphology_backend,
+        )
+        pixels -= back_pixels
+        pixels[pixels < 0] = 0
+
+        startmean = numpy.mean(pixels[mask])
+        ero = pixels.copy()
+
+        # Mask the test image so that masked pixels will have no effect
+        # during reconstruction
+        ero[~mask] = 0
+        currentmean = startmean
+        startmean = max(startmean, numpy.finfo(float).eps)
+        feature_measurments = {}
+        # the spectrum state of every object, starting from its mean in the image
+        object_current_means = scipy.ndimage.mean(
+            image_object, labels=label_image, index=object_ids
+        )
+        object_start_means = numpy.maximum(object_current_means, numpy.finfo(float).eps)
+        for i in range(1, granular_spectrum_length + 1):
+            prevmean = currentmean
+            ero_mask = numpy.zeros_like(ero)
+            ero_mask[mask == True] = ero[mask == True]
+            ero = grey_morphology(
+                ero_mask, footprint, operation="erosion", backend=morphology_backend
             )
 
+            rec = skimage.morphology.reconstruction(ero, pixels, footprint=footprint)
+            currentmean = numpy.mean(rec[mask])
+            gs = (prevmean - currentmean) * 100 / startmean
+            feature = granularity_feature(i)
+            feature_measurments[feature] = gs
+            # Restore the reconstructed image to the shape of the
+            # original image so we can match against object labels
+            object_new_means = get_upsampled_object_means(
+                rec,
+                label_image,
+                object_ids=object_ids,
+                voxel_counts=voxel_counts,
+                scale=upsample_scale,
+            )
+            object_gs = (
+                (object_current_means - object_new_means) * 100 / object_start_means
+            )
+            object_current_means = object_new_means
+            object_measurements["object_id"].extend(object_ids)
+            object_measurements["channel"].extend([channel] * len(object_ids))
+            object_measurements["feature"].extend([feature] * len(object_ids))
+            object_measurements["value"].extend(object_gs)
+    return object_measurements
+
+
+def get_granularity_crops(
+    object_index: ObjectIndex,
+    padding: int,
+    alignment: int = 1,
+    region_label_image: Optional[numpy.ndarray] = None,
+) -> List[Tuple[Tuple[slice, ...], numpy.ndarray]]:
+    """
+    Plan the crops that the granularity of the objects is measured in.
+    Each object gets the crop of its padded bounding box, or when a region labeled
+    image is given, e.g. the organoids, the objects in the same region share the crop
+    of their padded union bounding box.
+    Objects outside of every region get their own crop.
+
+    Parameters
+    ----------
+    object_index : ObjectIndex
+        The index of the objects to measure.
+    padding : int
+        The padding of each bounding box in voxels.
+    alignment : int, optional
+        The crop starts are rounded down to a multiple of the alignment so that
+        a downsampled crop samples the same voxels as the downsampled image,
+        by default 1
+    region_label_image : Optional[numpy.ndarray], optional
+        The labeled regions to group the objects by, by default None
+
+    Returns
+    -------
+    List[Tuple[Tuple[slice, ...], numpy.ndarray]]
+        The slices of each crop and the positions in the object index
+        of the objects measured in it.
+    """
+    positions = numpy.arange(len(object_index.object_ids))
+    if region_label_image is None:
+        groups = [position[None] for position in positions]
+    else:
+        # each object belongs to the region holding most of its voxels
+        region_labels = numpy.ravel(region_label_image)
+        object_regions = numpy.zeros(len(positions), dtype=numpy.int64)
+        for position, object_id in enumerate(object_index.object_ids):
+            voxel_regions = region_labels[object_index.get_voxel_indices(object_id)]
+            voxel_regions = voxel_regions[voxel_regions > 0]
+            if voxel_regions.size > 0:
+                regions, counts = numpy.unique(voxel_regions, return_counts=True)
+                object_regions[position] = regions[numpy.argmax(counts)]
+        groups = [position[None] for position in positions[object_regions == 0]]
+        groups += [
+            positions[object_regions == region]
+            for region in numpy.unique(object_regions[object_regions > 0])
+        ]
+    shape = numpy.array(object_index.shape)
+    crops = []
+    for group in groups:
+        bboxes = object_index.bboxes[group]
+        starts = numpy.maximum(bboxes[:, :3].min(axis=0) - padding, 0)
+        starts -= starts % alignment
+        stops = numpy.minimum(bboxes[:, 3:].max(axis=0) + padding, shape)
+        crops.append(
+            (tuple(slice(int(a), int(b)) for a, b in zip(starts, stops)), group)
+        )
+    return crops
+
 
 def measure_3D_granularity(
     object_loader: ObjectLoader,
@@ -75,10 +502,23 @@ def measure_3D_granularity(
     granular_spectrum_length: int = 16,
     subsample_size: float = 0.25,
     image_name: str = "image",
+    morphology_backend: str = "decomposed",
+    channel_images: Optional[Dict[str, numpy.ndarray]] = None,
+    crop_mode: Optional[str] = None,
+    region_label_image: Optional[numpy.ndarray] = None,
+    n_processes: int = 1,
 ) -> Dict[str, float]:
     """
     This function calculates the granularity of an image using the
     granularity feature. It uses the skimage library to perform the calculations.
+    Several channels can be measured in the same call, sharing the downsampled mask,
+    the structuring elements, and the object voxel counts.
+    By default the spectrum is calculated on the whole image.
+    In a crop mode it is instead calculated on crops around the objects,
+    padded by the reach of the background removal and of the spectrum,
+    and the crops are measured in parallel.
+    The cropped values are close to but not identical to the whole image values
+    as the background and the reconstructions only see the crop.
 
     Parameters
     ----------
@@ -92,114 +532,114 @@ def measure_3D_granularity(
         The size of the image subsample, by default 0.25
     image_name : str, optional
         The name of the image, by default "image"
+    morphology_backend : str, optional
+        The backend of the erosions and dilations, "skimage" or the identical
+        but much faster "decomposed", by default "decomposed"
+    channel_images : Optional[Dict[str, numpy.ndarray]], optional
+        The images of each channel to measure with the objects of the label image,
+        by default None which measures the object loader image
+    crop_mode : Optional[str], optional
+        None to measure the whole image, "object" to measure each object in its own
+        crop or "region" to measure the objects of each region of the region
+        labeled image in a shared crop, by default None
+    region_label_image : Optional[numpy.ndarray], optional
+        The labeled regions, e.g. the organoids, used by the "region" crop mode,
+        by default None
+    n_processes : int, optional
+        The number of processes measuring the crops, by default 1
 
     Returns
     -------
     Dict[str, float]
-        A dictionary containing the granularity feature measurements per object ID.
+        A dictionary containing the granularity feature measurements per object ID
+        and channel.
     """
-
-    image_object = object_loader.image
-    label_object = object_loader.label_image
-
-    pixels = image_object.copy()
-    mask = label_object.copy()
-
-    # begin by downsampling the image
-    new_shape = numpy.array(pixels.shape)
-    new_shape = (
-        new_shape * subsample_size
-    )  # downsample the image for computational speed
-    k, i, j = (
-        numpy.mgrid[0 : new_shape[0], 0 : new_shape[1], 0 : new_shape[2]].astype(float)
-        / subsample_size
-    )
-    pixels = scipy.ndimage.map_coordinates(pixels, (k, i, j), order=1)
-    mask = (
-        scipy.ndimage.map_coordinates(mask.astype(float), (k, i, j)) > 0.9
-    )  # 0.9 is a threshold to determine if the pixel is part of the object
-
-    back_shape = new_shape
-    k, i, j = (
-        numpy.mgrid[0 : new_shape[0], 0 : new_shape[1], 0 : new_shape[2]].astype(float)
-        / subsample_size
-    )
-    back_pixels = scipy.ndimage.map_coordinates(pixels, (k, i, j), order=1)
-    back_mask = scipy.ndimage.map_coordinates(mask.astype(float), (k, i, j)) > 0.9
-
-    footprint = skimage.morphology.ball(radius, dtype=bool)
-
-    back_pixels_mask = numpy.zeros_like(back_pixels)
-    back_pixels_mask[back_mask == True] = back_pixels[back_mask == True]
-    back_pixels = skimage.morphology.erosion(back_pixels_mask, footprint=footprint)
-
-    back_pixels_mask = numpy.zeros_like(back_pixels)
-    back_pixels_mask[back_mask == True] = back_pixels[back_mask == True]
-
-    back_pixels = skimage.morphology.dilation(back_pixels_mask, footprint=footprint)
-    k, i, j = numpy.mgrid[0 : new_shape[0], 0 : new_shape[1], 0 : new_shape[2]].astype(
-        float
+    if channel_images is None:
+        channel_images = {object_loader.channel: object_loader.image}
+    object_ids = numpy.asarray(object_loader.object_ids)
+    voxel_counts = numpy.diff(object_loader.object_index.voxel_offsets)
+    spectrum_kwargs = {
+        "radius": radius,
+        "granular_spectrum_length": granular_spectrum_length,
+        "subsample_size": subsample_size,
+        "morphology_backend": morphology_backend,
+    }
+    if crop_mode is None:
+        return measure_granularity_spectra(
+            object_loader.label_image,
+            channel_images,
+            object_ids,
+            voxel_counts,
+            **spectrum_kwargs,
+        )
+    if crop_mode not in GRANULARITY_CROP_MODES:
+        raise ValueError(
+            f"Crop mode {crop_mode} is not supported. "
+            f"Use one of {GRANULARITY_CROP_MODES}."
+        )
+    if crop_mode == "region" and region_label_image is None:
+        raise ValueError("The region crop mode needs a region labeled image.")
+
+    # the background removal reaches twice the radius and the spectrum one voxel
+    # per step in the downsampled image
+    padding = int(numpy.ceil((2 * radius + granular_spectrum_length) / subsample_size))
+    crops = get_granularity_crops(
+        object_loader.object_index,
+        padding=padding,
+        alignment=max(int(round(1 / subsample_size)), 1),
+        region_label_image=region_label_image if crop_mode == "region" else None,
     )
-    k *= float(back_shape[0] - 1) / float(new_shape[0] - 1)
-    i *= float(back_shape[1] - 1) / float(new_shape[1] - 1)
-    j *= float(back_shape[2] - 1) / float(new_shape[2] - 1)
-    back_pixels = scipy.ndimage.map_coordinates(back_pixels, (k, i, j), order=1)
-    pixels -= back_pixels
-    pixels[pixels < 0] = 0
+    object_measurements = {"object_id": [], "channel": [], "feature": [], "value": []}
+    for crop_measurements in map_in_processes(
+        functools.partial(measure_granularity_spectra, **spectrum_kwargs),
+        (numpy.array(object_loader.label_image[slices]) for slices, _ in crops),
+        (
+            {
+                channel: numpy.array(image[slices])
+                for channel, image in channel_images.items()
+            }
+            for slices, _ in crops
+        ),
+        (object_ids[group] for _, group in crops),
+        (voxel_counts[group] for _, group in crops),
+        n_processes=n_processes,
+    ):
+        for key, values in crop_measurements.items():
+            object_measurements[key].extend(values)
+    return object_measurements
 
-    startmean = numpy.mean(pixels[mask])
-    ero = pixels.copy()
 
-    # Mask the test image so that masked pixels will have no effect
-    # during reconstruction
-    ero[~mask] = 0
-    currentmean = startmean
-    startmean = max(startmean, numpy.finfo(float).eps)
-    footprint = skimage.morphology.ball(1, dtype=bool)
-    feature_measurments = {}
-    object_measurements = {"object_id": [], "feature": [], "value": []}
-    for i in range(1, granular_spectrum_length + 1):
-        object_records = (
-            ObjectGranularityRecord(object_loader, object_index)
-            for _, object_index in enumerate(object_loader.object_ids)
-        )  # create object records for each object in the image but with a generator
+def get_granularity_features_dataframe(
+    object_measurements: dict,
+    compartment: str,
+) -> pandas.DataFrame:
+    """
+    Pivot the granularity measurements to one row per object and one column per
+    channel and spectrum step.
 
-        prevmean = currentmean
-        ero_mask = numpy.zeros_like(ero)
-        ero_mask[mask == True] = ero[mask == True]
-        ero = skimage.morphology.erosion(ero_mask, footprint=footprint)
+    Parameters
+    ----------
+    object_measurements : dict
+        The measurements returned by one of the measure_3D_granularity functions.
+    compartment : str
+        The compartment the objects were measured in.
 
-        rec = skimage.morphology.reconstruction(ero, pixels, footprint=footprint)
-        currentmean = numpy.mean(rec[mask])
-        gs = (prevmean - currentmean) * 100 / startmean
-        feature = granularity_feature(i)
-        feature_measurments[feature] = gs
-        # Restore the reconstructed image to the shape of the
-        # original image so we can match against object labels
-        orig_shape = image_object.shape
-        k, i, j = numpy.mgrid[
-            0 : orig_shape[0], 0 : orig_shape[1], 0 : orig_shape[2]
-        ].astype(float)
-        k *= float(new_shape[0] - 1) / float(orig_shape[0] - 1)
-        i *= float(new_shape[1] - 1) / float(orig_shape[1] - 1)
-        j *= float(new_shape[2] - 1) / float(orig_shape[2] - 1)
-        rec = scipy.ndimage.map_coordinates(rec, (k, i, j), order=1)
-        for object_record in object_records:
-            assert isinstance(object_record, ObjectGranularityRecord)
-            if object_record.nobjects > 0:
-                new_mean = scipy.ndimage.mean(rec, object_record.labels)
-                gss = (
-                    (object_record.current_mean - new_mean)
-                    * 100
-                    / object_record.start_mean
-                )
-                object_record.current_mean = new_mean
-            else:
-                gss = numpy.zeros((0,))
-            object_measurements["object_id"].append(object_record.object_index)
-            object_measurements["feature"].append(feature)
-            object_measurements["value"].append(gss)
-    return object_measurements
+    Returns
+    -------
+    pandas.DataFrame
+        The measurements with columns named Granularity_{compartment}_{channel}_{feature}.
+    """
+    final_df = pandas.DataFrame(object_measurements)
+    final_df = final_df.pivot(
+        index=["object_id"],
+        columns=["channel", "feature"],
+        values="value",
+    ).sort_index(axis=1)
+    final_df.columns = [
+        f"Granularity_{compartment}_{channel}_{feature}"
+        for channel, feature in final_df.columns
+    ]
+    return final_df.reset_index()
 
 
 def measure_3D_granularity_gpu(
@@ -209,6 +649,7 @@ def measure_3D_granularity_gpu(
     granular_spectrum_length: int = 16,
     subsample_size: float = 0.25,
     image_name: str = "image",
+    morphology_backend: str = "decomposed",
 ) -> dict:
     """
     This function calculates the granularity of an image using the
@@ -229,6 +670,9 @@ def measure_3D_granularity_gpu(
         The size of the image subsample, by default 0.25
     image_name : str, optional
         The name of the image, by default "image"
+    morphology_backend : str, optional
+        The backend of the erosions and dilations, "skimage" or the identical
+        but much faster "decomposed", by default "decomposed"
 
     Returns
     -------
@@ -278,39 +722,18 @@ def measure_3D_granularity_gpu(
     back_pixels_mask[back_mask == True] = back_pixels[back_mask == True]
     back_pixels_mask = cupy.asarray(back_pixels_mask)
 
-    # getting a jitify runtime error
-    # bad fix and workaround -> I do not like converting between numpy and cupy
-    # too much overhead...
-    # convert to numpy array
-    # run the skimage erosion
-    # convert back to cupy array
-    # the cucim version of skimage does not work with jitify for erosion or dilation
-    back_pixels_mask = back_pixels_mask.get()
-    footprint = footprint.get()
-    back_pixels = skimage.morphology.erosion(back_pixels_mask, footprint=footprint)
-    back_pixels_mask = cupy.asarray(back_pixels_mask)
-    back_pixels = cupy.asarray(back_pixels)
-    footprint = cupy.asarray(footprint)
-
-    # bad workaround but yet here we are with features
+    # the cucim erosion and dilation raise a jitify runtime error,
+    # the decomposed backend runs on the GPU and the skimage backend on the host
+    back_pixels = grey_morphology(
+        back_pixels_mask, footprint, operation="erosion", backend=morphology_backend
+    )
 
     back_pixels_mask = cupy.zeros_like(back_pixels)
     back_pixels_mask[back_mask == True] = back_pixels[back_mask == True]
 
-    # getting a jitify runtime error
-    # bad fix and workaround
-    # convert to numpy array
-    # run the skimage erosion
-    # convert back to cupy array
-    # the cucim version of skimage does not work with jitify for erosion or dilation
-
-    back_pixels_mask = back_pixels_mask.get()
-    footprint = footprint.get()
-    back_pixels = skimage.morphology.dilation(back_pixels_mask, footprint=footprint)
-    back_pixels_mask = cupy.asarray(back_pixels_mask)
-    back_pixels = cupy.asarray(back_pixels)
-    footprint = cupy.asarray(footprint)
-    # bad workaround but yet here we are with features
+    back_pixels = grey_morphology(
+        back_pixels_mask, footprint, operation="dilation", backend=morphology_backend
+    )
 
     k, i, j = cupy.mgrid[0 : new_shape[0], 0 : new_shape[1], 0 : new_shape[2]].astype(
         cupy.float32
@@ -337,29 +760,24 @@ def measure_3D_granularity_gpu(
     footprint = cucim.skimage.morphology.ball(1, dtype=bool)
     feature_measurments = {}
 
-    object_measurements = {"object_id": [], "feature": [], "value": []}
-    for i in tqdm.tqdm(range(1, granular_spectrum_length + 1)):
-        objects_records = (
-            ObjectGranularityRecord(object_loader=object_loader, object_index=object_id)
-            for object_id in object_loader.object_ids
+    object_measurements = {"object_id": [], "channel": [], "feature": [], "value": []}
+    # the spectrum state of every object, starting from its mean in the image
+    object_ids = numpy.asarray(object_loader.object_ids)
+    labels = cupy.asarray(object_loader.label_image)
+    object_current_means = cupy.asarray(
+        scipy.ndimage.mean(
+            object_loader.image, labels=object_loader.label_image, index=object_ids
         )
+    )
+    object_start_means = cupy.maximum(object_current_means, numpy.finfo(float).eps)
+    object_ids_gpu = cupy.asarray(object_ids)
+    for i in tqdm.tqdm(range(1, granular_spectrum_length + 1)):
         prevmean = currentmean
         ero_mask = cupy.zeros_like(ero)
         ero_mask[mask == True] = ero[mask == True]
-        # getting a jitify runtime error
-        # bad fix and workaround
-        # convert to numpy array
-        # run the skimage erosion
-        # convert back to cupy array
-        # the cucim version of skimage does not work with jitify for erosion or dilation
-
-        ero_mask = ero_mask.get()
-        footprint = footprint.get()
-        ero = skimage.morphology.erosion(ero_mask, footprint=footprint)
-        ero = cupy.asarray(ero)
-        ero_mask = cupy.asarray(ero_mask)
-        footprint = cupy.asarray(footprint)
-        # bad workaround but yet here we are with features
+        ero = grey_morphology(
+            ero_mask, footprint, operation="erosion", backend=morphology_backend
+        )
 
         rec = cucim.skimage.morphology.reconstruction(
             ero,
@@ -382,21 +800,15 @@ def measure_3D_granularity_gpu(
         j *= (new_shape[2] - 1) / (orig_shape[2] - 1)
 
         rec = cupyx.scipy.ndimage.map_coordinates(rec, cupy.stack((k, i, j)), order=1)
-        for object_record in objects_records:
-            if object_record.nobjects > 0:
-                labels = cupy.asarray(object_record.labels)
-                new_mean = cupy.mean(rec - labels)
-                gss = (
-                    (object_record.current_mean - new_mean)
-                    * 100
-                    / object_record.start_mean
-                )
-                object_record.current_mean = new_mean
-
-            else:
-                gss = cupy.zeros((0,))
-            object_measurements["object_id"].append(object_record.object_index)
-            object_measurements["feature"].append(feature)
-            object_measurements["value"].append(gss.get())
+        # the means of all objects in one labeled pass over the image
+        object_new_means = cupyx.scipy.ndimage.mean(
+            rec, labels=labels, index=object_ids_gpu
+        )
+        object_gs = (object_current_means - object_new_means) * 100 / object_start_means
+        object_current_means = object_new_means
+        object_measurements["object_id"].extend(object_loader.object_ids)
+        object_measurements["channel"].extend([object_loader.channel] * len(object_ids))
+        object_measurements["feature"].extend([feature] * len(object_ids))
+        object_measurements["value"].extend(object_gs.get())
 
     return object_measurements
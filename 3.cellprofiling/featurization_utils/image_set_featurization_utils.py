@@ -0,0 +1,910 @@
+import json
+import logging
+import pathlib
+from typing import Callable, Dict, List, Optional, Union
+
+import numpy
+import pandas
+from area_size_shape_utils import measure_3D_area_size_shape
+from area_size_shape_utils_gpu import measure_3D_area_size_shape_gpu
+from colocalization_utils import (
+    COLOCALIZATION_ENGINES,
+    get_channel_pairs,
+    measure_3D_colocalization_all_pairs,
+    measure_3D_colocalization_labeled,
+)
+from colocalization_utils_gpu import measure_3D_colocalization_all_pairs_gpu
+from errors import ProcessorTypeError
+from granularity_utils import (
+    get_granularity_features_dataframe,
+    measure_3D_granularity,
+    measure_3D_granularity_gpu,
+)
+from intensity_utils import (
+    INTENSITY_ENGINES,
+    get_intensity_features_dataframe,
+    measure_3D_intensity_CPU,
+    measure_3D_intensity_gpu,
+    measure_3D_intensity_vectorized,
+)
+from loading_classes import ImageSetLoader, ObjectLoader
+from neighbors_utils import (
+    NEIGHBORS_ENGINES,
+    measure_3D_adjacency_graph,
+    measure_3D_number_of_neighbors,
+    measure_3D_number_of_neighbors_kdtree,
+)
+from texture_utils import (
+    TEXTURE_NORMALIZATIONS,
+    get_texture_parameters,
+    measure_3D_texture_vectorized,
+)
+
+# features that are only implemented on the CPU
+CPU_ONLY_FEATURES = ["Neighbors", "Texture"]
+
+
+def load_input_combinations(
+    input_combinations_path: pathlib.Path,
+    features: List[str] = None,
+) -> List[Dict[str, str]]:
+    """
+    Load the feature, compartment, and channel combinations to run for an image set.
+
+    Parameters
+    ----------
+    input_combinations_path : pathlib.Path
+        Path to the input combinations json file.
+        Generated by get_run_combinations.
+    features : List[str], optional
+        The feature types to keep, by default None which keeps all feature types
+
+    Returns
+    -------
+    List[Dict[str, str]]
+        A list of dictionaries with the keys "feature", "compartment", and "channel".
+    """
+    with open(input_combinations_path, "r") as f:
+        input_combinations = json.load(f)
+    if features is not None:
+        input_combinations = [
+            combination
+            for combination in input_combinations
+            if combination["feature"] in features
+        ]
+    return input_combinations
+
+
+def get_output_file_name(
+    feature: str,
+    compartment: str,
+    channel: str,
+    processor_type: str,
+) -> str:
+    """
+    Get the name of the parquet file a featurization writes.
+    These match the file names of the per feature scripts so that
+    the downstream merging is agnostic to how the features were extracted.
+
+    Parameters
+    ----------
+    feature : str
+        The feature type, e.g. "Intensity"
+    compartment : str
+        The compartment, e.g. "Nuclei"
+    channel : str
+        The channel, e.g. "DNA" or "ER.AGP" for colocalization
+    processor_type : str
+        The processor type, e.g. "CPU" or "GPU"
+
+    Returns
+    -------
+    str
+        The file name of the output parquet file.
+    """
+    if feature == "AreaSizeShape":
+        return f"AreaSize_Shape_{compartment}_{processor_type}_features.parquet"
+    return f"{feature}_{compartment}_{channel}_{processor_type}_features.parquet"
+
+
+def get_adjacency_graph_file_name(compartment: str) -> str:
+    """
+    Get the name of the parquet file the adjacency graph of a compartment is written to.
+    The name contains none of the feature type names so that the downstream
+    merging of the feature files does not pick it up.
+
+    Parameters
+    ----------
+    compartment : str
+        The compartment, e.g. "Nuclei"
+
+    Returns
+    -------
+    str
+        The file name of the adjacency graph parquet file.
+    """
+    return f"Object_Adjacency_Graph_{compartment}.parquet"
+
+
+def featurize_area_size_shape(
+    image_set_loader: ImageSetLoader,
+    compartment: str,
+    channel: str,
+    processor_type: str,
+    surface_area_method: str = "marching_cubes",
+    n_processes: int = 1,
+) -> pandas.DataFrame:
+    """
+    Extract the AreaSizeShape features for a compartment.
+    The channel is only used to build the object loader as these features
+    are channel independent.
+
+    Parameters
+    ----------
+    image_set_loader : ImageSetLoader
+        The image set loader containing the loaded image set.
+    compartment : str
+        The compartment to featurize.
+    channel : str
+        The channel to featurize.
+    processor_type : str
+        The processor type, "CPU" or "GPU".
+    surface_area_method : str, optional
+        The CPU surface area method, "marching_cubes" or "voxel_faces",
+        by default "marching_cubes"
+    n_processes : int, optional
+        The number of processes to calculate CPU surface areas with, by default 1
+
+    Returns
+    -------
+    pandas.DataFrame
+        The featurized objects.
+    """
+    object_loader = ObjectLoader(
+        image_set_loader.image_set_dict[channel],
+        image_set_loader.image_set_dict[compartment],
+        channel,
+        compartment,
+        image_set_loader.get_object_index(compartment),
+    )
+    if processor_type == "GPU":
+        size_shape_dict = measure_3D_area_size_shape_gpu(
+            image_set_loader=image_set_loader,
+            object_loader=object_loader,
+        )
+    else:
+        size_shape_dict = measure_3D_area_size_shape(
+            image_set_loader=image_set_loader,
+            object_loader=object_loader,
+            single_pass=True,
+            surface_area_method=surface_area_method,
+            n_processes=n_processes,
+        )
+    final_df = pandas.DataFrame(size_shape_dict)
+    final_df.columns = [
+        col if col == "object_id" else f"Area.Size.Shape_{compartment}_{col}"
+        for col in final_df.columns
+    ]
+    final_df.insert(1, "image_set", image_set_loader.image_set_name)
+    return final_df
+
+
+def featurize_intensity(
+    image_set_loader: ImageSetLoader,
+    compartment: str,
+    channel: str,
+    processor_type: str,
+    engine: str = "standard",
+    quantile_method: str = "exact",
+) -> pandas.DataFrame:
+    """
+    Extract the Intensity features for a compartment and one or more channels.
+    Several channels are given separated by ".", e.g. "DNA.AGP.ER",
+    and are measured together so the compartment object index is shared.
+
+    Parameters
+    ----------
+    image_set_loader : ImageSetLoader
+        The image set loader containing the loaded image set.
+    compartment : str
+        The compartment to featurize.
+    channel : str
+        The channel to featurize, or several channels separated by ".".
+    processor_type : str
+        The processor type, "CPU" or "GPU".
+    engine : str, optional
+        "standard" measures each channel with measure_3D_intensity_CPU or
+        measure_3D_intensity_gpu, "vectorized" measures every statistic over the
+        voxels of each object with labeled reductions over all objects at once
+        and only runs on the CPU, by default "standard".
+        The features of the vectorized engine are named with a "_Vectorized"
+        suffix as they are different measurements than the standard features.
+    quantile_method : str, optional
+        How the quartiles and median of the vectorized engine are calculated,
+        "exact" or "histogram", by default "exact"
+
+    Returns
+    -------
+    pandas.DataFrame
+        The featurized objects with one column per channel and measurement.
+    """
+    if engine not in INTENSITY_ENGINES:
+        raise ValueError(
+            f"Intensity engine {engine} is not supported. "
+            f"Use one of {INTENSITY_ENGINES}."
+        )
+    channels = channel.split(".")
+    object_loaders = [
+        ObjectLoader(
+            image_set_loader.image_set_dict[object_channel],
+            image_set_loader.image_set_dict[compartment],
+            object_channel,
+            compartment,
+            image_set_loader.get_object_index(compartment),
+        )
+        for object_channel in channels
+    ]
+    if engine == "vectorized":
+        if processor_type == "GPU":
+            raise ValueError("The vectorized Intensity engine only runs on the CPU.")
+        output_dict = measure_3D_intensity_vectorized(
+            object_loaders[0],
+            quantile_method=quantile_method,
+            channel_images={
+                cpu_channel: image_set_loader.image_set_dict[cpu_channel]
+                for cpu_channel in channels
+            },
+        )
+    else:
+        # the standard engine measures one channel at a time
+        measure_3D_intensity = (
+            measure_3D_intensity_gpu
+            if processor_type == "GPU"
+            else measure_3D_intensity_CPU
+        )
+        output_dict = {}
+        for object_loader in object_loaders:
+            for key, values in measure_3D_intensity(object_loader).items():
+                output_dict.setdefault(key, []).extend(values)
+    final_df = get_intensity_features_dataframe(output_dict, compartment=compartment)
+    if engine == "vectorized":
+        final_df.columns = ["object_id"] + [
+            f"{feature}_Vectorized" for feature in final_df.columns[1:]
+        ]
+    final_df.insert(0, "image_set", image_set_loader.image_set_name)
+    return final_df
+
+
+def featurize_granularity(
+    image_set_loader: ImageSetLoader,
+    compartment: str,
+    channel: str,
+    processor_type: str,
+    morphology_backend: str = "decomposed",
+    crop_mode: Optional[str] = None,
+    n_processes: int = 1,
+) -> pandas.DataFrame:
+    """
+    Extract the Granularity features for a compartment and one or more channels.
+    Several channels are given separated by ".", e.g. "DNA.AGP.ER",
+    and are measured together so the downsampled compartment mask is shared.
+    On the CPU the objects can be measured in crops instead of the whole image,
+    either each object on its own or the objects of each organoid together.
+
+    Parameters
+    ----------
+    image_set_loader : ImageSetLoader
+        The image set loader containing the loaded image set.
+    compartment : str
+        The compartment to featurize.
+    channel : str
+        The channel to featurize, or several channels separated by ".".
+    processor_type : str
+        The processor type, "CPU" or "GPU".
+    morphology_backend : str, optional
+        The backend of the erosions and dilations, "skimage" or "decomposed",
+        by default "decomposed"
+    crop_mode : Optional[str], optional
+        None to measure the whole image, "object" to measure each object in its
+        own crop or "region" to measure the objects of each organoid in the crop
+        of the organoid, by default None
+    n_processes : int, optional
+        The number of processes measuring the crops, by default 1
+
+    Returns
+    -------
+    pandas.DataFrame
+        The featurized objects with one column per channel and measurement.
+    """
+    channels = channel.split(".")
+    object_loaders = [
+        ObjectLoader(
+            image_set_loader.image_set_dict[object_channel],
+            image_set_loader.image_set_dict[compartment],
+            object_channel,
+            compartment,
+            image_set_loader.get_object_index(compartment),
+        )
+        for object_channel in channels
+    ]
+    if processor_type == "GPU":
+        # the GPU path measures one channel at a time
+        object_measurements = {}
+        for object_loader in object_loaders:
+            for key, values in measure_3D_granularity_gpu(
+                object_loader=object_loader,
+                image_set_loader=image_set_loader,
+                radius=10,
+                granular_spectrum_length=16,
+                subsample_size=0.25,
+                image_name=object_loader.channel,
+                morphology_backend=morphology_backend,
+            ).items():
+                object_measurements.setdefault(key, []).extend(values)
+    else:
+        object_measurements = measure_3D_granularity(
+            object_loader=object_loaders[0],
+            radius=10,
+            granular_spectrum_length=16,
+            subsample_size=0.25,
+            image_name=channel,
+            morphology_backend=morphology_backend,
+            channel_images={
+                cpu_channel: image_set_loader.image_set_dict[cpu_channel]
+                for cpu_channel in channels
+            },
+            crop_mode=crop_mode,
+            region_label_image=(
+                image_set_loader.image_set_dict["Organoid"]
+                if crop_mode == "region"
+                else None
+            ),
+            n_processes=n_processes,
+        )
+    final_df = get_granularity_features_dataframe(
+        object_measurements, compartment=compartment
+    )
+    final_df.insert(0, "image_set", image_set_loader.image_set_name)
+    return final_df
+
+
+def featurize_texture(
+    image_set_loader: ImageSetLoader,
+    compartment: str,
+    channel: str,
+    processor_type: str,
+    n_processes: int = 1,
+    distances: Union[int, List[int]] = 3,
+    gray_levels: Union[int, List[int]] = 256,
+    normalization: str = "object",
+) -> pandas.DataFrame:
+    """
+    Extract the Texture features for a compartment and channel.
+    Texture is only implemented on the CPU.
+
+    Parameters
+    ----------
+    image_set_loader : ImageSetLoader
+        The image set loader containing the loaded image set.
+    compartment : str
+        The compartment to featurize.
+    channel : str
+        The channel to featurize.
+    processor_type : str
+        The processor type, only "CPU" is supported.
+    n_processes : int, optional
+        The number of processes to derive the features of the objects with, by default 1
+    distances : Union[int, List[int]], optional
+        The distance or distances in pixels to measure, by default 3 which is what CP uses
+    gray_levels : Union[int, List[int]], optional
+        The number or numbers of gray levels to measure, by default 256
+    normalization : str, optional
+        How the gray levels are scaled, by default "object".
+        "object" scales each object from 0 to its maximum.
+        "global" scales the whole channel image from its minimum to its maximum,
+        which is quantized once and reused by every compartment.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The featurized objects.
+    """
+    if normalization not in TEXTURE_NORMALIZATIONS:
+        raise ValueError(
+            f"Texture normalization {normalization} is not supported. "
+            f"Use one of {TEXTURE_NORMALIZATIONS}."
+        )
+    object_loader = ObjectLoader(
+        image_set_loader.image_set_dict[channel],
+        image_set_loader.image_set_dict[compartment],
+        channel,
+        compartment,
+        image_set_loader.get_object_index(compartment),
+    )
+    quantized_images = None
+    if normalization == "global":
+        _, gray_levels = get_texture_parameters(distances, gray_levels)
+        quantized_images = {
+            grayscale: image_set_loader.get_quantized_image(channel, grayscale)
+            for grayscale in gray_levels
+        }
+    output_texture_dict = measure_3D_texture_vectorized(
+        object_loader=object_loader,
+        distance=distances,
+        grayscale=gray_levels,
+        n_processes=n_processes,
+        quantized_images=quantized_images,
+    )
+    final_df = pandas.DataFrame(output_texture_dict)
+    final_df = final_df.pivot(
+        index="object_id",
+        columns="texture_name",
+        values="texture_value",
+    )
+    final_df.reset_index(inplace=True)
+    final_df.columns = [
+        col if col == "object_id" else f"Texture_{compartment}_{channel}_{col}"
+        for col in final_df.columns
+    ]
+    final_df.insert(0, "image_set", image_set_loader.image_set_name)
+    final_df.columns.name = None
+    return final_df
+
+
+def featurize_neighbors(
+    image_set_loader: ImageSetLoader,
+    compartment: str,
+    channel: str,
+    processor_type: str,
+    distance_thresholds: Union[int, List[int]] = 10,
+    engine: str = "kdtree",
+) -> pandas.DataFrame:
+    """
+    Extract the Neighbors features for a compartment.
+    Neighbors is only implemented on the CPU.
+
+    Parameters
+    ----------
+    image_set_loader : ImageSetLoader
+        The image set loader containing the loaded image set.
+    compartment : str
+        The compartment to featurize.
+    channel : str
+        The channel to featurize.
+    processor_type : str
+        The processor type, only "CPU" is supported.
+    distance_thresholds : Union[int, List[int]], optional
+        The distance threshold or thresholds for counting neighbors, by default 10
+    engine : str, optional
+        The neighbors engine, by default "kdtree" which counts the neighbors of all
+        objects at once, while "crop" counts the labels in the crop of each object.
+        Both give the same counts.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The featurized objects.
+    """
+    if engine not in NEIGHBORS_ENGINES:
+        raise ValueError(
+            f"Neighbors engine {engine} is not supported. "
+            f"Use one of {NEIGHBORS_ENGINES}."
+        )
+    distance_thresholds = (
+        [distance_thresholds]
+        if numpy.isscalar(distance_thresholds)
+        else list(distance_thresholds)
+    )
+    object_index = image_set_loader.get_object_index(compartment)
+    if engine == "kdtree":
+        neighbors_out_dict = measure_3D_number_of_neighbors_kdtree(
+            object_index=object_index,
+            distance_thresholds=distance_thresholds,
+            anisotropy_factor=image_set_loader.anisotropy_factor,
+        )
+    else:
+        object_loader = ObjectLoader(
+            image_set_loader.image_set_dict[channel],
+            image_set_loader.image_set_dict[compartment],
+            channel,
+            compartment,
+            object_index,
+        )
+        neighbors_out_dict = {}
+        for distance_threshold in distance_thresholds:
+            neighbors_out_dict.update(
+                measure_3D_number_of_neighbors(
+                    object_loader=object_loader,
+                    distance_threshold=distance_threshold,
+                    anisotropy_factor=image_set_loader.anisotropy_factor,
+                )
+            )
+    final_df = pandas.DataFrame(neighbors_out_dict)
+    if not final_df.empty:
+        final_df.insert(0, "image_set", image_set_loader.image_set_name)
+    return final_df
+
+
+def featurize_adjacency_graph(
+    image_set_loader: ImageSetLoader,
+    compartment: str,
+) -> pandas.DataFrame:
+    """
+    Build the edge list of the objects that touch in a compartment.
+
+    Parameters
+    ----------
+    image_set_loader : ImageSetLoader
+        The image set loader containing the loaded image set.
+    compartment : str
+        The compartment to build the graph of.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per pair of touching objects with the columns image_set,
+        object_a, object_b, and shared_surface_voxels.
+    """
+    final_df = pandas.DataFrame(
+        measure_3D_adjacency_graph(image_set_loader.image_set_dict[compartment])
+    )
+    final_df.insert(0, "image_set", image_set_loader.image_set_name)
+    return final_df
+
+
+def featurize_colocalization(
+    image_set_loader: ImageSetLoader,
+    compartment: str,
+    channel: str,
+    processor_type: str,
+    engine: str = "crop",
+    n_processes: int = 1,
+) -> pandas.DataFrame:
+    """
+    Extract the Colocalization features for a compartment and a channel pair,
+    or for every pair of several channels.
+    Each channel is cropped once per object and shared by all of its pairs.
+
+    Parameters
+    ----------
+    image_set_loader : ImageSetLoader
+        The image set loader containing the loaded image set.
+    compartment : str
+        The compartment to featurize.
+    channel : str
+        The channel pair to featurize, e.g. "ER.AGP",
+        or more channels to featurize every pair of, e.g. "DNA.AGP.ER"
+    processor_type : str
+        The processor type, "CPU" or "GPU".
+    engine : str, optional
+        "crop" measures the bounding box crop of each object,
+        "labeled" measures the voxels of each object with labeled reductions
+        over all objects at once and only runs on the CPU, by default "crop".
+        The features of the labeled engine are named with a "_Labeled" suffix
+        as they are different measurements than the crop features.
+    n_processes : int, optional
+        The number of processes measuring the objects with the crop engine
+        on the CPU, by default 1
+
+    Returns
+    -------
+    pandas.DataFrame
+        The featurized objects with one column per channel pair and measurement.
+    """
+    if engine not in COLOCALIZATION_ENGINES:
+        raise ValueError(
+            f"Colocalization engine {engine} is not supported. "
+            f"Use one of {COLOCALIZATION_ENGINES}."
+        )
+    channels = channel.split(".")
+    channel_pairs = get_channel_pairs(channels)
+    object_index = image_set_loader.get_object_index(compartment)
+    if len(object_index.object_ids) == 0:
+        return pandas.DataFrame()
+    measure_kwargs = {
+        "object_index": object_index,
+        "channel_images": {
+            pair_channel: image_set_loader.image_set_dict[pair_channel]
+            for pair_channel in channels
+        },
+        "channel_pairs": channel_pairs,
+        "thr": 15,
+        "fast_costes": "Accurate",
+    }
+    if engine == "labeled":
+        if processor_type == "GPU":
+            raise ValueError("The labeled Colocalization engine only runs on the CPU.")
+        columns = measure_3D_colocalization_labeled(**measure_kwargs)
+    elif processor_type == "GPU":
+        columns = measure_3D_colocalization_all_pairs_gpu(**measure_kwargs)
+    else:
+        columns = measure_3D_colocalization_all_pairs(
+            **measure_kwargs, n_processes=n_processes
+        )
+    final_df = pandas.DataFrame(columns)
+    engine_suffix = "_Labeled" if engine == "labeled" else ""
+    final_df.columns = ["object_id"] + [
+        f"Colocalization_{compartment}_{feature}{engine_suffix}"
+        for feature in final_df.columns[1:]
+    ]
+    final_df.insert(1, "image_set", image_set_loader.image_set_name)
+    return final_df
+
+
+def get_output_channels(feature: str, channel: str) -> List[str]:
+    """
+    Get the channels of a combination that are written to separate files,
+    the channel pairs for Colocalization and the channels for other features.
+
+    Parameters
+    ----------
+    feature : str
+        The feature of the combination.
+    channel : str
+        The channels of the combination separated by ".".
+
+    Returns
+    -------
+    List[str]
+        The output channels, e.g. ["DNA.AGP", "DNA.ER", "AGP.ER"] for
+        Colocalization of "DNA.AGP.ER".
+    """
+    channels = channel.split(".")
+    if feature == "Colocalization":
+        return [
+            f"{channel1}.{channel2}"
+            for channel1, channel2 in get_channel_pairs(channels)
+        ]
+    return channels
+
+
+def get_images_for_combination(combination: Dict[str, str]) -> List[str]:
+    """
+    Get the channel and compartment images a featurization combination reads.
+
+    Parameters
+    ----------
+    combination : Dict[str, str]
+        A dictionary with the keys "feature", "compartment", and "channel".
+
+    Returns
+    -------
+    List[str]
+        The names of the images read by the combination.
+    """
+    return [combination["compartment"]] + combination["channel"].split(".")
+
+
+def batch_combination_channels(
+    input_combinations: List[Dict[str, str]],
+    feature: str,
+) -> List[Dict[str, str]]:
+    """
+    Merge the combinations of a feature that share a compartment into a single
+    combination whose channels are separated by ".".
+
+    Parameters
+    ----------
+    input_combinations : List[Dict[str, str]]
+        A list of dictionaries with the keys "feature", "compartment", and "channel".
+    feature : str
+        The feature to batch the channels of.
+
+    Returns
+    -------
+    List[Dict[str, str]]
+        The combinations with one combination per compartment for the feature.
+    """
+    batched_channels = {}
+    other_combinations = []
+    for combination in input_combinations:
+        if combination["feature"] != feature:
+            other_combinations.append(combination)
+            continue
+        batched_channels.setdefault(combination["compartment"], []).extend(
+            combination["channel"].split(".")
+        )
+    return other_combinations + [
+        {
+            "feature": feature,
+            "compartment": compartment,
+            "channel": ".".join(dict.fromkeys(channels)),
+        }
+        for compartment, channels in batched_channels.items()
+    ]
+
+
+def split_features_by_channel(
+    final_df: pandas.DataFrame,
+    feature_prefix: str,
+    compartment: str,
+    channels: List[str],
+) -> Dict[str, pandas.DataFrame]:
+    """
+    Split a wide feature table of several channels into one table per channel.
+
+    Parameters
+    ----------
+    final_df : pandas.DataFrame
+        The featurized objects with columns named {feature_prefix}_{compartment}_{channel}_{measurement}.
+    feature_prefix : str
+        The prefix of the feature columns, e.g. "Intensity".
+    compartment : str
+        The compartment of the features.
+    channels : List[str]
+        The channels to split out.
+
+    Returns
+    -------
+    Dict[str, pandas.DataFrame]
+        A dictionary mapping each channel to its features.
+    """
+    index_columns = [
+        col for col in final_df.columns if col in ["image_set", "object_id"]
+    ]
+    return {
+        channel: final_df[
+            index_columns
+            + [
+                col
+                for col in final_df.columns
+                if col.startswith(f"{feature_prefix}_{compartment}_{channel}_")
+            ]
+        ]
+        for channel in channels
+    }
+
+
+FEATURIZERS: Dict[str, Callable[..., pandas.DataFrame]] = {
+    "AreaSizeShape": featurize_area_size_shape,
+    "Colocalization": featurize_colocalization,
+    "Granularity": featurize_granularity,
+    "Intensity": featurize_intensity,
+    "Neighbors": featurize_neighbors,
+    "Texture": featurize_texture,
+}
+
+
+def featurize_image_set(
+    image_set_loader: ImageSetLoader,
+    input_combinations: List[Dict[str, str]],
+    processor_type: str,
+    output_parent_path: pathlib.Path,
+    featurizer_kwargs: Optional[Dict[str, dict]] = None,
+    intensity_output: Optional[str] = None,
+    granularity_output: Optional[str] = None,
+    colocalization_output: Optional[str] = None,
+    adjacency_graph: bool = False,
+) -> List[pathlib.Path]:
+    """
+    Run every feature, compartment, and channel combination on an image set
+    that has already been loaded.
+    Each combination is written to the same parquet file the per feature
+    scripts write to.
+    When the image set is lazily loaded the combinations are run grouped by channel
+    and each image is released once no remaining combination reads it.
+
+    Parameters
+    ----------
+    image_set_loader : ImageSetLoader
+        The image set loader containing the loaded image set.
+    input_combinations : List[Dict[str, str]]
+        A list of dictionaries with the keys "feature", "compartment", and "channel".
+    processor_type : str
+        The processor type, "CPU" or "GPU".
+        Features only implemented on the CPU always run on the CPU.
+    output_parent_path : pathlib.Path
+        The directory to write the parquet files to.
+    featurizer_kwargs : Optional[Dict[str, dict]], optional
+        Extra keyword arguments passed to the featurizer of each feature type,
+        e.g. {"AreaSizeShape": {"n_processes": 4}}, by default None
+    intensity_output : Optional[str], optional
+        How the Intensity channels of a compartment are run, by default None
+        which runs each channel as its own combination.
+        "per_channel" measures all channels of a compartment together and
+        writes the existing per channel files.
+        "wide" measures all channels of a compartment together and
+        writes a single wide file per compartment.
+    granularity_output : Optional[str], optional
+        How the Granularity channels of a compartment are run, by default None,
+        with the same options as intensity_output.
+    colocalization_output : Optional[str], optional
+        How the Colocalization channel pairs of a compartment are run,
+        by default None, with the same options as intensity_output.
+        Every pair of the channels of the compartment is measured
+        from crops shared by all pairs.
+    adjacency_graph : bool, optional
+        Whether to also write the graph of the touching objects of each
+        compartment with Neighbors features, by default False
+
+    Returns
+    -------
+    List[pathlib.Path]
+        The paths of the parquet files written.
+    """
+    if processor_type not in ["CPU", "GPU"]:
+        raise ProcessorTypeError()
+    output_parent_path.mkdir(parents=True, exist_ok=True)
+    if featurizer_kwargs is None:
+        featurizer_kwargs = {}
+    channel_outputs = {
+        "Intensity": intensity_output,
+        "Granularity": granularity_output,
+        "Colocalization": colocalization_output,
+    }
+    for feature, channel_output in channel_outputs.items():
+        if channel_output is None:
+            continue
+        if channel_output not in ["per_channel", "wide"]:
+            raise ValueError(
+                f"{feature} output {channel_output} is not supported. "
+                "Use 'per_channel' or 'wide'."
+            )
+        input_combinations = batch_combination_channels(
+            input_combinations, feature=feature
+        )
+    if image_set_loader.lazy:
+        # group the combinations by channel so each channel is read once
+        input_combinations = sorted(
+            input_combinations, key=lambda combination: combination["channel"]
+        )
+    output_files = []
+    for index, combination in enumerate(input_combinations):
+        feature = combination["feature"]
+        compartment = combination["compartment"]
+        channel = combination["channel"]
+        if feature not in FEATURIZERS:
+            raise ValueError(
+                f"Feature {feature} is not supported. "
+                f"Use one of {list(FEATURIZERS.keys())}."
+            )
+        combination_processor_type = (
+            "CPU" if feature in CPU_ONLY_FEATURES else processor_type
+        )
+        logging.info(
+            f"Featurizing {feature} for {compartment} {channel} "
+            f"on {combination_processor_type}"
+        )
+        final_df = FEATURIZERS[feature](
+            image_set_loader=image_set_loader,
+            compartment=compartment,
+            channel=channel,
+            processor_type=combination_processor_type,
+            **featurizer_kwargs.get(feature, {}),
+        )
+        output_dfs = {channel: final_df}
+        if channel_outputs.get(feature) == "per_channel":
+            output_dfs = split_features_by_channel(
+                final_df,
+                feature_prefix=feature,
+                compartment=compartment,
+                channels=get_output_channels(feature, channel),
+            )
+        for output_channel, output_df in output_dfs.items():
+            output_file = output_parent_path / get_output_file_name(
+                feature=feature,
+                compartment=compartment,
+                channel=output_channel,
+                processor_type=combination_processor_type,
+            )
+            output_df.to_parquet(output_file)
+            output_files.append(output_file)
+        if adjacency_graph and feature == "Neighbors":
+            output_file = output_parent_path / get_adjacency_graph_file_name(
+                compartment
+            )
+            if output_file not in output_files:
+                featurize_adjacency_graph(
+                    image_set_loader=image_set_loader, compartment=compartment
+                ).to_parquet(output_file)
+                output_files.append(output_file)
+
+        remaining_images = {
+            image
+            for remaining_combination in input_combinations[index + 1 :]
+            for image in get_images_for_combination(remaining_combination)
+        }
+        for image in get_images_for_combination(combination):
+            if image not in remaining_images:
+                image_set_loader.release_image(image)
+    return output_files
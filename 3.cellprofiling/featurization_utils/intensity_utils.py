@@ -1,12 +1,17 @@
+from typing import Callable, Dict, Optional
+
 import cucim.skimage.measure
 import cupy
 import cupyx
 import cupyx.scipy.ndimage
 import numpy
+import pandas
 import scipy.ndimage
 import skimage.segmentation
 from loading_classes import ObjectLoader
 
+INTENSITY_ENGINES = ["standard", "vectorized"]
+
 
 def get_outline(mask: numpy.ndarray) -> numpy.ndarray:
     """
@@ -57,55 +62,52 @@ def measure_3D_intensity_CPU(
         "compartment": [],
         "value": [],
     }
+    # measurements that do not depend on the object are calculated once
+    non_zero_pixels_object = image_object[image_object > 0]
+    # calculate the standard deviation
+    std_intensity = numpy.std(non_zero_pixels_object)
+    # min intensity
+    min_intensity = numpy.min(non_zero_pixels_object)
+    # max intensity
+    max_intensity = numpy.max(non_zero_pixels_object)
+    # lower quartile
+    lower_quartile_intensity = numpy.percentile(non_zero_pixels_object, 25)
+    # upper quartile
+    upper_quartile_intensity = numpy.percentile(non_zero_pixels_object, 75)
+    # median intensity
+    median_intensity = numpy.median(non_zero_pixels_object)
+    # max intensity location
+    max_z, max_y, max_x = scipy.ndimage.maximum_position(
+        image_object,
+    )  # z, y, x
+    # sums and means of the voxel coordinate grid of the image
+    # each coordinate along an axis is repeated once per voxel in the other axes
+    i_z, i_y, i_x = (
+        numpy.int64(image_object.size // length * (length * (length - 1) // 2))
+        for length in image_object.shape
+    )
+    cm_x = i_x / numpy.float64(image_object.size)
+    cm_y = i_y / numpy.float64(image_object.size)
+    cm_z = i_z / numpy.float64(image_object.size)
+    # the outlines of all objects are found in a single pass over the compartment
+    edge_offsets, edge_indices = object_loader.object_index.get_edge_voxels(
+        label_object
+    )
     for index, label in enumerate(labels):
-        selected_label_object = label_object.copy()
-        selected_image_object = image_object.copy()
-
-        selected_label_object[selected_label_object != label] = 0
-        # selected_image_object[selected_label_object == 0] = 0
-        non_zero_pixels_object = selected_image_object[selected_image_object > 0]
-
-        mask_outlines = get_outline(selected_label_object)
-        mesh_z, mesh_y, mesh_x = numpy.mgrid[
-            0 : selected_image_object.shape[0],
-            0 : selected_image_object.shape[1],
-            0 : selected_image_object.shape[2],
+        voxel_indices = object_loader.object_index.get_voxel_indices(label)
+        edge_values = image_object.ravel()[
+            edge_indices[edge_offsets[index] : edge_offsets[index + 1]]
         ]
 
-        ranges = len(numpy.unique(selected_label_object))
-
         # calculate the integrated intensity
         integrated_intensity = scipy.ndimage.sum(
-            selected_image_object,
-            selected_label_object,
+            image_object.ravel()[voxel_indices],
         )
         # calculate the volume
-        volume = numpy.sum(selected_label_object)
+        volume = numpy.sum(label_object.ravel()[voxel_indices])
 
         # calculate the mean intensity
         mean_intensity = integrated_intensity / volume
-        # calculate the standard deviation
-        std_intensity = numpy.std(non_zero_pixels_object)
-        # min intensity
-        min_intensity = numpy.min(non_zero_pixels_object)
-        # max intensity
-        max_intensity = numpy.max(non_zero_pixels_object)
-        # lower quartile
-        lower_quartile_intensity = numpy.percentile(non_zero_pixels_object, 25)
-        # upper quartile
-        upper_quartile_intensity = numpy.percentile(non_zero_pixels_object, 75)
-        # median intensity
-        median_intensity = numpy.median(non_zero_pixels_object)
-        # max intensity location
-        max_z, max_y, max_x = scipy.ndimage.maximum_position(
-            image_object,
-        )  # z, y, x
-        cm_x = scipy.ndimage.mean(mesh_x)
-        cm_y = scipy.ndimage.mean(mesh_y)
-        cm_z = scipy.ndimage.mean(mesh_z)
-        i_x = scipy.ndimage.sum(mesh_x)
-        i_y = scipy.ndimage.sum(mesh_y)
-        i_z = scipy.ndimage.sum(mesh_z)
         # calculate the center of mass
         cmi_x = i_x / integrated_intensity
         cmi_y = i_y / integrated_intensity
@@ -118,12 +120,12 @@ def measure_3D_intensity_CPU(
         mass_displacement = numpy.sqrt(diff_x**2 + diff_y**2 + diff_z**2)
         # mean aboslute deviation
         mad_intensity = numpy.mean(numpy.abs(non_zero_pixels_object - mean_intensity))
-        edge_count = scipy.ndimage.sum(mask_outlines)
-        integrated_intensity_edge = numpy.sum(image_object[mask_outlines > 0])
+        edge_count = numpy.uint64(edge_values.size)
+        integrated_intensity_edge = numpy.sum(edge_values)
         mean_intensity_edge = integrated_intensity_edge / edge_count
-        std_intensity_edge = numpy.std(image_object[mask_outlines > 0])
-        min_intensity_edge = numpy.min(image_object[mask_outlines > 0])
-        max_intensity_edge = numpy.max(image_object[mask_outlines > 0])
+        std_intensity_edge = numpy.std(edge_values)
+        min_intensity_edge = numpy.min(edge_values)
+        max_intensity_edge = numpy.max(edge_values)
         measurements_dict = {
             "INTEGRATED.INTENSITY": integrated_intensity,
             "VOLUME": volume,
@@ -170,6 +172,406 @@ def measure_3D_intensity_CPU(
     return output_dict
 
 
+def get_segment_first_position(
+    is_selected: numpy.ndarray,
+    voxel_offsets: numpy.ndarray,
+) -> numpy.ndarray:
+    """
+    Get the position of the first selected voxel of each object segment.
+
+    Parameters
+    ----------
+    is_selected : numpy.ndarray
+        A boolean array over the voxels of all objects grouped by object.
+    voxel_offsets : numpy.ndarray
+        The start of each object segment with one extra trailing entry.
+
+    Returns
+    -------
+    numpy.ndarray
+        The position of the first selected voxel in each segment.
+        Segments without a selected voxel get the position of their end.
+    """
+    positions = numpy.where(
+        is_selected, numpy.arange(len(is_selected)), voxel_offsets[-1]
+    )
+    return numpy.minimum.reduceat(positions, voxel_offsets[:-1])
+
+
+def interpolate_ranks(
+    voxel_offsets: numpy.ndarray,
+    quantiles: numpy.ndarray,
+    get_rank_values: Callable[[numpy.ndarray, numpy.ndarray], numpy.ndarray],
+) -> numpy.ndarray:
+    """
+    Linearly interpolate quantiles between the neighboring ranks of each segment
+    the same way as numpy.percentile with the default linear method.
+
+    Parameters
+    ----------
+    voxel_offsets : numpy.ndarray
+        The start of each segment with one extra trailing entry.
+    quantiles : numpy.ndarray
+        The quantiles to calculate in the range [0, 1].
+    get_rank_values : Callable[[numpy.ndarray, numpy.ndarray], numpy.ndarray]
+        A function that takes the segment positions and the ranks within the segments
+        and returns the value of each rank.
+
+    Returns
+    -------
+    numpy.ndarray
+        An array of shape (segments, quantiles).
+    """
+    counts = numpy.diff(voxel_offsets)
+    positions = numpy.repeat(numpy.arange(len(counts)), len(quantiles))
+    ranks = numpy.tile(quantiles, len(counts)) * (counts[positions] - 1)
+    lower_ranks = numpy.floor(ranks).astype(numpy.int64)
+    upper_ranks = numpy.minimum(lower_ranks + 1, counts[positions] - 1)
+    fractions = ranks - lower_ranks
+    lower_values = get_rank_values(positions, lower_ranks)
+    upper_values = get_rank_values(positions, upper_ranks)
+    # matches the interpolation of numpy.percentile
+    differences = upper_values - lower_values
+    interpolated = lower_values + differences * fractions
+    upper_interpolated = upper_values - differences * (1 - fractions)
+    interpolated = numpy.where(fractions >= 0.5, upper_interpolated, interpolated)
+    return interpolated.reshape(len(counts), len(quantiles))
+
+
+def get_grouped_quantiles(
+    values: numpy.ndarray,
+    voxel_offsets: numpy.ndarray,
+    quantiles: list,
+    method: str = "exact",
+    n_bins: int = 1024,
+) -> numpy.ndarray:
+    """
+    Calculate quantiles of every object at once from the values of all objects
+    grouped by object.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The values of all objects grouped by object.
+    voxel_offsets : numpy.ndarray
+        The start of each object segment with one extra trailing entry.
+    quantiles : list
+        The quantiles to calculate in the range [0, 1].
+    method : str, optional
+        How the quantiles are calculated, by default "exact".
+        "exact" sorts the values once by (object, value) and reads the quantiles
+        at the segment offsets, matching numpy.percentile.
+        "histogram" builds a per object histogram of integer values without sorting
+        and interpolates the ranks within the bins. It is exact when the value range
+        fits in n_bins and otherwise approximate.
+    n_bins : int, optional
+        The number of histogram bins used by the "histogram" method, by default 1024
+
+    Returns
+    -------
+    numpy.ndarray
+        An array of shape (objects, quantiles).
+    """
+    quantiles = numpy.asarray(quantiles, dtype=numpy.float64)
+    counts = numpy.diff(voxel_offsets)
+    segment_ids = numpy.repeat(numpy.arange(len(counts)), counts)
+    if method == "exact":
+        sorted_values = values[numpy.lexsort((values, segment_ids))]
+
+        def get_rank_values(positions, ranks):
+            return sorted_values[voxel_offsets[positions] + ranks].astype(numpy.float64)
+
+    elif method == "histogram":
+        if not numpy.issubdtype(values.dtype, numpy.integer):
+            raise ValueError(
+                f"The histogram quantile method needs integer values, not {values.dtype}."
+            )
+        if len(values) == 0:
+            return numpy.zeros((0, len(quantiles)))
+        min_value = int(values.min())
+        bin_width = -(-(int(values.max()) - min_value + 1) // n_bins)
+        bins = (values - min_value) // bin_width
+        histogram = numpy.bincount(
+            segment_ids * n_bins + bins, minlength=len(counts) * n_bins
+        ).reshape(len(counts), n_bins)
+        cumulative_counts = numpy.cumsum(histogram, axis=1)
+        # offset each row so that one searchsorted finds the bins of all objects
+        row_offsets = numpy.arange(len(counts)) * (counts.max() + 1)
+        flat_cumulative_counts = (cumulative_counts + row_offsets[:, None]).ravel()
+
+        def get_rank_values(positions, ranks):
+            flat_bins = numpy.searchsorted(
+                flat_cumulative_counts, row_offsets[positions] + ranks + 1
+            )
+            rank_bins = flat_bins - positions * n_bins
+            count_before = (
+                cumulative_counts[positions, rank_bins]
+                - histogram[positions, rank_bins]
+            )
+            # spread the values of a bin uniformly over its width
+            within_bin = (ranks - count_before + 0.5) / histogram[positions, rank_bins]
+            return min_value + bin_width * rank_bins + (bin_width - 1) * within_bin
+
+    else:
+        raise ValueError(
+            f"Quantile method {method} is not supported. Use 'exact' or 'histogram'."
+        )
+    return interpolate_ranks(
+        voxel_offsets=voxel_offsets,
+        quantiles=quantiles,
+        get_rank_values=get_rank_values,
+    )
+
+
+def segment_reduce(
+    ufunc: numpy.ufunc,
+    values: numpy.ndarray,
+    offsets: numpy.ndarray,
+    empty_value: float = numpy.nan,
+) -> numpy.ndarray:
+    """
+    Reduce each segment of an array that is grouped by object, allowing empty segments.
+
+    Parameters
+    ----------
+    ufunc : numpy.ufunc
+        The reduction, e.g. numpy.add, numpy.minimum or numpy.maximum.
+    values : numpy.ndarray
+        The values of all segments.
+    offsets : numpy.ndarray
+        The start of each segment with one extra trailing entry.
+    empty_value : float, optional
+        The result of the empty segments, by default numpy.nan
+
+    Returns
+    -------
+    numpy.ndarray
+        The reduction of each segment.
+    """
+    counts = numpy.diff(offsets)
+    reduced = numpy.full(len(counts), empty_value, dtype=numpy.float64)
+    # reduceat reads up to the next start so empty segments are skipped
+    is_filled = counts > 0
+    if numpy.any(is_filled):
+        reduced[is_filled] = ufunc.reduceat(values, offsets[:-1][is_filled])
+    return reduced
+
+
+def measure_object_edges(
+    object_loader: ObjectLoader,
+    image: Optional[numpy.ndarray] = None,
+) -> dict:
+    """
+    Measure the intensity of the outline of each object.
+    The outlines of all objects come from a single boundary pass over the compartment
+    that is shared by every channel measured with the same object index.
+
+    Parameters
+    ----------
+    object_loader : ObjectLoader
+        The object loader containing the image, label image and object index.
+    image : Optional[numpy.ndarray], optional
+        The image to measure, by default None which measures the object loader image.
+
+    Returns
+    -------
+    dict
+        A dictionary mapping each edge measurement name to an array with one value per object.
+    """
+    edge_offsets, edge_indices = object_loader.object_index.get_edge_voxels(
+        object_loader.label_image
+    )
+    if image is None:
+        image = object_loader.image
+    edge_values = image.ravel()[edge_indices].astype(numpy.float64)
+    edge_count = numpy.diff(edge_offsets)
+    integrated_intensity_edge = segment_reduce(
+        numpy.add, edge_values, edge_offsets, empty_value=0
+    )
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        mean_intensity_edge = integrated_intensity_edge / edge_count
+        deviations = edge_values - numpy.repeat(mean_intensity_edge, edge_count)
+        std_intensity_edge = numpy.sqrt(
+            segment_reduce(numpy.add, deviations**2, edge_offsets) / edge_count
+        )
+    return {
+        "EDGE.COUNT": edge_count,
+        "INTEGRATED.INTENSITY.EDGE": integrated_intensity_edge,
+        "MEAN.INTENSITY.EDGE": mean_intensity_edge,
+        "STD.INTENSITY.EDGE": std_intensity_edge,
+        "MIN.INTENSITY.EDGE": segment_reduce(numpy.minimum, edge_values, edge_offsets),
+        "MAX.INTENSITY.EDGE": segment_reduce(numpy.maximum, edge_values, edge_offsets),
+    }
+
+
+def measure_3D_intensity_vectorized(
+    object_loader: ObjectLoader,
+    quantile_method: str = "exact",
+    channel_images: Optional[Dict[str, numpy.ndarray]] = None,
+) -> dict:
+    """
+    Measure the intensity of all objects in a 3D image at once.
+    The voxels of every object are gathered once through the object index and
+    each measurement is a labeled reduction over the object segments,
+    so the cost is proportional to the number of object voxels.
+    Unlike measure_3D_intensity_CPU every statistic is calculated over the voxels
+    of the object only, the volume is the voxel count, and the I.X, I.Y and I.Z
+    moments are weighted by intensity.
+    Several channels can be measured in one call, in which case the object
+    voxel coordinates and outlines are found once and shared by every channel.
+
+    Parameters
+    ----------
+    object_loader : ObjectLoader
+        The object loader containing the image, label image and object index.
+    quantile_method : str, optional
+        How the quartiles and median are calculated, "exact" or the approximate
+        "histogram" for integer images, by default "exact"
+    channel_images : Optional[Dict[str, numpy.ndarray]], optional
+        A dictionary mapping each channel to measure to its image, by default None
+        which measures the channel and image of the object loader.
+
+    Returns
+    -------
+    dict
+        A dictionary containing the measurements for each object and channel.
+        The keys are the measurement names and the values are the corresponding values.
+    """
+    if channel_images is None:
+        channel_images = {object_loader.channel: object_loader.image}
+    object_index = object_loader.object_index
+    labels = object_loader.object_ids
+    voxel_offsets = object_index.voxel_offsets
+    segment_starts = voxel_offsets[:-1]
+    volume = numpy.diff(voxel_offsets)
+
+    def segment_sum(array: numpy.ndarray) -> numpy.ndarray:
+        return numpy.add.reduceat(array, segment_starts)
+
+    # the object geometry is shared by every channel
+    mesh_z, mesh_y, mesh_x = numpy.unravel_index(
+        object_index.voxel_indices, object_index.shape
+    )
+    cm_x = segment_sum(mesh_x) / volume
+    cm_y = segment_sum(mesh_y) / volume
+    cm_z = segment_sum(mesh_z) / volume
+
+    output_dict = {
+        "object_id": [],
+        "feature_name": [],
+        "channel": [],
+        "compartment": [],
+        "value": [],
+    }
+    for channel, image in channel_images.items():
+        # gather the voxels of all objects grouped by object
+        raw_values = image.ravel()[object_index.voxel_indices]
+        values = raw_values.astype(numpy.float64)
+
+        integrated_intensity = segment_sum(values)
+        mean_intensity = integrated_intensity / volume
+        deviations = values - numpy.repeat(mean_intensity, volume)
+        std_intensity = numpy.sqrt(segment_sum(deviations**2) / volume)
+        mad_intensity = segment_sum(numpy.abs(deviations)) / volume
+        del deviations
+        min_intensity = numpy.minimum.reduceat(values, segment_starts)
+        max_intensity = numpy.maximum.reduceat(values, segment_starts)
+        quartiles = get_grouped_quantiles(
+            values=raw_values,
+            voxel_offsets=voxel_offsets,
+            quantiles=[0.25, 0.5, 0.75],
+            method=quantile_method,
+        )
+        # first voxel in C order with the max intensity of its object
+        max_positions = get_segment_first_position(
+            values == numpy.repeat(max_intensity, volume), voxel_offsets
+        )
+        # intensity weighted center of mass
+        i_x = segment_sum(mesh_x * values)
+        i_y = segment_sum(mesh_y * values)
+        i_z = segment_sum(mesh_z * values)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            cmi_x = i_x / integrated_intensity
+            cmi_y = i_y / integrated_intensity
+            cmi_z = i_z / integrated_intensity
+        diff_x = cm_x - cmi_x
+        diff_y = cm_y - cmi_y
+        diff_z = cm_z - cmi_z
+        mass_displacement = numpy.sqrt(diff_x**2 + diff_y**2 + diff_z**2)
+
+        measurements_dict = {
+            "INTEGRATED.INTENSITY": integrated_intensity,
+            "VOLUME": volume,
+            "MEAN.INTENSITY": mean_intensity,
+            "STD.INTENSITY": std_intensity,
+            "MIN.INTENSITY": min_intensity,
+            "MAX.INTENSITY": max_intensity,
+            "LOWER.QUARTILE.INTENSITY": quartiles[:, 0],
+            "UPPER.QUARTILE.INTENSITY": quartiles[:, 2],
+            "MEDIAN.INTENSITY": quartiles[:, 1],
+            "MAX.Z": mesh_z[max_positions],
+            "MAX.Y": mesh_y[max_positions],
+            "MAX.X": mesh_x[max_positions],
+            "CM.X": cm_x,
+            "CM.Y": cm_y,
+            "CM.Z": cm_z,
+            "I.X": i_x,
+            "I.Y": i_y,
+            "I.Z": i_z,
+            "CMI.X": cmi_x,
+            "CMI.Y": cmi_y,
+            "CMI.Z": cmi_z,
+            "DIFF.X": diff_x,
+            "DIFF.Y": diff_y,
+            "DIFF.Z": diff_z,
+            "MASS.DISPLACEMENT": mass_displacement,
+            "MAD.INTENSITY": mad_intensity,
+        }
+        measurements_dict.update(measure_object_edges(object_loader, image=image))
+
+        for index, label in enumerate(labels):
+            for feature_name, values in measurements_dict.items():
+                output_dict["object_id"].append(label)
+                output_dict["feature_name"].append(feature_name)
+                output_dict["channel"].append(channel)
+                output_dict["compartment"].append(object_loader.compartment)
+                output_dict["value"].append(values[index].item())
+    return output_dict
+
+
+def get_intensity_features_dataframe(
+    output_dict: dict,
+    compartment: str,
+) -> pandas.DataFrame:
+    """
+    Pivot the intensity measurements to one row per object and one column per
+    channel and measurement.
+
+    Parameters
+    ----------
+    output_dict : dict
+        The measurements returned by one of the measure_3D_intensity functions.
+    compartment : str
+        The compartment the objects were measured in.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The measurements with columns named Intensity_{compartment}_{channel}_{measurement}.
+    """
+    final_df = pandas.DataFrame(output_dict)
+    final_df = final_df.pivot(
+        index=["object_id"],
+        columns=["channel", "feature_name"],
+        values="value",
+    ).sort_index(axis=1)
+    final_df.columns = [
+        f"Intensity_{compartment}_{channel}_{feature_name}"
+        for channel, feature_name in final_df.columns
+    ]
+    return final_df.reset_index()
+
+
 def measure_3D_intensity_gpu(
     object_loader: ObjectLoader,
 ) -> dict:
@@ -196,6 +598,13 @@ def measure_3D_intensity_gpu(
     labels = cupy.asarray(labels)
     ranges = len(labels)
 
+    # the outlines of all objects are found in a single pass over the compartment
+    # and only the outline voxel indices are copied to the device
+    edge_offsets, edge_indices = object_loader.object_index.get_edge_voxels(
+        object_loader.label_image
+    )
+    edge_indices = cupy.asarray(edge_indices)
+
     output_dict = {
         "object_id": [],
         "feature_name": [],
@@ -210,11 +619,9 @@ def measure_3D_intensity_gpu(
         selected_label_object[selected_label_object != label] = 0
         selected_image_object[selected_label_object == 0] = 0
         non_zero_pixels_object = selected_image_object[selected_image_object > 0]
-
-        selected_label_object = selected_label_object.get()
-        mask_outlines = get_outline(selected_label_object)
-        selected_label_object = cupy.asarray(selected_label_object)
-        mask_outlines = cupy.asarray(mask_outlines)
+        edge_values = image_object.ravel()[
+            edge_indices[edge_offsets[index] : edge_offsets[index + 1]]
+        ]
         mesh_z, mesh_y, mesh_x = cupy.mgrid[
             0 : selected_image_object.shape[0],
             0 : selected_image_object.shape[1],
@@ -267,12 +674,12 @@ def measure_3D_intensity_gpu(
         mass_displacement = cupy.sqrt(diff_x**2 + diff_y**2 + diff_z**2)
         # mean aboslute deviation
         mad_intensity = cupy.mean(cupy.abs(non_zero_pixels_object - mean_intensity))
-        edge_count = cupyx.scipy.ndimage.sum(mask_outlines)
-        integrated_intensity_edge = cupy.sum(image_object[mask_outlines > 0])
+        edge_count = cupy.asarray(edge_values.size)
+        integrated_intensity_edge = cupy.sum(edge_values)
         mean_intensity_edge = integrated_intensity_edge / edge_count
-        std_intensity_edge = cupy.std(image_object[mask_outlines > 0])
-        min_intensity_edge = cupy.min(image_object[mask_outlines > 0])
-        max_intensity_edge = cupy.max(image_object[mask_outlines > 0])
+        std_intensity_edge = cupy.std(edge_values)
+        min_intensity_edge = cupy.min(edge_values)
+        max_intensity_edge = cupy.max(edge_values)
         measurements_dict = {
             "INTEGRATED.INTENSITY": integrated_intensity.get(),
             "VOLUME": volume.get(),
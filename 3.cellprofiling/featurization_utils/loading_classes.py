@@ -1,13 +1,474 @@
+import collections.abc
 import logging
+import os
 import pathlib
+from typing import Callable, Iterable, Tuple
 
 import numpy
+import scipy.ndimage
 import skimage.io
 import skimage.measure
+import tifffile
 
 logging.basicConfig(level=logging.INFO)
 
 
+def read_only_view(array: numpy.ndarray) -> numpy.ndarray:
+    """
+    Get a read only view of an array without copying the underlying data.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        The array to view.
+
+    Returns
+    -------
+    numpy.ndarray
+        A view of the array that raises on any in place modification.
+    """
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def memmap_image(
+    image_path: pathlib.Path,
+    memmap_cache_path: pathlib.Path,
+) -> numpy.memmap:
+    """
+    Memory map a tiff image as a read only array.
+    Uncompressed contiguous tiffs are mapped in place.
+    Other tiffs are converted once to an uncompressed tiff in the cache directory,
+    which is mapped instead and reused on later calls.
+
+    Parameters
+    ----------
+    image_path : pathlib.Path
+        Path to the tiff image.
+    memmap_cache_path : pathlib.Path
+        Directory to write converted tiffs to.
+
+    Returns
+    -------
+    numpy.memmap
+        The read only memory mapped image.
+    """
+    try:
+        return tifffile.memmap(image_path, mode="r")
+    except ValueError:
+        # the tiff is compressed or not contiguous so it can not be mapped
+        pass
+    cached_image_path = memmap_cache_path / image_path.name
+    if (
+        not cached_image_path.exists()
+        or cached_image_path.stat().st_mtime < image_path.stat().st_mtime
+    ):
+        logging.info(f"Converting {image_path} to a memory mappable tiff")
+        memmap_cache_path.mkdir(parents=True, exist_ok=True)
+        image = tifffile.imread(image_path)
+        cached_image = tifffile.memmap(
+            cached_image_path, shape=image.shape, dtype=image.dtype
+        )
+        cached_image[:] = image
+        cached_image.flush()
+        del cached_image
+    return tifffile.memmap(cached_image_path, mode="r")
+
+
+def get_object_index_path(mask_path: pathlib.Path) -> pathlib.Path:
+    """
+    Get the path of the object index sidecar file of a segmentation mask.
+    Sidecar files are kept in an object_index directory next to the masks
+    so that they are not counted as image files.
+
+    Parameters
+    ----------
+    mask_path : pathlib.Path
+        Path to the segmentation mask.
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the object index sidecar file.
+    """
+    return mask_path.parent / "object_index" / f"{mask_path.stem}_object_index.npz"
+
+
+def get_quantized_image_path(
+    image_path: pathlib.Path, gray_levels: int
+) -> pathlib.Path:
+    """
+    Get the path of the cached gray level quantized copy of an image.
+    Quantized images are kept in a quantized_images directory next to the images
+    so that they are not counted as image files.
+
+    Parameters
+    ----------
+    image_path : pathlib.Path
+        Path to the image.
+    gray_levels : int
+        The number of gray levels of the quantized image.
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the quantized image file.
+    """
+    return (
+        image_path.parent
+        / "quantized_images"
+        / f"{image_path.stem}_{gray_levels}_levels.npy"
+    )
+
+
+def quantize_image(
+    image: numpy.ndarray,
+    gray_levels: int = 256,
+    min_value: float = None,
+    max_value: float = None,
+) -> numpy.ndarray:
+    """
+    Quantize an image to a number of gray levels between its minimum and maximum.
+    The image is scaled one z slice at a time so that only a slice sized
+    float64 temporary is allocated, with the same operations as
+    texture_utils.scale_image so that the gray levels are identical.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        The 3D image to quantize.
+    gray_levels : int, optional
+        The number of gray levels, at most 256, by default 256
+    min_value : float, optional
+        The value quantized to the lowest gray level, by default None which uses the image min
+    max_value : float, optional
+        The value quantized to the highest gray level, by default None which uses the image max
+
+    Returns
+    -------
+    numpy.ndarray
+        The quantized uint8 image, all zeros when the image is constant.
+    """
+    if not 2 <= gray_levels <= 256:
+        raise ValueError(f"Gray levels must be between 2 and 256, got {gray_levels}")
+    if min_value is None:
+        min_value = image.min()
+    if max_value is None:
+        max_value = image.max()
+    if max_value == min_value:
+        # a constant image, e.g. a blank or saturated FOV, has no range to scale
+        return numpy.zeros(image.shape, dtype=numpy.uint8)
+    quantized_image = numpy.empty(image.shape, dtype=numpy.uint8)
+    for z in range(image.shape[0]):
+        scaled_slice = (image[z] - min_value) / (max_value - min_value)
+        quantized_image[z] = (scaled_slice * (gray_levels - 1)).astype(numpy.uint8)
+    return quantized_image
+
+
+def find_object_edge_voxels(
+    label_image: numpy.ndarray,
+    object_ids: numpy.ndarray,
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Find the outline voxels of every object in a single pass over the labeled image.
+    The outline of an object matches skimage.segmentation.find_boundaries run on each
+    z slice of the object mask: the object voxels with a 4-connected in-slice neighbor
+    outside the object and the voxels outside the object with an in-slice neighbor
+    inside it. A voxel can be on the outline of more than one object.
+
+    Parameters
+    ----------
+    label_image : numpy.ndarray
+        The labeled image containing the segmented objects.
+    object_ids : numpy.ndarray
+        The sorted unique nonzero object IDs.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        The start of the outline voxels of each object with one extra trailing entry,
+        and the flat voxel indices of the outlines grouped by object and sorted within each object.
+    """
+    label_image = numpy.asarray(label_image)
+    n_voxels = label_image.size
+    keys = []
+    # compare each voxel with its next neighbor in y and in x
+    for axis in [1, 2]:
+        lower = [slice(None)] * label_image.ndim
+        upper = [slice(None)] * label_image.ndim
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        lower_labels = label_image[tuple(lower)]
+        upper_labels = label_image[tuple(upper)]
+        differs = lower_labels != upper_labels
+        lower_indices = numpy.ravel_multi_index(
+            numpy.nonzero(differs), label_image.shape
+        )
+        upper_indices = lower_indices + int(numpy.prod(label_image.shape[axis + 1 :]))
+        lower_labels = lower_labels[differs]
+        upper_labels = upper_labels[differs]
+        # both voxels of a differing pair are on the outline of both labels
+        for labels in [lower_labels, upper_labels]:
+            is_object = labels != 0
+            positions = numpy.searchsorted(object_ids, labels[is_object]).astype(
+                numpy.int64
+            )
+            for indices in [lower_indices, upper_indices]:
+                keys.append(positions * n_voxels + indices[is_object])
+    keys = numpy.unique(numpy.concatenate(keys)) if keys else numpy.zeros(0, int)
+    edge_positions = keys // n_voxels
+    edge_indices = keys % n_voxels
+    edge_offsets = numpy.searchsorted(
+        edge_positions, numpy.arange(len(object_ids) + 1)
+    ).astype(numpy.int64)
+    return edge_offsets, edge_indices
+
+
+class ObjectIndex:
+    """
+    An index of the objects in a labeled image.
+    The index holds the bounding box and the flat voxel indices of every object
+    so that per object work is proportional to the object size
+    instead of the image size.
+    Parameters
+    ----------
+    object_ids : numpy.ndarray
+        The sorted unique nonzero object IDs.
+    bboxes : numpy.ndarray
+        The bounding box of each object in the format
+        (min_z, min_y, min_x, max_z, max_y, max_x) where the max is exclusive.
+    voxel_offsets : numpy.ndarray
+        The start of the voxels of each object in voxel_indices,
+        with one extra trailing entry holding the total number of voxels.
+    voxel_indices : numpy.ndarray
+        The flat (C order) voxel indices of all objects grouped by object ID
+        and sorted within each object.
+    shape : tuple
+        The shape of the labeled image.
+    Methods
+    -------
+    from_label_image(label_image)
+        Builds the index of a labeled image.
+    load(path)
+        Loads an index from a sidecar file.
+    save(path)
+        Saves the index to a sidecar file.
+    get_bbox(object_id)
+        Retrieves the bounding box of an object.
+    get_slices(object_id, padding)
+        Retrieves the slices of the bounding box of an object.
+    get_voxel_indices(object_id)
+        Retrieves the flat voxel indices of an object.
+    get_voxel_count(object_id)
+        Retrieves the number of voxels of an object.
+    get_edge_voxels(label_image)
+        Retrieves the outline voxels of all objects, found once and then cached.
+    """
+
+    def __init__(
+        self,
+        object_ids: numpy.ndarray,
+        bboxes: numpy.ndarray,
+        voxel_offsets: numpy.ndarray,
+        voxel_indices: numpy.ndarray,
+        shape: tuple,
+    ):
+        self.object_ids = object_ids
+        self.bboxes = bboxes
+        self.voxel_offsets = voxel_offsets
+        self.voxel_indices = voxel_indices
+        self.shape = tuple(int(x) for x in shape)
+        self._positions = {
+            int(object_id): position for position, object_id in enumerate(object_ids)
+        }
+        self._edge_voxels = None
+
+    @classmethod
+    def from_label_image(cls, label_image: numpy.ndarray) -> "ObjectIndex":
+        """
+        Build the index of a labeled image in a single pass over the image.
+
+        Parameters
+        ----------
+        label_image : numpy.ndarray
+            The labeled image containing the segmented objects.
+
+        Returns
+        -------
+        ObjectIndex
+            The index of the objects in the labeled image.
+        """
+        label_image = numpy.asarray(label_image)
+        flat_labels = label_image.ravel()
+        voxel_indices = numpy.flatnonzero(flat_labels)
+        voxel_labels = flat_labels[voxel_indices]
+        # a stable sort keeps the voxels of each object in C order
+        voxel_indices = voxel_indices[numpy.argsort(voxel_labels, kind="stable")]
+        counts = numpy.bincount(voxel_labels)
+        object_ids = numpy.flatnonzero(counts).astype(label_image.dtype)
+        voxel_offsets = numpy.zeros(len(object_ids) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts[object_ids], out=voxel_offsets[1:])
+        object_slices = scipy.ndimage.find_objects(label_image)
+        bboxes = numpy.array(
+            [
+                [s.start for s in object_slices[object_id - 1]]
+                + [s.stop for s in object_slices[object_id - 1]]
+                for object_id in object_ids
+            ],
+            dtype=numpy.int64,
+        ).reshape(len(object_ids), 2 * label_image.ndim)
+        return cls(
+            object_ids=object_ids,
+            bboxes=bboxes,
+            voxel_offsets=voxel_offsets,
+            voxel_indices=voxel_indices,
+            shape=label_image.shape,
+        )
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "ObjectIndex":
+        with numpy.load(path) as sidecar:
+            return cls(
+                object_ids=sidecar["object_ids"],
+                bboxes=sidecar["bboxes"],
+                voxel_offsets=sidecar["voxel_offsets"],
+                voxel_indices=sidecar["voxel_indices"],
+                shape=tuple(sidecar["shape"]),
+            )
+
+    def save(self, path: pathlib.Path):
+        """
+        Save the index to a sidecar file.
+        The file is written under a temporary name and then renamed so that
+        concurrent jobs on the same image set never read a partial file.
+
+        Parameters
+        ----------
+        path : pathlib.Path
+            Path to the sidecar file.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+        numpy.savez(
+            tmp_path,
+            object_ids=self.object_ids,
+            bboxes=self.bboxes,
+            voxel_offsets=self.voxel_offsets,
+            voxel_indices=self.voxel_indices,
+            shape=numpy.array(self.shape, dtype=numpy.int64),
+        )
+        os.replace(tmp_path, path)
+
+    def get_bbox(self, object_id) -> tuple:
+        return tuple(int(x) for x in self.bboxes[self._positions[int(object_id)]])
+
+    def get_slices(self, object_id, padding: tuple = (0, 0, 0)) -> tuple:
+        """
+        Get the slices of the bounding box of an object.
+
+        Parameters
+        ----------
+        object_id : int
+            The object ID.
+        padding : tuple, optional
+            The number of voxels to pad the bounding box by in each dimension,
+            by default (0, 0, 0). The padded box is clipped to the image.
+
+        Returns
+        -------
+        tuple
+            A tuple of slices, one per dimension.
+        """
+        bbox = self.get_bbox(object_id)
+        ndim = len(self.shape)
+        return tuple(
+            slice(
+                max(bbox[i] - padding[i], 0),
+                min(bbox[i + ndim] + padding[i], self.shape[i]),
+            )
+            for i in range(ndim)
+        )
+
+    def get_voxel_indices(self, object_id) -> numpy.ndarray:
+        position = self._positions[int(object_id)]
+        return self.voxel_indices[
+            self.voxel_offsets[position] : self.voxel_offsets[position + 1]
+        ]
+
+    def get_edge_voxels(
+        self, label_image: numpy.ndarray
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Get the outline voxels of all objects.
+        The outlines are found on the first call and reused by every later call,
+        so every channel measured in a compartment shares a single boundary pass.
+
+        Parameters
+        ----------
+        label_image : numpy.ndarray
+            The labeled image the index was built from.
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, numpy.ndarray]
+            The start of the outline voxels of each object with one extra trailing entry,
+            and the flat voxel indices of the outlines grouped by object.
+        """
+        if self._edge_voxels is None:
+            self._edge_voxels = find_object_edge_voxels(
+                label_image=label_image, object_ids=self.object_ids
+            )
+        return self._edge_voxels
+
+    def get_voxel_count(self, object_id) -> int:
+        position = self._positions[int(object_id)]
+        return int(self.voxel_offsets[position + 1] - self.voxel_offsets[position])
+
+
+class LazyDict(collections.abc.Mapping):
+    """
+    A read only dictionary that computes the value of a key on first access.
+    The computed value is cached until it is released.
+    Parameters
+    ----------
+    keys : Iterable
+        The keys of the dictionary.
+    load_function : Callable
+        A function that takes a key and returns the value for that key.
+    Methods
+    -------
+    is_loaded(key)
+        Checks if the value of a key has already been computed.
+    release(key)
+        Drops the cached value of a key so that its memory can be freed.
+    """
+
+    def __init__(self, keys: Iterable, load_function: Callable):
+        self._keys = list(dict.fromkeys(keys))
+        self._load_function = load_function
+        self._cache = {}
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key not in self._cache:
+            self._cache[key] = self._load_function(key)
+        return self._cache[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def is_loaded(self, key) -> bool:
+        return key in self._cache
+
+    def release(self, key):
+        self._cache.pop(key, None)
+
+
 class ImageSetLoader:
     """
     A class to load an image set consisting of raw z stack images from multiple spectral
@@ -24,6 +485,22 @@ class ImageSetLoader:
     channel_mapping : dict
         A dictionary mapping channel names to their corresponding image file names.
         Example: {'nuclei': 'nuclei_', 'cell': 'cell_', 'cytoplasm': 'cytoplasm_'}
+    lazy : bool, optional
+        Whether to read each image only when it is first accessed, by default False
+    backend : str, optional
+        How images are read, by default "imread".
+        "imread" decodes each image into memory.
+        "memmap" memory maps each image read only so that processes on the same node
+        share the page cache instead of holding private copies.
+    memmap_cache_path : pathlib.Path, optional
+        Directory for tiffs converted to be memory mappable, by default None
+        which uses a memmap_cache directory next to the zstack_images directory.
+    save_quantized_images : bool, optional
+        Whether to save the gray level quantized channel images next to the images
+        and reuse them in later runs, by default False
+    save_object_indices : bool, optional
+        Whether to save the object index of each compartment as a sidecar file
+        next to the mask and reuse it in later runs, by default False
     Attributes
     ----------
     image_set_name : str
@@ -32,8 +509,11 @@ class ImageSetLoader:
         The anisotropy spacing of the images.
     anisotropy_factor : float
         The anisotropy factor calculated from the spacing.
+    image_set_files : dict
+        A dictionary containing the image file paths, with keys as channel names.
     image_set_dict : dict
         A dictionary containing the loaded images, with keys as channel names.
+        In lazy mode this is a LazyDict that reads an image on first access.
     unique_mask_objects : dict
         A dictionary containing unique object IDs for each mask in the image set.
     unique_compartment_objects : dict
@@ -41,6 +521,12 @@ class ImageSetLoader:
         Where a compartment is defined as a segmented region in the image.
         For example typically the Cell, Cytoplasm, Nuclei, and in this case also Organoid.
         The compartments are bounds for measurements.
+        In lazy mode the unique object IDs are only found for the compartments accessed.
+    object_indices : dict
+        A dictionary containing the ObjectIndex of each compartment that was accessed.
+    quantized_images : dict
+        A dictionary containing the gray level quantized channel images that were accessed,
+        with keys as (channel, gray levels).
     image_names : list
         A list of image names in the image set.
     compartments : list
@@ -59,6 +545,14 @@ class ImageSetLoader:
         Retrieves the names of compartments in the image set.
     get_anisotropy()
         Retrieves the anisotropy factor.
+    get_object_index(compartment)
+        Retrieves the ObjectIndex of a compartment, which is built on first access
+        and optionally loaded from or saved to a sidecar file next to the mask.
+    get_quantized_image(channel, gray_levels)
+        Retrieves a channel image quantized to a number of gray levels,
+        which is computed once and reused by every compartment.
+    release_image(key)
+        Releases a lazily loaded image and the objects found in it from memory.
     """
 
     def __init__(
@@ -66,6 +560,11 @@ class ImageSetLoader:
         image_set_path: pathlib.Path,
         anisotropy_spacing: tuple,
         channel_mapping: dict,
+        lazy: bool = False,
+        backend: str = "imread",
+        memmap_cache_path: pathlib.Path = None,
+        save_quantized_images: bool = False,
+        save_object_indices: bool = False,
     ):
         """
         Initialize the ImageSetLoader with the path to the image set, spacing, and channel mapping.
@@ -79,25 +578,68 @@ class ImageSetLoader:
         channel_mapping : dict
             A dictionary mapping channel names to their corresponding image file names.
             Example: {'nuclei': 'nuclei_', 'cell': 'cell_', 'cytoplasm': 'cytoplasm_'}
+        lazy : bool, optional
+            Whether to read each image only when it is first accessed, by default False
+        backend : str, optional
+            How images are read, "imread" or "memmap", by default "imread"
+        memmap_cache_path : pathlib.Path, optional
+            Directory for tiffs converted to be memory mappable, by default None
+        save_quantized_images : bool, optional
+            Whether to save quantized channel images next to the images, by default False
+        save_object_indices : bool, optional
+            Whether to save object index sidecar files next to the masks, by default False
         """
         self.anisotropy_spacing = anisotropy_spacing
         self.anisotropy_factor = self.anisotropy_spacing[0] / self.anisotropy_spacing[1]
         self.image_set_name = image_set_path.name
+        self.lazy = lazy
+        if backend not in ["imread", "memmap"]:
+            raise ValueError(
+                f"Backend {backend} is not supported. Use 'imread' or 'memmap'."
+            )
+        self.backend = backend
+        if memmap_cache_path is None:
+            memmap_cache_path = (
+                image_set_path.parent.parent / "memmap_cache" / image_set_path.name
+            )
+        self.memmap_cache_path = memmap_cache_path
+        self.save_quantized_images = save_quantized_images
+        self.save_object_indices = save_object_indices
         files = sorted(image_set_path.glob("*"))
         files = [f for f in files if f.suffix in [".tif", ".tiff"]]
 
-        # Load images into a dictionary
-        self.image_set_dict = {}
+        # map each channel to the image file to load
+        self.image_set_files = {}
         for f in files:
             for key, value in channel_mapping.items():
                 if value in f.name:
-                    self.image_set_dict[key] = skimage.io.imread(f)
+                    self.image_set_files[key] = f
+
+        # Load images into a dictionary
+        if self.lazy:
+            self.image_set_dict = LazyDict(
+                keys=self.image_set_files.keys(),
+                load_function=lambda key: self.read_image(self.image_set_files[key]),
+            )
+        else:
+            self.image_set_dict = {
+                key: self.read_image(f) for key, f in self.image_set_files.items()
+            }
 
+        self.object_indices = {}
+        self.quantized_images = {}
         self.retrieve_image_attributes()
         self.get_compartments()
         self.get_image_names()
         self.get_unique_objects_in_compartments()
 
+    def read_image(self, image_path: pathlib.Path) -> numpy.ndarray:
+        if self.backend == "memmap":
+            return memmap_image(
+                image_path=image_path, memmap_cache_path=self.memmap_cache_path
+            )
+        return skimage.io.imread(image_path)
+
     def retrieve_image_attributes(self):
         """
         This is also a quick and dirty way of loading two types of images:
@@ -111,25 +653,162 @@ class ImageSetLoader:
         Future work should be to load the images in a more structured way
         that does not depend on the file naming convention.
         """
-        self.unique_mask_objects = {}
-        for key, value in self.image_set_dict.items():
-            if "mask" in key:
-                self.unique_mask_objects[key] = numpy.unique(value)
+        mask_keys = [key for key in self.image_set_dict.keys() if "mask" in key]
+        if self.lazy:
+            self.unique_mask_objects = LazyDict(
+                keys=mask_keys,
+                load_function=lambda key: numpy.unique(self.image_set_dict[key]),
+            )
+        else:
+            self.unique_mask_objects = {
+                key: numpy.unique(self.image_set_dict[key]) for key in mask_keys
+            }
+
+    def get_unique_objects_in_compartment(self, compartment: str) -> list:
+        if compartment in self.object_indices:
+            # the object index already holds the unique nonzero labels
+            return list(self.object_indices[compartment].object_ids)
+        return [x for x in numpy.unique(self.image_set_dict[compartment]) if x != 0]
+
+    def get_object_index(self, compartment: str) -> ObjectIndex:
+        """
+        Get the ObjectIndex of a compartment.
+        The index is built from the mask the first time it is accessed.
+        When save_object_indices is set it is also saved as a sidecar file next to
+        the mask and loaded in later runs while the sidecar is newer than the mask.
 
-    def get_unique_objects_in_compartments(self):
-        self.unique_compartment_objects = {}
-        for compartment in self.compartments:
-            self.unique_compartment_objects[compartment] = numpy.unique(
+        Parameters
+        ----------
+        compartment : str
+            The name of the compartment.
+
+        Returns
+        -------
+        ObjectIndex
+            The index of the objects in the compartment mask.
+        """
+        if compartment in self.object_indices:
+            return self.object_indices[compartment]
+        mask_path = self.image_set_files[compartment]
+        object_index_path = get_object_index_path(mask_path)
+        object_index = None
+        if (
+            self.save_object_indices
+            and object_index_path.exists()
+            and object_index_path.stat().st_mtime >= mask_path.stat().st_mtime
+        ):
+            object_index = ObjectIndex.load(object_index_path)
+            if object_index.shape != self.image_set_dict[compartment].shape:
+                object_index = None
+        if object_index is None:
+            logging.info(f"Building the object index of {mask_path}")
+            object_index = ObjectIndex.from_label_image(
                 self.image_set_dict[compartment]
             )
-            # remove the 0 label
-            self.unique_compartment_objects[compartment] = [
-                x for x in self.unique_compartment_objects[compartment] if x != 0
-            ]
+            if self.save_object_indices:
+                try:
+                    object_index.save(object_index_path)
+                except OSError as error:
+                    logging.warning(
+                        f"Could not save the object index of {mask_path}: {error}"
+                    )
+        self.object_indices[compartment] = object_index
+        return object_index
+
+    def get_quantized_image(self, channel: str, gray_levels: int = 256):
+        """
+        Get a channel image quantized to a number of gray levels between its
+        minimum and maximum.
+        The quantized image is kept in memory until the channel is released.
+        When save_quantized_images is set it is also saved next to the images
+        and loaded in later runs while it is newer than the image.
+
+        Parameters
+        ----------
+        channel : str
+            The name of the channel.
+        gray_levels : int, optional
+            The number of gray levels, by default 256
+
+        Returns
+        -------
+        numpy.ndarray
+            The read only quantized uint8 image.
+        """
+        if (channel, gray_levels) in self.quantized_images:
+            return self.quantized_images[(channel, gray_levels)]
+        image_path = self.image_set_files[channel]
+        quantized_image_path = get_quantized_image_path(image_path, gray_levels)
+        quantized_image = None
+        if (
+            self.save_quantized_images
+            and quantized_image_path.exists()
+            and quantized_image_path.stat().st_mtime >= image_path.stat().st_mtime
+        ):
+            quantized_image = numpy.load(
+                quantized_image_path,
+                mmap_mode="r" if self.backend == "memmap" else None,
+            )
+            if quantized_image.shape != self.image_set_dict[channel].shape:
+                quantized_image = None
+        if quantized_image is None:
+            logging.info(f"Quantizing {image_path} to {gray_levels} gray levels")
+            quantized_image = quantize_image(
+                self.image_set_dict[channel], gray_levels=gray_levels
+            )
+            if self.save_quantized_images:
+                try:
+                    quantized_image_path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp_path = quantized_image_path.with_name(
+                        f"{quantized_image_path.stem}.{os.getpid()}.tmp.npy"
+                    )
+                    numpy.save(tmp_path, quantized_image)
+                    os.replace(tmp_path, quantized_image_path)
+                except OSError as error:
+                    logging.warning(
+                        f"Could not save the quantized image of {image_path}: {error}"
+                    )
+        quantized_image = read_only_view(quantized_image)
+        self.quantized_images[(channel, gray_levels)] = quantized_image
+        return quantized_image
+
+    def get_unique_objects_in_compartments(self):
+        if self.lazy:
+            self.unique_compartment_objects = LazyDict(
+                keys=self.compartments,
+                load_function=self.get_unique_objects_in_compartment,
+            )
+        else:
+            self.unique_compartment_objects = {
+                compartment: self.get_unique_objects_in_compartment(compartment)
+                for compartment in self.compartments
+            }
 
     def get_image(self, key):
         return self.image_set_dict[key]
 
+    def release_image(self, key):
+        """
+        Release a lazily loaded image, the objects found in it,
+        and its quantized copies from memory.
+        The image is read again if it is accessed after being released.
+        This has no effect when the image set is not lazily loaded.
+
+        Parameters
+        ----------
+        key : str
+            The channel or compartment name of the image to release.
+        """
+        if not self.lazy:
+            return
+        self.image_set_dict.release(key)
+        self.unique_mask_objects.release(key)
+        self.unique_compartment_objects.release(key)
+        self.object_indices.pop(key, None)
+        for quantized_key in list(self.quantized_images):
+            if quantized_key[0] == key:
+                del self.quantized_images[quantized_key]
+
     def get_image_names(self):
         self.image_names = [
             x for x in self.image_set_dict.keys() if x not in self.compartments
@@ -161,38 +840,43 @@ class ObjectLoader:
         The name of the channel from which the objects are extracted.
     compartment_name : str
         The name of the compartment from which the objects are extracted.
+    object_index : ObjectIndex, optional
+        The precomputed index of the objects in the labeled image, by default None
+        which builds the index from the labeled image.
     Attributes
     ----------
     image : numpy.ndarray
-        The image from which the objects are extracted.
+        A read only view of the image from which the objects are extracted.
     label_image : numpy.ndarray
-        The labeled image containing the segmented objects.
+        A read only view of the labeled image containing the segmented objects.
     channel : str
         The name of the channel from which the objects are extracted.
     compartment : str
         The name of the compartment from which the objects are extracted.
-    objects : numpy.ndarray
-        The labeled image containing the segmented objects.
+    object_index : ObjectIndex
+        The index of the bounding boxes and voxels of the segmented objects.
     object_ids : numpy.ndarray
         The unique object IDs for the segmented objects.
     Methods
     -------
-    __init__(image, label_image, channel_name, compartment_name)
+    __init__(image, label_image, channel_name, compartment_name, object_index)
         Initializes the ObjectLoader with the image, label image, channel name, and compartment name.
 
     """
 
-    def __init__(self, image, label_image, channel_name, compartment_name):
-        self.image = image
-        self.label_image = label_image
+    def __init__(
+        self, image, label_image, channel_name, compartment_name, object_index=None
+    ):
+        self.image = read_only_view(image)
+        self.label_image = read_only_view(label_image)
         self.channel = channel_name
         self.compartment = compartment_name
         # get the labeled image objects
         # this is a 3D image, so the objects are labeled in 3D
-        # self.objects = skimage.measure.label(label_image)
-        self.object_ids = numpy.unique(label_image)
-        # drop the 0 label
-        self.object_ids = [x for x in self.object_ids if x != 0]
+        if object_index is None:
+            object_index = ObjectIndex.from_label_image(label_image)
+        self.object_index = object_index
+        self.object_ids = list(self.object_index.object_ids)
 
 
 class TwoObjectLoader:
@@ -216,11 +900,12 @@ class TwoObjectLoader:
     compartment : str
         The name of the compartment for which the label image is loaded.
     label_image : numpy.ndarray
-        The labeled image containing the segmented objects for the specified compartment.
+        A read only view of the labeled image containing the segmented objects
+        for the specified compartment.
     image1 : numpy.ndarray
-        The image corresponding to the first channel.
+        A read only view of the image corresponding to the first channel.
     image2 : numpy.ndarray
-        The image corresponding to the second channel.
+        A read only view of the image corresponding to the second channel.
     object_ids : numpy.ndarray
         The unique object IDs for the segmented objects in the specified compartment.
     Methods
@@ -238,7 +923,9 @@ class TwoObjectLoader:
     ):
         self.image_set_loader = image_set_loader
         self.compartment = compartment
-        self.label_image = self.image_set_loader.image_set_dict[compartment].copy()
-        self.image1 = self.image_set_loader.image_set_dict[channel1].copy()
-        self.image2 = self.image_set_loader.image_set_dict[channel2].copy()
+        self.label_image = read_only_view(
+            self.image_set_loader.image_set_dict[compartment]
+        )
+        self.image1 = read_only_view(self.image_set_loader.image_set_dict[channel1])
+        self.image2 = read_only_view(self.image_set_loader.image_set_dict[channel2])
         self.object_ids = image_set_loader.unique_compartment_objects[compartment]
@@ -1,8 +1,10 @@
-from typing import Dict, Tuple, Union
+from typing import Dict, List, Tuple, Union
 
 import numpy
-import skimage.measure
-from loading_classes import ObjectLoader
+import scipy.spatial
+from loading_classes import ObjectIndex, ObjectLoader
+
+NEIGHBORS_ENGINES = ["crop", "kdtree"]
 
 
 def neighbors_expand_box(
@@ -113,23 +115,13 @@ def measure_3D_number_of_neighbors(
         f"Neighbors_{distance_threshold}": [],
     }
     for index, label in enumerate(labels):
-        selected_label_object = label_object.copy()
-        selected_label_object[selected_label_object != label] = 0
-        props_label = skimage.measure.regionprops_table(
-            selected_label_object, properties=["bbox"]
-        )
         # get the number of neighbors for each object
         distance_x_y = distance_threshold
         distance_z = numpy.ceil(distance_threshold / anisotropy_factor).astype(int)
         # find how many other indexes are within a specified distance of the object
         # first expand the mask image by a specified distance
-        z_min, y_min, x_min, z_max, y_max, x_max = (
-            props_label["bbox-0"][0],
-            props_label["bbox-1"][0],
-            props_label["bbox-2"][0],
-            props_label["bbox-3"][0],
-            props_label["bbox-4"][0],
-            props_label["bbox-5"][0],
+        z_min, y_min, x_min, z_max, y_max, x_max = object_loader.object_index.get_bbox(
+            label
         )
         original_bbox = (z_min, y_min, x_min, z_max, y_max, x_max)
 
@@ -182,3 +174,187 @@ def measure_3D_number_of_neighbors(
         )
 
     return neighbors_out_dict
+
+
+def measure_3D_number_of_neighbors_kdtree(
+    object_index: ObjectIndex,
+    distance_thresholds: Union[int, List[int]] = 10,
+    anisotropy_factor: int = 10,
+) -> Dict[str, numpy.ndarray]:
+    """
+    Calculate the number of neighbors of every object in a 3D image at once
+    for one or more distance thresholds.
+    The counts are the same as measure_3D_number_of_neighbors gives:
+    an object is adjacent when it has a voxel in the bounding box of the object
+    and within a distance when it has a voxel in the bounding box expanded by
+    the distance in y and x and the distance over the anisotropy factor in z.
+    The candidate neighbors of all objects are found with a KD-tree of the
+    anisotropy scaled bounding box centers, and only the candidates whose
+    bounding boxes come close enough have their voxels checked.
+
+    Parameters
+    ----------
+    object_index : ObjectIndex
+        The index of the objects to measure.
+    distance_thresholds : Union[int, List[int]], optional
+        The distance threshold or thresholds for counting neighbors, by default 10
+    anisotropy_factor : int, optional
+        The anisotropy factor for the image where the anisotropy factor is the ratio of the pixel size in the z direction to the pixel size in the x and y directions, by default 10
+
+    Returns
+    -------
+    Dict[str, numpy.ndarray]
+        The object_id, Neighbors_adjacent, and one Neighbors_{distance} column
+        per distance threshold.
+    """
+    distance_thresholds = (
+        [distance_thresholds]
+        if numpy.isscalar(distance_thresholds)
+        else list(distance_thresholds)
+    )
+    object_ids = numpy.asarray(object_index.object_ids)
+    n_objects = len(object_ids)
+    columns = {"object_id": object_ids}
+    count_columns = ["Neighbors_adjacent"] + [
+        f"Neighbors_{distance_threshold}" for distance_threshold in distance_thresholds
+    ]
+    counts = numpy.zeros((n_objects, len(count_columns)), dtype=numpy.int64)
+    if n_objects > 0:
+        # the (z, y, x) expansion of the bounding box for each count,
+        # the bounding box itself for the adjacent objects
+        expansions = numpy.array(
+            [[0, 0, 0]]
+            + [
+                [
+                    numpy.ceil(distance_threshold / anisotropy_factor).astype(int),
+                    distance_threshold,
+                    distance_threshold,
+                ]
+                for distance_threshold in distance_thresholds
+            ],
+            dtype=numpy.int64,
+        )
+        bboxes = numpy.asarray(object_index.bboxes, dtype=numpy.int64)
+        starts = bboxes[:, :3]
+        # the last voxel of each bounding box
+        ends = bboxes[:, 3:] - 1
+        scale = numpy.array([anisotropy_factor, 1, 1], dtype=numpy.float64)
+        centers = (starts + ends) / 2 * scale
+        half_sizes = (ends - starts) / 2 * scale
+        # two expanded bounding boxes can only meet when their centers are
+        # closer on every axis than the sum of their half sizes and the expansion
+        radii = (
+            half_sizes + half_sizes.max(axis=0) + expansions.max(axis=0) * scale + scale
+        ).max(axis=1)
+        tree = scipy.spatial.cKDTree(centers)
+        candidates = tree.query_ball_point(centers, r=radii, p=numpy.inf)
+
+        voxel_coordinates = {}
+        for position, candidate_positions in enumerate(candidates):
+            candidate_positions = numpy.array(
+                [
+                    candidate_position
+                    for candidate_position in candidate_positions
+                    if candidate_position != position
+                ],
+                dtype=numpy.int64,
+            )
+            if len(candidate_positions) == 0:
+                continue
+            # the gap between the bounding boxes on each axis
+            box_gaps = numpy.maximum(
+                numpy.maximum(
+                    starts[candidate_positions] - ends[position],
+                    starts[position] - ends[candidate_positions],
+                ),
+                0,
+            )
+            reachable = numpy.all(
+                box_gaps[:, numpy.newaxis, :] <= expansions[numpy.newaxis], axis=2
+            )
+            for candidate_position, candidate_reachable in zip(
+                candidate_positions, reachable
+            ):
+                if not candidate_reachable.any():
+                    continue
+                if candidate_position not in voxel_coordinates:
+                    voxel_coordinates[candidate_position] = numpy.stack(
+                        numpy.unravel_index(
+                            object_index.get_voxel_indices(
+                                object_ids[candidate_position]
+                            ),
+                            object_index.shape,
+                        ),
+                        axis=1,
+                    )
+                coordinates = voxel_coordinates[candidate_position]
+                # the gap between each voxel and the bounding box on each axis
+                voxel_gaps = numpy.maximum(
+                    numpy.maximum(
+                        starts[position] - coordinates, coordinates - ends[position]
+                    ),
+                    0,
+                )
+                for count_position in numpy.flatnonzero(candidate_reachable):
+                    if numpy.any(
+                        numpy.all(voxel_gaps <= expansions[count_position], axis=1)
+                    ):
+                        counts[position, count_position] += 1
+
+    for count_position, column in enumerate(count_columns):
+        columns[column] = counts[:, count_position]
+    return columns
+
+
+def measure_3D_adjacency_graph(label_image: numpy.ndarray) -> Dict[str, numpy.ndarray]:
+    """
+    Build the graph of the objects that touch in a 3D label image
+    by comparing the image with itself shifted by one voxel along each axis.
+    Every voxel face between two different objects adds one to the shared
+    surface of the pair, so the whole image is compared once per axis
+    instead of once per object.
+
+    Parameters
+    ----------
+    label_image : numpy.ndarray
+        The labeled image containing the segmented objects.
+
+    Returns
+    -------
+    Dict[str, numpy.ndarray]
+        The edge list with one row per pair of touching objects, with the
+        columns object_a, object_b where object_a < object_b, and
+        shared_surface_voxels, the number of voxel faces the two objects share.
+    """
+    label_image = numpy.asarray(label_image)
+    max_label = int(label_image.max()) if label_image.size > 0 else 0
+    pair_keys = [numpy.zeros(0, dtype=numpy.int64)]
+    for axis in range(label_image.ndim):
+        first = label_image[
+            tuple(
+                slice(None, -1) if dimension == axis else slice(None)
+                for dimension in range(label_image.ndim)
+            )
+        ]
+        second = label_image[
+            tuple(
+                slice(1, None) if dimension == axis else slice(None)
+                for dimension in range(label_image.ndim)
+            )
+        ]
+        touching = (first != second) & (first > 0) & (second > 0)
+        first_labels = first[touching].astype(numpy.int64)
+        second_labels = second[touching].astype(numpy.int64)
+        # encode each unordered pair as a single integer
+        pair_keys.append(
+            numpy.minimum(first_labels, second_labels) * (max_label + 1)
+            + numpy.maximum(first_labels, second_labels)
+        )
+    pair_keys, shared_surface_voxels = numpy.unique(
+        numpy.concatenate(pair_keys), return_counts=True
+    )
+    return {
+        "object_a": (pair_keys // (max_label + 1)).astype(label_image.dtype),
+        "object_b": (pair_keys % (max_label + 1)).astype(label_image.dtype),
+        "shared_surface_voxels": shared_surface_voxels.astype(numpy.int64),
+    }
@@ -0,0 +1,48 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+
+def map_in_processes(
+    function,
+    *iterables,
+    n_processes: int = 1,
+    initializer=None,
+    initargs: tuple = (),
+):
+    """
+    Map a function over iterables in a process pool, yielding the results in order.
+    Unlike ProcessPoolExecutor.map only a few inputs per process are submitted
+    at a time so that large inputs are not all held in memory at once.
+
+    Parameters
+    ----------
+    function : callable
+        The function to map, it has to be picklable.
+    *iterables : iterable
+        The iterables of the function arguments.
+    n_processes : int, optional
+        The number of processes, by default 1 which maps in this process
+    initializer : callable, optional
+        A picklable function run once in each process before the first input,
+        e.g. to attach shared memory, by default None
+    initargs : tuple, optional
+        The arguments of the initializer, by default ()
+
+    Yields
+    ------
+    object
+        The result of the function for each input.
+    """
+    if n_processes <= 1:
+        yield from map(function, *iterables)
+        return
+    with ProcessPoolExecutor(
+        max_workers=n_processes, initializer=initializer, initargs=initargs
+    ) as executor:
+        pending = collections.deque()
+        for arguments in zip(*iterables):
+            pending.append(executor.submit(function, *arguments))
+            if len(pending) >= 2 * n_processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,12 +1,37 @@
-import gc
+import itertools
+from typing import Dict, List, Optional, Union
 
 import mahotas
 import numpy
 import tqdm
 from loading_classes import ObjectLoader
+from parallel_utils import map_in_processes
 
+TEXTURE_NORMALIZATIONS = ["object", "global"]
 
-def scale_image(image: numpy.ndarray, num_gray_levels=256) -> numpy.ndarray:
+HARALICK_FEATURE_NAMES = [
+    "Angular.Second.Moment",
+    "Contrast",
+    "Correlation",
+    "Variance",
+    "Inverse.Difference.Moment",
+    "Sum.Average",
+    "Sum.Variance",
+    "Sum.Entropy",
+    "Entropy",
+    "Difference.Variance",
+    "Difference.Entropy",
+    "Information.Measure.of.Correlation.1",
+    "Information.Measure.of.Correlation.2",
+]
+
+
+def scale_image(
+    image: numpy.ndarray,
+    num_gray_levels=256,
+    min_value: Optional[float] = None,
+    max_value: Optional[float] = None,
+) -> numpy.ndarray:
     """
     Scale the image to a specified number of gray levels.
     Example: 1024 gray levels will be scaled to 256 gray levels if num_gray_levels=256.
@@ -19,84 +44,600 @@ def scale_image(image: numpy.ndarray, num_gray_levels=256) -> numpy.ndarray:
         The input image to be scaled. Can be a ndarray of any shape.
     num_gray_levels : int, optional
         The number of gray levels to scale the image to, by default 256
+    min_value : Optional[float], optional
+        The value scaled to the lowest gray level, by default None which uses the image min
+    max_value : Optional[float], optional
+        The value scaled to the highest gray level, by default None which uses the image max
 
     Returns
     -------
     numpy.ndarray
         The gray level scaled image of any shape.
     """
+    if min_value is None:
+        min_value = image.min()
+    if max_value is None:
+        max_value = image.max()
     # scale the image to 256 gray levels
-    image = (image - image.min()) / (image.max() - image.min())
+    image = (image - min_value) / (max_value - min_value)
     image = (image * (num_gray_levels - 1)).astype(numpy.uint8)
     return image
 
 
+def count_cooccurrence_pairs(shape: tuple, direction: int, distance: int) -> int:
+    """
+    Count the voxel pairs of a 3D image that mahotas compares in a direction.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the image.
+    direction : int
+        The index of the mahotas 3D cooccurrence direction.
+    distance : int
+        The distance between the voxels of a pair.
+
+    Returns
+    -------
+    int
+        The number of voxel pairs.
+    """
+    delta = mahotas.features.texture._3d_deltas[direction]
+    return int(
+        numpy.prod(
+            [
+                max(length - distance * abs(step), 0)
+                for length, step in zip(shape, delta)
+            ]
+        )
+    )
+
+
+def get_texture_parameters(distance, grayscale) -> tuple:
+    """
+    Get the lists of distances and gray levels to measure texture with.
+
+    Parameters
+    ----------
+    distance : Union[int, List[int]]
+        A distance or a list of distances for Haralick features.
+    grayscale : Union[int, List[int]]
+        A number of gray levels or a list of numbers of gray levels.
+
+    Returns
+    -------
+    tuple
+        The list of distances and the list of gray levels.
+
+    Raises
+    ------
+    ValueError
+        If a distance is not positive or a number of gray levels is not between 2 and 256.
+    """
+    distances = [distance] if numpy.isscalar(distance) else list(distance)
+    grayscales = [grayscale] if numpy.isscalar(grayscale) else list(grayscale)
+    if not distances or min(distances) < 1:
+        raise ValueError(f"Distances must be positive integers, got {distances}")
+    if not grayscales or min(grayscales) < 2 or max(grayscales) > 256:
+        raise ValueError(
+            f"Gray levels must be integers between 2 and 256, got {grayscales}"
+        )
+    return distances, grayscales
+
+
+def calculate_cropped_haralick_features(
+    masked_crop: numpy.ndarray,
+    fills_image: bool,
+    image_shape: tuple,
+    distances: List[int],
+    grayscales: List[int],
+) -> numpy.ndarray:
+    """
+    Calculate the mean Haralick features over the 13 3D directions of an object
+    from the crop of its bounding box, as if they were calculated on the full image
+    with every other voxel set to zero.
+    The crop has to be padded by at least the largest distance in every direction
+    so that the pairs left out of the crop are all background (0, 0) pairs,
+    which are added back to each cooccurrence matrix.
+
+    Parameters
+    ----------
+    masked_crop : numpy.ndarray
+        The crop of the object with every other voxel set to zero.
+    fills_image : bool
+        Whether the object fills the whole image, in which case the masked image
+        has no zero background and is scaled from the object minimum instead of 0.
+    image_shape : tuple
+        The shape of the full image the crop was taken from.
+    distances : List[int]
+        The distances to calculate the features for.
+    grayscales : List[int]
+        The numbers of gray levels to calculate the features for.
+
+    Returns
+    -------
+    numpy.ndarray
+        The mean of each Haralick feature over the directions
+        for each number of gray levels and distance.
+    """
+    haralick_means = numpy.empty(
+        (len(grayscales), len(distances), len(HARALICK_FEATURE_NAMES))
+    )
+    min_value = masked_crop.min() if fills_image else 0
+    for grayscale_index, grayscale in enumerate(grayscales):
+        scaled_crop = scale_image(
+            masked_crop, num_gray_levels=grayscale, min_value=min_value
+        )
+        gray_levels = int(scaled_crop.max()) + 1
+        cmat = numpy.empty((gray_levels, gray_levels), numpy.int32)
+        for distance_index, distance in enumerate(distances):
+
+            def all_cmatrices():
+                for direction in range(len(mahotas.features.texture._3d_deltas)):
+                    mahotas.features.texture.cooccurence(
+                        scaled_crop, direction, cmat, symmetric=True, distance=distance
+                    )
+                    # the symmetric matrix counts each missing background pair twice
+                    cmat[0, 0] += 2 * (
+                        count_cooccurrence_pairs(image_shape, direction, distance)
+                        - count_cooccurrence_pairs(
+                            scaled_crop.shape, direction, distance
+                        )
+                    )
+                    yield cmat
+
+            haralick_means[grayscale_index, distance_index] = (
+                mahotas.features.texture.haralick_features(
+                    all_cmatrices(),
+                    ignore_zeros=False,
+                    compute_14th_feature=False,
+                ).mean(axis=0)
+            )
+    return haralick_means
+
+
+def get_texture_output_dict(
+    labels: list,
+    haralick_means,
+    distances: List[int],
+    grayscales: List[int],
+) -> dict:
+    """
+    Get the texture output dictionary from the Haralick features of each object.
+
+    Parameters
+    ----------
+    labels : list
+        The object IDs.
+    haralick_means : iterable
+        The mean Haralick features of each object, shaped as
+        number of gray levels by number of distances by number of features.
+    distances : List[int]
+        The distances of the features.
+    grayscales : List[int]
+        The numbers of gray levels of the features.
+
+    Returns
+    -------
+    dict
+        A dictionary containing the object ID, texture name, and texture value.
+    """
+    output_texture_dict = {
+        "object_id": [],
+        "texture_name": [],
+        "texture_value": [],
+    }
+    for label, object_haralick_means in tqdm.tqdm(
+        zip(labels, haralick_means), total=len(labels)
+    ):
+        for grayscale_index, grayscale in enumerate(grayscales):
+            for distance_index, distance in enumerate(distances):
+                for i, feature_name in enumerate(HARALICK_FEATURE_NAMES):
+                    output_texture_dict["object_id"].append(label)
+                    output_texture_dict["texture_name"].append(
+                        f"{feature_name}_{grayscale}.{distance}"
+                    )
+                    output_texture_dict["texture_value"].append(
+                        object_haralick_means[grayscale_index, distance_index, i]
+                    )
+    return output_texture_dict
+
+
 def measure_3D_texture(
     object_loader: ObjectLoader,
-    distance: int = 1,
-    grayscale: int = 256,
+    distance: Union[int, List[int]] = 1,
+    grayscale: Union[int, List[int]] = 256,
+    n_processes: int = 1,
 ) -> dict:
     """
     Calculate texture features for each object in the image using Haralick features.
     The features are calculated for each object separately and the mean value is returned.
+    Each object is measured on the crop of its bounding box padded by the largest distance,
+    which gives the same features as the full image with every other voxel set to zero.
+    Every combination of distance and number of gray levels is measured on the same crop.
 
     Parameters
     ----------
     object_loader : ObjectLoader
         The object loader containing the image and object information.
-    distance : int, optional
-        The distance parameter for Haralick features, by default 1
-    grayscale : int, optional
-        The number of gray levels to scale the image to, by default 256
+    distance : Union[int, List[int]], optional
+        The distance or distances for Haralick features, by default 1
+    grayscale : Union[int, List[int]], optional
+        The number or numbers of gray levels to scale the image to, by default 256
+    n_processes : int, optional
+        The number of processes to distribute the objects over, by default 1
 
     Returns
     -------
     dict
         A dictionary containing the object ID, texture name, and texture value.
     """
-    label_object = object_loader.label_image
+    distances, grayscales = get_texture_parameters(distance, grayscale)
     labels = object_loader.object_ids
-    feature_names = [
-        "Angular.Second.Moment",
-        "Contrast",
-        "Correlation",
-        "Variance",
-        "Inverse.Difference.Moment",
-        "Sum.Average",
-        "Sum.Variance",
-        "Sum.Entropy",
-        "Entropy",
-        "Difference.Variance",
-        "Difference.Entropy",
-        "Information.Measure.of.Correlation.1",
-        "Information.Measure.of.Correlation.2",
+    object_index = object_loader.object_index
+    image_shape = object_loader.image.shape
+
+    def masked_crops():
+        for label in labels:
+            object_slices = object_index.get_slices(
+                label, padding=(max(distances),) * 3
+            )
+            label_crop = object_loader.label_image[object_slices]
+            yield object_loader.image[object_slices] * (label_crop == label)
+
+    fills_image = [
+        object_index.get_voxel_count(label) == object_loader.image.size
+        for label in labels
     ]
+    haralick_means = map_in_processes(
+        calculate_cropped_haralick_features,
+        masked_crops(),
+        fills_image,
+        itertools.repeat(image_shape),
+        itertools.repeat(distances),
+        itertools.repeat(grayscales),
+        n_processes=n_processes,
+    )
+    return get_texture_output_dict(labels, haralick_means, distances, grayscales)
 
-    output_texture_dict = {
-        "object_id": [],
-        "texture_name": [],
-        "texture_value": [],
-    }
-    for index, label in tqdm.tqdm(enumerate(labels)):
-        selected_label_object = label_object.copy()
-        selected_label_object[selected_label_object != label] = 0
-        image_object = object_loader.image.copy()
-        image_object[selected_label_object == 0] = 0
-        image_object = scale_image(image_object)
-        haralick_features = mahotas.features.haralick(
-            ignore_zeros=False,
-            f=image_object,
-            distance=distance,
-            compute_14th_feature=False,
+
+def get_offset_slices(shape: tuple, direction: int, distance: int) -> tuple:
+    """
+    Get the slices of the first and second voxels of every pair that mahotas
+    compares in a 3D cooccurrence direction.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the image.
+    direction : int
+        The index of the mahotas 3D cooccurrence direction.
+    distance : int
+        The distance between the voxels of a pair.
+
+    Returns
+    -------
+    tuple
+        The slices of the first voxels and the slices of the second voxels.
+    """
+    first_slices = []
+    second_slices = []
+    for length, step in zip(shape, mahotas.features.texture._3d_deltas[direction]):
+        offset = step * distance
+        first_slices.append(slice(max(-offset, 0), length - max(offset, 0)))
+        second_slices.append(slice(max(offset, 0), length - max(-offset, 0)))
+    return tuple(first_slices), tuple(second_slices)
+
+
+def get_labeled_quantized_image(
+    object_loader: ObjectLoader,
+    grayscale: int = 256,
+    quantized_image: Optional[numpy.ndarray] = None,
+) -> tuple:
+    """
+    Quantize every object of the image with its own gray level scale and
+    number the objects from 1 in object ID order.
+    Each object is scaled as in measure_3D_texture, so from 0 to its maximum
+    unless the object fills the whole image.
+    The objects can instead share the scale of an already quantized image.
+
+    Parameters
+    ----------
+    object_loader : ObjectLoader
+        The object loader containing the image and object information.
+    grayscale : int, optional
+        The number of gray levels to scale the objects to, by default 256
+    quantized_image : Optional[numpy.ndarray], optional
+        The image already quantized to the number of gray levels, by default None
+        which quantizes each object with its own scale
+
+    Returns
+    -------
+    tuple
+        The quantized image with background set to zero and
+        the image of object numbers with background set to zero.
+    """
+    object_index = object_loader.object_index
+    image = object_loader.image
+    voxel_counts = numpy.diff(object_index.voxel_offsets)
+    object_numbers = numpy.repeat(
+        numpy.arange(1, len(voxel_counts) + 1, dtype=numpy.int32), voxel_counts
+    )
+    object_number_image = numpy.zeros(image.shape, dtype=numpy.int32)
+    object_number_image.ravel()[object_index.voxel_indices] = object_numbers
+    if quantized_image is not None:
+        labeled_quantized_image = numpy.zeros(image.shape, dtype=numpy.uint8)
+        labeled_quantized_image.ravel()[object_index.voxel_indices] = (
+            quantized_image.ravel()[object_index.voxel_indices]
+        )
+        return labeled_quantized_image, object_number_image
+
+    values = image.ravel()[object_index.voxel_indices]
+    max_values = numpy.maximum.reduceat(values, object_index.voxel_offsets[:-1])
+    min_values = numpy.zeros_like(max_values)
+    # the masked image only has no background when the object fills the whole image
+    fills_image = voxel_counts == image.size
+    if fills_image.any():
+        min_values[fills_image] = values.min()
+
+    # same operations as scale_image so the gray levels are identical
+    min_values = min_values[object_numbers - 1]
+    scaled_values = (values - min_values) / (
+        max_values[object_numbers - 1] - min_values
+    )
+    scaled_values = (scaled_values * (grayscale - 1)).astype(numpy.uint8)
+
+    labeled_quantized_image = numpy.zeros(image.shape, dtype=numpy.uint8)
+    labeled_quantized_image.ravel()[object_index.voxel_indices] = scaled_values
+    return labeled_quantized_image, object_number_image
+
+
+def count_labeled_cooccurrences(
+    quantized_image: numpy.ndarray,
+    object_number_image: numpy.ndarray,
+    direction: int,
+    distance: int,
+    grayscale: int = 256,
+) -> tuple:
+    """
+    Count the gray level cooccurrences of every object in one pass over the image.
+    For each object the image is seen as the object with every other voxel set to zero,
+    so a pair with a voxel of another object counts as a pair with a zero voxel.
+    Only the pairs with at least one voxel in the object are counted,
+    every other pair of the image is a (0, 0) pair.
+
+    Parameters
+    ----------
+    quantized_image : numpy.ndarray
+        The quantized image with background set to zero.
+    object_number_image : numpy.ndarray
+        The image of object numbers starting from 1 with background set to zero.
+    direction : int
+        The index of the mahotas 3D cooccurrence direction.
+    distance : int
+        The distance between the voxels of a pair.
+    grayscale : int, optional
+        The number of gray levels of the quantized image, by default 256
+
+    Returns
+    -------
+    tuple
+        The sorted unique keys of object number - 1, first and second gray level as
+        (object_number - 1) * grayscale**2 + first * grayscale + second,
+        and the count of each key.
+    """
+    first_slices, second_slices = get_offset_slices(
+        quantized_image.shape, direction, distance
+    )
+    # select the pairs that touch an object on the views of the images so that
+    # only the selected pairs are copied, keeping the int32 object numbers and
+    # uint8 gray levels until the keys are built
+    first_objects = object_number_image[first_slices]
+    second_objects = object_number_image[second_slices]
+    touching = first_objects > 0
+    touching |= second_objects > 0
+    first_objects = first_objects[touching]
+    second_objects = second_objects[touching]
+    first_levels = quantized_image[first_slices][touching]
+    second_levels = quantized_image[second_slices][touching]
+    del touching
+    same_object = first_objects == second_objects
+
+    # pairs counted for the object of the first voxel
+    selected = first_objects > 0
+    first_keys = (
+        (first_objects[selected].astype(numpy.int64) - 1) * grayscale**2
+        + first_levels[selected].astype(numpy.int64) * grayscale
+        + numpy.where(same_object[selected], second_levels[selected], 0)
+    )
+    # pairs counted for a different object of the second voxel
+    selected = ~same_object
+    selected &= second_objects > 0
+    second_keys = (
+        second_objects[selected].astype(numpy.int64) - 1
+    ) * grayscale**2 + second_levels[selected].astype(numpy.int64)
+    return numpy.unique(
+        numpy.concatenate((first_keys, second_keys)), return_counts=True
+    )
+
+
+def build_object_cmats(
+    object_number: int,
+    gray_levels: int,
+    direction_counts: list,
+    image_shape: tuple,
+    distance: int,
+    grayscale: int = 256,
+) -> numpy.ndarray:
+    """
+    Build the symmetric cooccurrence matrices of the 13 3D directions of an object
+    from the labeled cooccurrence counts of count_labeled_cooccurrences.
+
+    Parameters
+    ----------
+    object_number : int
+        The object number starting from 0 in object ID order.
+    gray_levels : int
+        The number of gray levels of the object, its maximum gray level + 1.
+    direction_counts : list
+        The gray level keys, counts and object offsets of the keys of each direction.
+    image_shape : tuple
+        The shape of the image.
+    distance : int
+        The distance between the voxels of a pair.
+    grayscale : int, optional
+        The number of gray levels of the quantized image, by default 256
+
+    Returns
+    -------
+    numpy.ndarray
+        The cooccurrence matrices of each direction.
+    """
+    cmats = numpy.zeros((len(direction_counts), gray_levels, gray_levels), numpy.int32)
+    for direction, (level_keys, counts, object_offsets) in enumerate(direction_counts):
+        start, stop = object_offsets[object_number : object_number + 2]
+        cmat = cmats[direction]
+        cmat[
+            level_keys[start:stop] // grayscale,
+            level_keys[start:stop] % grayscale,
+        ] = counts[start:stop]
+        # every pair without a voxel of the object is a (0, 0) pair
+        cmat[0, 0] += (
+            count_cooccurrence_pairs(image_shape, direction, distance)
+            - counts[start:stop].sum()
+        )
+        cmat += cmat.T.copy()
+    return cmats
+
+
+def calculate_haralick_features_from_cmats(
+    cmats_list: List[numpy.ndarray],
+) -> numpy.ndarray:
+    """
+    Calculate the mean Haralick features over the cooccurrence matrices
+    of the 13 3D directions.
+
+    Parameters
+    ----------
+    cmats_list : List[numpy.ndarray]
+        The symmetric cooccurrence matrices of each direction
+        for each combination of gray levels and distance.
+
+    Returns
+    -------
+    numpy.ndarray
+        The mean of each Haralick feature over the directions for each combination.
+    """
+    return numpy.stack(
+        [
+            mahotas.features.texture.haralick_features(
+                cmats,
+                ignore_zeros=False,
+                compute_14th_feature=False,
+            ).mean(axis=0)
+            for cmats in cmats_list
+        ]
+    )
+
+
+def measure_3D_texture_vectorized(
+    object_loader: ObjectLoader,
+    distance: Union[int, List[int]] = 1,
+    grayscale: Union[int, List[int]] = 256,
+    n_processes: int = 1,
+    quantized_images: Optional[Dict[int, numpy.ndarray]] = None,
+) -> dict:
+    """
+    Calculate texture features for each object in the image using Haralick features.
+    The cooccurrence matrices of all objects are counted together in one pass
+    over the image per direction and the features are then derived per object.
+    The image is quantized once per number of gray levels for all distances.
+    The features are the same as measure_3D_texture.
+
+    Parameters
+    ----------
+    object_loader : ObjectLoader
+        The object loader containing the image and object information.
+    distance : Union[int, List[int]], optional
+        The distance or distances for Haralick features, by default 1
+    grayscale : Union[int, List[int]], optional
+        The number or numbers of gray levels to scale the image to, by default 256
+    n_processes : int, optional
+        The number of processes to derive the features of the objects with, by default 1
+    quantized_images : Optional[Dict[int, numpy.ndarray]], optional
+        The image quantized with a single scale for each number of gray levels,
+        e.g. from ImageSetLoader.get_quantized_image, by default None
+        which quantizes each object with its own scale as measure_3D_texture does
+
+    Returns
+    -------
+    dict
+        A dictionary containing the object ID, texture name, and texture value.
+    """
+    distances, grayscales = get_texture_parameters(distance, grayscale)
+    labels = object_loader.object_ids
+    object_index = object_loader.object_index
+    image_shape = object_loader.image.shape
+
+    # the counts of each combination of gray levels and distance
+    combination_counts = []
+    for grayscale in grayscales:
+        quantized_image, object_number_image = get_labeled_quantized_image(
+            object_loader,
+            grayscale=grayscale,
+            quantized_image=(
+                None if quantized_images is None else quantized_images[grayscale]
+            ),
         )
-        haralick_mean = haralick_features.mean(axis=0)
-        for i, feature_name in enumerate(feature_names):
-            output_texture_dict["object_id"].append(label)
-            output_texture_dict["texture_name"].append(
-                f"{feature_name}_{grayscale}.{distance}"
+        # the gray levels of each object go up to its maximum as in the full image
+        object_gray_levels = (
+            numpy.maximum.reduceat(
+                quantized_image.ravel()[object_index.voxel_indices],
+                object_index.voxel_offsets[:-1],
+            ).astype(numpy.int64)
+            + 1
+        )
+        for distance in distances:
+            direction_counts = []
+            for direction in range(len(mahotas.features.texture._3d_deltas)):
+                keys, counts = count_labeled_cooccurrences(
+                    quantized_image,
+                    object_number_image,
+                    direction=direction,
+                    distance=distance,
+                    grayscale=grayscale,
+                )
+                object_offsets = numpy.searchsorted(
+                    keys, numpy.arange(len(labels) + 1) * grayscale**2
+                )
+                direction_counts.append((keys % grayscale**2, counts, object_offsets))
+            combination_counts.append(
+                (grayscale, distance, object_gray_levels, direction_counts)
             )
-            output_texture_dict["texture_value"].append(haralick_mean[i])
-        del haralick_mean
-        del haralick_features
-        gc.collect()
-    return output_texture_dict
+        del quantized_image, object_number_image
+
+    def object_cmats():
+        for object_number in range(len(labels)):
+            yield [
+                build_object_cmats(
+                    object_number,
+                    object_gray_levels[object_number],
+                    direction_counts,
+                    image_shape,
+                    distance=distance,
+                    grayscale=grayscale,
+                )
+                for grayscale, distance, object_gray_levels, direction_counts in (
+                    combination_counts
+                )
+            ]
+
+    haralick_means = (
+        object_haralick_means.reshape(len(grayscales), len(distances), -1)
+        for object_haralick_means in map_in_processes(
+            calculate_haralick_features_from_cmats,
+            object_cmats(),
+            n_processes=n_processes,
+        )
+    )
+    return get_texture_output_dict(labels, haralick_means, distances, grayscales)
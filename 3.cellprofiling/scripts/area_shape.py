@@ -60,6 +60,10 @@ if not in_notebook:
     compartment = arguments_dict["compartment"]
     channel = arguments_dict["channel"]
     processor_type = arguments_dict["processor_type"]
+    image_backend = arguments_dict["image_backend"]
+    save_object_indices = arguments_dict["save_object_indices"]
+    n_processes = arguments_dict["n_processes"]
+    surface_area_method = arguments_dict["surface_area_method"]
 
 else:
     well_fov = "C4-2"
@@ -67,6 +71,10 @@ else:
     compartment = "Nuclei"
     channel = "DNA"
     processor_type = "CPU"
+    image_backend = "imread"
+    save_object_indices = False
+    n_processes = 1
+    surface_area_method = "marching_cubes"
 
 image_set_path = pathlib.Path(f"{root_dir}/data/{patient}/zstack_images/{well_fov}/")
 
@@ -107,6 +115,9 @@ image_set_loader = ImageSetLoader(
     image_set_path=image_set_path,
     anisotropy_spacing=(1, 0.1, 0.1),
     channel_mapping=channel_n_compartment_mapping,
+    lazy=True,
+    backend=image_backend,
+    save_object_indices=save_object_indices,
 )
 
 
@@ -118,6 +129,7 @@ object_loader = ObjectLoader(
     image_set_loader.image_set_dict[compartment],
     "DNA",
     compartment,
+    image_set_loader.get_object_index(compartment),
 )
 
 
@@ -131,6 +143,9 @@ elif processor_type == "CPU":
     size_shape_dict = measure_3D_area_size_shape(
         image_set_loader=image_set_loader,
         object_loader=object_loader,
+        single_pass=True,
+        surface_area_method=surface_area_method,
+        n_processes=n_processes,
     )
 else:
     raise ValueError(
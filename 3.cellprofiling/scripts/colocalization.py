@@ -11,7 +11,6 @@ import sys
 import time
 from itertools import product
 
-import pandas as pd
 import psutil
 
 try:
@@ -45,16 +44,13 @@ if root_dir is None:
     raise FileNotFoundError("No Git root directory found.")
 
 sys.path.append(f"{root_dir}/3.cellprofiling/featurization_utils/")
-from colocalization_utils import (
-    measure_3D_colocalization,
-    prepare_two_images_for_colocalization,
-)
-from colocalization_utils_gpu import (
-    measure_3D_colocalization_gpu,
-    prepare_two_images_for_colocalization_gpu,
-)
 from featurization_parsable_arguments import parse_featurization_args
-from loading_classes import ImageSetLoader, TwoObjectLoader
+from image_set_featurization_utils import (
+    featurize_colocalization,
+    get_output_channels,
+    split_features_by_channel,
+)
+from loading_classes import ImageSetLoader
 from resource_profiling_util import get_mem_and_time_profiling
 
 # In[2]:
@@ -67,16 +63,24 @@ if not in_notebook:
     channel = arguments_dict["channel"]
     compartment = arguments_dict["compartment"]
     processor_type = arguments_dict["processor_type"]
+    image_backend = arguments_dict["image_backend"]
+    save_object_indices = arguments_dict["save_object_indices"]
+    colocalization_output = arguments_dict["colocalization_output"]
+    colocalization_engine = arguments_dict["colocalization_engine"]
+    n_processes = arguments_dict["n_processes"]
 
 else:
     well_fov = "C4-2"
     patient = "NF0014"
-    channel = "ER.AGP"
+    channel = "ER.AGP"  # more channels measure every pair, e.g. "DNA.AGP.ER"
     compartment = "Nuclei"
     processor_type = "GPU"
+    image_backend = "imread"
+    save_object_indices = False
+    colocalization_output = "per_channel"
+    colocalization_engine = "crop"
+    n_processes = 1
 
-channel1 = channel.split(".")[0] if "." in channel else channel
-channel2 = channel.split(".")[1] if "." in channel else None
 image_set_path = pathlib.Path(f"{root_dir}/data/{patient}/zstack_images/{well_fov}/")
 
 output_parent_path = pathlib.Path(
@@ -108,6 +112,9 @@ image_set_loader = ImageSetLoader(
     image_set_path=image_set_path,
     anisotropy_spacing=(1, 0.1, 0.1),
     channel_mapping=channel_mapping,
+    lazy=True,
+    backend=image_backend,
+    save_object_indices=save_object_indices,
 )
 
 
@@ -122,63 +129,33 @@ start_mem = psutil.Process(os.getpid()).memory_info().rss / 1024**2
 # In[6]:
 
 
-coloc_loader = TwoObjectLoader(
+if processor_type not in ["CPU", "GPU"]:
+    raise ValueError(
+        f"Processor type {processor_type} is not supported. Use 'CPU' or 'GPU'."
+    )
+# each channel is cropped once per object and shared by all of its pairs
+coloc_df = featurize_colocalization(
     image_set_loader=image_set_loader,
     compartment=compartment,
-    channel1=channel1,
-    channel2=channel2,
-)
-
-output_dir = pathlib.Path(
-    output_parent_path
-    / f"Colocalization_{compartment}_{channel1}.{channel2}_{processor_type}_features.parquet"
+    channel=channel,
+    processor_type=processor_type,
+    engine=colocalization_engine,
+    n_processes=n_processes,
 )
-list_of_dfs = []
-for object_id in coloc_loader.object_ids:
-    if processor_type == "CPU":
-        cropped_image1, cropped_image2 = prepare_two_images_for_colocalization(
-            label_object1=coloc_loader.label_image,
-            label_object2=coloc_loader.label_image,
-            image_object1=coloc_loader.image1,
-            image_object2=coloc_loader.image2,
-            object_id1=object_id,
-            object_id2=object_id,
-        )
-        colocalization_features = measure_3D_colocalization(
-            cropped_image_1=cropped_image1,
-            cropped_image_2=cropped_image2,
-            thr=15,
-            fast_costes="Accurate",
-        )
-    elif processor_type == "GPU":
-        cropped_image1, cropped_image2 = prepare_two_images_for_colocalization_gpu(
-            label_object1=coloc_loader.label_image,
-            label_object2=coloc_loader.label_image,
-            image_object1=coloc_loader.image1,
-            image_object2=coloc_loader.image2,
-            object_id1=object_id,
-            object_id2=object_id,
-        )
-        colocalization_features = measure_3D_colocalization_gpu(
-            cropped_image_1=cropped_image1,
-            cropped_image_2=cropped_image2,
-            thr=15,
-            fast_costes="Accurate",
-        )
-    else:
-        raise ValueError(
-            f"Processor type {processor_type} is not supported. Use 'CPU' or 'GPU'."
-        )
-    coloc_df = pd.DataFrame(colocalization_features, index=[0])
-    coloc_df.columns = [
-        f"Colocalization_{compartment}_{channel1}.{channel2}_{col}"
-        for col in coloc_df.columns
-    ]
-    coloc_df.insert(0, "object_id", object_id)
-    coloc_df.insert(1, "image_set", image_set_loader.image_set_name)
-    list_of_dfs.append(coloc_df)
-coloc_df = pd.concat(list_of_dfs, ignore_index=True)
-coloc_df.to_parquet(output_dir)
+output_dfs = {channel: coloc_df}
+if colocalization_output == "per_channel":
+    output_dfs = split_features_by_channel(
+        coloc_df,
+        feature_prefix="Colocalization",
+        compartment=compartment,
+        channels=get_output_channels("Colocalization", channel),
+    )
+for output_channel, output_df in output_dfs.items():
+    output_file = pathlib.Path(
+        output_parent_path
+        / f"Colocalization_{compartment}_{output_channel}_{processor_type}_features.parquet"
+    )
+    output_df.to_parquet(output_file)
 
 
 # In[7]:
@@ -194,10 +171,10 @@ get_mem_and_time_profiling(
     feature_type="Colocalization",
     well_fov=well_fov,
     patient_id=patient,
-    channel=f"{channel1}.{channel2}",
+    channel=channel,
     compartment=compartment,
     CPU_GPU=processor_type,
     output_file_dir=pathlib.Path(
-        f"{root_dir}/data/{patient}/extracted_features/run_stats/{well_fov}_Colocalization_{channel1}.{channel2}_{compartment}_{processor_type}.parquet"
+        f"{root_dir}/data/{patient}/extracted_features/run_stats/{well_fov}_Colocalization_{channel}_{compartment}_{processor_type}.parquet"
     ),
 )
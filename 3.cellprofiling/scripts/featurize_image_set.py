@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[ ]:
+
+
+import os
+import pathlib
+import sys
+import time
+
+import psutil
+
+try:
+    cfg = get_ipython().config
+    in_notebook = True
+except NameError:
+    in_notebook = False
+
+# Get the current working directory
+cwd = pathlib.Path.cwd()
+
+if (cwd / ".git").is_dir():
+    root_dir = cwd
+
+else:
+    root_dir = None
+    for parent in cwd.parents:
+        if (parent / ".git").is_dir():
+            root_dir = parent
+            break
+
+# Check if a Git root directory was found
+if root_dir is None:
+    raise FileNotFoundError("No Git root directory found.")
+
+sys.path.append(f"{root_dir}/3.cellprofiling/featurization_utils/")
+from featurization_parsable_arguments import parse_image_set_featurization_args
+from image_set_featurization_utils import featurize_image_set, load_input_combinations
+from loading_classes import ImageSetLoader
+from resource_profiling_util import get_mem_and_time_profiling
+
+# In[ ]:
+
+
+if not in_notebook:
+    arguments_dict = parse_image_set_featurization_args()
+    patient = arguments_dict["patient"]
+    well_fov = arguments_dict["well_fov"]
+    processor_type = arguments_dict["processor_type"]
+    image_backend = arguments_dict["image_backend"]
+    save_object_indices = arguments_dict["save_object_indices"]
+    save_quantized_images = arguments_dict["save_quantized_images"]
+    features = arguments_dict["features"]
+    n_processes = arguments_dict["n_processes"]
+    surface_area_method = arguments_dict["surface_area_method"]
+    intensity_output = arguments_dict["intensity_output"]
+    intensity_engine = arguments_dict["intensity_engine"]
+    granularity_output = arguments_dict["granularity_output"]
+    granularity_crop_mode = arguments_dict["granularity_crop_mode"]
+    colocalization_output = arguments_dict["colocalization_output"]
+    colocalization_engine = arguments_dict["colocalization_engine"]
+    neighbors_distances = arguments_dict["neighbors_distances"]
+    neighbors_engine = arguments_dict["neighbors_engine"]
+    adjacency_graph = arguments_dict["adjacency_graph"]
+    texture_distances = arguments_dict["texture_distances"]
+    texture_gray_levels = arguments_dict["texture_gray_levels"]
+    texture_normalization = arguments_dict["texture_normalization"]
+
+else:
+    well_fov = "C4-2"
+    patient = "NF0014"
+    processor_type = "CPU"
+    image_backend = "imread"
+    save_object_indices = False
+    save_quantized_images = False
+    features = None  # None runs all features
+    n_processes = 1
+    surface_area_method = "marching_cubes"
+    intensity_output = None  # None runs each intensity channel separately
+    intensity_engine = "standard"
+    granularity_output = None  # None runs each granularity channel separately
+    granularity_crop_mode = None  # None measures granularity on the whole image
+    colocalization_output = None  # None runs each channel pair separately
+    colocalization_engine = "crop"
+    neighbors_distances = [10]
+    neighbors_engine = "kdtree"
+    adjacency_graph = False
+    texture_distances = [3]  # distance in pixels 3 is what CP uses
+    texture_gray_levels = [256]
+    texture_normalization = "object"
+
+image_set_path = pathlib.Path(f"{root_dir}/data/{patient}/zstack_images/{well_fov}/")
+input_combinations_path = pathlib.Path(
+    f"{root_dir}/3.cellprofiling/load_data/input_combinations.json"
+)
+output_parent_path = pathlib.Path(
+    f"{root_dir}/data/{patient}/extracted_features/{well_fov}/"
+)
+output_parent_path.mkdir(parents=True, exist_ok=True)
+
+
+# In[ ]:
+
+
+channel_mapping = {
+    "DNA": "405",
+    "AGP": "488",
+    "ER": "555",
+    "Mito": "640",
+    "BF": "TRANS",
+    "Nuclei": "nuclei_",
+    "Cell": "cell_",
+    "Cytoplasm": "cytoplasm_",
+    "Organoid": "organoid_",
+}
+
+
+# In[ ]:
+
+
+start_time = time.time()
+# get starting memory (cpu)
+start_mem = psutil.Process(os.getpid()).memory_info().rss / 1024**2
+
+
+# In[ ]:
+
+
+input_combinations = load_input_combinations(
+    input_combinations_path=input_combinations_path,
+    features=features,
+)
+print(f"Running {len(input_combinations)} featurization combinations for {well_fov}")
+
+
+# In[ ]:
+
+
+image_set_loader = ImageSetLoader(
+    image_set_path=image_set_path,
+    anisotropy_spacing=(1, 0.1, 0.1),
+    channel_mapping=channel_mapping,
+    lazy=True,
+    backend=image_backend,
+    save_object_indices=save_object_indices,
+    save_quantized_images=save_quantized_images,
+)
+
+
+# In[ ]:
+
+
+output_files = featurize_image_set(
+    image_set_loader=image_set_loader,
+    input_combinations=input_combinations,
+    processor_type=processor_type,
+    output_parent_path=output_parent_path,
+    featurizer_kwargs={
+        "AreaSizeShape": {
+            "surface_area_method": surface_area_method,
+            "n_processes": n_processes,
+        },
+        "Colocalization": {
+            "engine": colocalization_engine,
+            "n_processes": n_processes,
+        },
+        "Granularity": {
+            "crop_mode": granularity_crop_mode,
+            "n_processes": n_processes,
+        },
+        "Intensity": {
+            "engine": intensity_engine,
+        },
+        "Neighbors": {
+            "distance_thresholds": neighbors_distances,
+            "engine": neighbors_engine,
+        },
+        "Texture": {
+            "n_processes": n_processes,
+            "distances": texture_distances,
+            "gray_levels": texture_gray_levels,
+            "normalization": texture_normalization,
+        },
+    },
+    intensity_output=intensity_output,
+    granularity_output=granularity_output,
+    colocalization_output=colocalization_output,
+    adjacency_graph=adjacency_graph,
+)
+print(f"Wrote {len(output_files)} feature files to {output_parent_path}")
+
+
+# In[ ]:
+
+
+end_mem = psutil.Process(os.getpid()).memory_info().rss / 1024**2
+end_time = time.time()
+get_mem_and_time_profiling(
+    start_mem=start_mem,
+    end_mem=end_mem,
+    start_time=start_time,
+    end_time=end_time,
+    feature_type="AllFeatures",
+    well_fov=well_fov,
+    patient_id=patient,
+    channel="all",
+    compartment="all",
+    CPU_GPU=processor_type,
+    output_file_dir=pathlib.Path(
+        f"{root_dir}/data/{patient}/extracted_features/run_stats/{well_fov}_AllFeatures_{processor_type}.parquet"
+    ),
+)
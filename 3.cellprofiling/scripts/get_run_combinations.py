@@ -83,6 +83,7 @@ image_set_loader = ImageSetLoader(
     image_set_path=image_set_path,
     anisotropy_spacing=(1, 0.1, 0.1),
     channel_mapping=channel_mapping,
+    lazy=True,
 )
 
 
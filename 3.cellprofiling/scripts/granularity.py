@@ -14,7 +14,6 @@ import cucim
 import cupy as cp
 import numpy
 import numpy as np
-import pandas as pd
 import psutil
 import scipy
 import skimage
@@ -48,10 +47,11 @@ if root_dir is None:
 
 sys.path.append(f"{root_dir}/3.cellprofiling/featurization_utils/")
 from featurization_parsable_arguments import parse_featurization_args
-from granularity_utils import measure_3D_granularity, measure_3D_granularity_gpu
-
-# from granularity import measure_3D_granularity
-from loading_classes import ImageSetLoader, ObjectLoader
+from image_set_featurization_utils import (
+    featurize_granularity,
+    split_features_by_channel,
+)
+from loading_classes import ImageSetLoader
 from resource_profiling_util import get_mem_and_time_profiling
 
 # In[ ]:
@@ -64,13 +64,23 @@ if not in_notebook:
     channel = arguments_dict["channel"]
     compartment = arguments_dict["compartment"]
     processor_type = arguments_dict["processor_type"]
+    image_backend = arguments_dict["image_backend"]
+    save_object_indices = arguments_dict["save_object_indices"]
+    granularity_output = arguments_dict["granularity_output"]
+    granularity_crop_mode = arguments_dict["granularity_crop_mode"]
+    n_processes = arguments_dict["n_processes"]
 
 else:
     well_fov = "C4-2"
     patient = "NF0014"
-    channel = "DNA"
+    channel = "DNA"  # several channels can be separated by ".", e.g. "DNA.AGP"
     compartment = "Nuclei"
     processor_type = "CPU"
+    image_backend = "imread"
+    save_object_indices = False
+    granularity_output = "per_channel"
+    granularity_crop_mode = None  # None measures the whole image
+    n_processes = 1
 
 image_set_path = pathlib.Path(f"{root_dir}/data/{patient}/zstack_images/{well_fov}/")
 output_parent_path = pathlib.Path(
@@ -110,62 +120,44 @@ image_set_loader = ImageSetLoader(
     image_set_path=image_set_path,
     anisotropy_spacing=(1, 0.1, 0.1),
     channel_mapping=channel_mapping,
+    lazy=True,
+    backend=image_backend,
+    save_object_indices=save_object_indices,
 )
 
 
 # In[ ]:
 
 
-object_loader = ObjectLoader(
-    image_set_loader.image_set_dict[channel],
-    image_set_loader.image_set_dict[compartment],
-    channel,
-    compartment,
-)
-if processor_type == "GPU":
-    object_measurements = measure_3D_granularity_gpu(
-        object_loader=object_loader,
-        radius=10,  # radius of the sphere to use for granularity measurement
-        granular_spectrum_length=16,  # usually 16 but 2 is used for testing for now
-        subsample_size=0.25,  # subsample to 25% of the image to reduce computation time
-        image_name=channel,
-    )
-elif processor_type == "CPU":
-    object_measurements = measure_3D_granularity(
-        object_loader=object_loader,
-        radius=10,  # radius of the sphere to use for granularity measurement
-        granular_spectrum_length=16,  # usually 16 but 2 is used for testing for now
-        subsample_size=0.25,  # subsample to 25% of the image to reduce computation time
-        image_name=channel,
-    )
-else:
+if processor_type not in ["CPU", "GPU"]:
     raise ValueError(
         f"Processor type {processor_type} is not supported. Use 'CPU' or 'GPU'."
     )
-final_df = pd.DataFrame(object_measurements)
-# get the mean of each value in the array
-# melt the dataframe to wide format
-final_df = final_df.pivot_table(
-    index=["object_id"], columns=["feature"], values=["value"]
-)
-final_df.columns = final_df.columns.droplevel()
-final_df = final_df.reset_index()
-# prepend compartment and channel to column names
-for col in final_df.columns:
-    if col == "object_id":
-        continue
-    else:
-        final_df.rename(
-            columns={col: f"Granularity_{compartment}_{channel}_{col}"},
-            inplace=True,
-        )
-final_df.insert(0, "image_set", image_set_loader.image_set_name)
-output_file = pathlib.Path(
-    output_parent_path
-    / f"Granularity_{compartment}_{channel}_{processor_type}_features.parquet"
+# radius 10 spheres, a spectrum length of 16 and a subsample of 25% of the image
+# all channels are measured together sharing the downsampled compartment mask
+final_df = featurize_granularity(
+    image_set_loader=image_set_loader,
+    compartment=compartment,
+    channel=channel,
+    processor_type=processor_type,
+    crop_mode=granularity_crop_mode,
+    n_processes=n_processes,
 )
-output_file.parent.mkdir(parents=True, exist_ok=True)
-final_df.to_parquet(output_file)
+output_dfs = {channel: final_df}
+if granularity_output == "per_channel":
+    output_dfs = split_features_by_channel(
+        final_df,
+        feature_prefix="Granularity",
+        compartment=compartment,
+        channels=channel.split("."),
+    )
+for output_channel, output_df in output_dfs.items():
+    output_file = pathlib.Path(
+        output_parent_path
+        / f"Granularity_{compartment}_{output_channel}_{processor_type}_features.parquet"
+    )
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    output_df.to_parquet(output_file)
 
 
 # In[ ]:
@@ -10,7 +10,6 @@ import sys
 import time
 from itertools import product
 
-import pandas as pd
 import psutil
 
 try:
@@ -42,8 +41,8 @@ if root_dir is None:
 
 sys.path.append(f"{root_dir}/3.cellprofiling/featurization_utils/")
 from featurization_parsable_arguments import parse_featurization_args
-from intensity_utils import measure_3D_intensity_CPU, measure_3D_intensity_gpu
-from loading_classes import ImageSetLoader, ObjectLoader
+from image_set_featurization_utils import featurize_intensity, split_features_by_channel
+from loading_classes import ImageSetLoader
 from resource_profiling_util import get_mem_and_time_profiling
 
 # In[ ]:
@@ -56,14 +55,22 @@ if not in_notebook:
     channel = arguments_dict["channel"]
     compartment = arguments_dict["compartment"]
     processor_type = arguments_dict["processor_type"]
+    image_backend = arguments_dict["image_backend"]
+    save_object_indices = arguments_dict["save_object_indices"]
+    intensity_output = arguments_dict["intensity_output"]
+    intensity_engine = arguments_dict["intensity_engine"]
 
 
 else:
     well_fov = "C4-2"
     patient = "NF0014"
-    channel = "DNA"
+    channel = "DNA"  # several channels can be separated by ".", e.g. "DNA.AGP"
     compartment = "Nuclei"
     processor_type = "CPU"
+    image_backend = "imread"
+    save_object_indices = False
+    intensity_output = "per_channel"
+    intensity_engine = "standard"
 
 image_set_path = pathlib.Path(f"{root_dir}/data/{patient}/zstack_images/{well_fov}/")
 output_parent_path = pathlib.Path(
@@ -103,50 +110,42 @@ image_set_loader = ImageSetLoader(
     image_set_path=image_set_path,
     anisotropy_spacing=(1, 0.1, 0.1),
     channel_mapping=channel_n_compartment_mapping,
+    lazy=True,
+    backend=image_backend,
+    save_object_indices=save_object_indices,
 )
 
 
 # In[ ]:
 
 
-object_loader = ObjectLoader(
-    image_set_loader.image_set_dict[channel],
-    image_set_loader.image_set_dict[compartment],
-    channel,
-    compartment,
-)
-if processor_type == "GPU":
-    output_dict = measure_3D_intensity_gpu(object_loader)
-elif processor_type == "CPU":
-    output_dict = measure_3D_intensity_CPU(object_loader)
-else:
+if processor_type not in ["CPU", "GPU"]:
     raise ValueError(
         f"Processor type {processor_type} is not supported. Use 'CPU' or 'GPU'."
     )
-final_df = pd.DataFrame(output_dict)
-# prepend compartment and channel to column names
-final_df = final_df.pivot(
-    index=["object_id"],
-    columns="feature_name",
-    values="value",
-).reset_index()
-for col in final_df.columns:
-    if col == "object_id":
-        continue
-    else:
-        final_df.rename(
-            columns={col: f"Intensity_{compartment}_{channel}_{col}"},
-            inplace=True,
-        )
-
-final_df.insert(0, "image_set", image_set_loader.image_set_name)
-
-output_file = pathlib.Path(
-    output_parent_path
-    / f"Intensity_{compartment}_{channel}_{processor_type}_features.parquet"
+# all channels are measured together sharing the compartment object index
+final_df = featurize_intensity(
+    image_set_loader=image_set_loader,
+    compartment=compartment,
+    channel=channel,
+    processor_type=processor_type,
+    engine=intensity_engine,
 )
-output_file.parent.mkdir(parents=True, exist_ok=True)
-final_df.to_parquet(output_file)
+output_dfs = {channel: final_df}
+if intensity_output == "per_channel":
+    output_dfs = split_features_by_channel(
+        final_df,
+        feature_prefix="Intensity",
+        compartment=compartment,
+        channels=channel.split("."),
+    )
+for output_channel, output_df in output_dfs.items():
+    output_file = pathlib.Path(
+        output_parent_path
+        / f"Intensity_{compartment}_{output_channel}_{processor_type}_features.parquet"
+    )
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    output_df.to_parquet(output_file)
 
 
 # In[ ]:
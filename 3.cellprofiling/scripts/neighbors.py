@@ -10,7 +10,6 @@ import sys
 import time
 
 import numpy as np
-import pandas as pd
 import psutil
 import scipy
 import skimage
@@ -44,8 +43,12 @@ if root_dir is None:
 
 sys.path.append(f"{root_dir}/3.cellprofiling/featurization_utils/")
 from featurization_parsable_arguments import parse_featurization_args
-from loading_classes import ImageSetLoader, ObjectLoader
-from neighbors_utils import measure_3D_number_of_neighbors
+from image_set_featurization_utils import (
+    featurize_adjacency_graph,
+    featurize_neighbors,
+    get_adjacency_graph_file_name,
+)
+from loading_classes import ImageSetLoader
 from resource_profiling_util import get_mem_and_time_profiling
 
 # In[ ]:
@@ -58,12 +61,22 @@ if not in_notebook:
     channel = arguments_dict["channel"]
     compartment = arguments_dict["compartment"]
     processor_type = arguments_dict["processor_type"]
+    image_backend = arguments_dict["image_backend"]
+    save_object_indices = arguments_dict["save_object_indices"]
+    neighbors_distances = arguments_dict["neighbors_distances"]
+    neighbors_engine = arguments_dict["neighbors_engine"]
+    adjacency_graph = arguments_dict["adjacency_graph"]
 else:
     well_fov = "C4-2"
     patient = "NF0014"
     channel = "DNA"
     compartment = "Nuclei"
     processor_type = "CPU"
+    image_backend = "imread"
+    save_object_indices = False
+    neighbors_distances = [10]
+    neighbors_engine = "kdtree"
+    adjacency_graph = False
 
 image_set_path = pathlib.Path(f"{root_dir}/data/{patient}/zstack_images/{well_fov}/")
 output_parent_path = pathlib.Path(
@@ -103,6 +116,9 @@ image_set_loader = ImageSetLoader(
     image_set_path=image_set_path,
     anisotropy_spacing=(1, 0.1, 0.1),
     channel_mapping=channel_n_compartment_mapping,
+    lazy=True,
+    backend=image_backend,
+    save_object_indices=save_object_indices,
 )
 
 
@@ -115,20 +131,15 @@ image_set_loader = ImageSetLoader(
 
 compartment = "Nuclei"
 channel = "DNA"
-object_loader = ObjectLoader(
-    image_set_loader.image_set_dict[channel],
-    image_set_loader.image_set_dict[compartment],
-    channel,
-    compartment,
-)
-neighbors_out_dict = measure_3D_number_of_neighbors(
-    object_loader=object_loader,
-    distance_threshold=10,
-    anisotropy_factor=image_set_loader.anisotropy_factor,
+# one Neighbors_{distance} column per distance threshold
+final_df = featurize_neighbors(
+    image_set_loader=image_set_loader,
+    compartment=compartment,
+    channel=channel,
+    processor_type=processor_type,
+    distance_thresholds=neighbors_distances,
+    engine=neighbors_engine,
 )
-final_df = pd.DataFrame(neighbors_out_dict)
-if not final_df.empty:
-    final_df.insert(0, "image_set", image_set_loader.image_set_name)
 
 output_file = pathlib.Path(
     output_parent_path
@@ -136,6 +147,11 @@ output_file = pathlib.Path(
 )
 output_file.parent.mkdir(parents=True, exist_ok=True)
 final_df.to_parquet(output_file)
+if adjacency_graph:
+    # the edge list of the touching objects, written next to the features
+    featurize_adjacency_graph(
+        image_set_loader=image_set_loader, compartment=compartment
+    ).to_parquet(output_parent_path / get_adjacency_graph_file_name(compartment))
 final_df.head()
 
 
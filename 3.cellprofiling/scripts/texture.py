@@ -47,7 +47,7 @@ sys.path.append(f"{root_dir}/3.cellprofiling/featurization_utils/")
 from featurization_parsable_arguments import parse_featurization_args
 from loading_classes import ImageSetLoader, ObjectLoader
 from resource_profiling_util import get_mem_and_time_profiling
-from texture_utils import measure_3D_texture
+from texture_utils import measure_3D_texture_vectorized
 
 # In[ ]:
 
@@ -59,12 +59,26 @@ if not in_notebook:
     channel = arguments_dict["channel"]
     compartment = arguments_dict["compartment"]
     processor_type = arguments_dict["processor_type"]
+    image_backend = arguments_dict["image_backend"]
+    save_object_indices = arguments_dict["save_object_indices"]
+    save_quantized_images = arguments_dict["save_quantized_images"]
+    n_processes = arguments_dict["n_processes"]
+    texture_distances = arguments_dict["texture_distances"]
+    texture_gray_levels = arguments_dict["texture_gray_levels"]
+    texture_normalization = arguments_dict["texture_normalization"]
 else:
     well_fov = "C4-2"
     patient = "NF0014"
     channel = "DNA"
     compartment = "Nuclei"
     processor_type = "CPU"
+    image_backend = "imread"
+    save_object_indices = False
+    save_quantized_images = False
+    n_processes = 1
+    texture_distances = [3]  # distance in pixels 3 is what CP uses
+    texture_gray_levels = [256]
+    texture_normalization = "object"
 
 image_set_path = pathlib.Path(f"{root_dir}/data/{patient}/zstack_images/{well_fov}/")
 output_parent_path = pathlib.Path(
@@ -104,6 +118,10 @@ image_set_loader = ImageSetLoader(
     image_set_path=image_set_path,
     anisotropy_spacing=(1, 0.1, 0.1),
     channel_mapping=channel_mapping,
+    lazy=True,
+    backend=image_backend,
+    save_object_indices=save_object_indices,
+    save_quantized_images=save_quantized_images,
 )
 
 
@@ -115,10 +133,21 @@ object_loader = ObjectLoader(
     image_set_loader.image_set_dict[compartment],
     channel,
     compartment,
+    image_set_loader.get_object_index(compartment),
 )
-output_texture_dict = measure_3D_texture(
+quantized_images = None
+if texture_normalization == "global":
+    # the quantized channel is saved and reused by the other compartments
+    quantized_images = {
+        gray_levels: image_set_loader.get_quantized_image(channel, gray_levels)
+        for gray_levels in texture_gray_levels
+    }
+output_texture_dict = measure_3D_texture_vectorized(
     object_loader=object_loader,
-    distance=3,  # distance in pixels 3 is what CP uses
+    distance=texture_distances,
+    grayscale=texture_gray_levels,
+    n_processes=n_processes,
+    quantized_images=quantized_images,
 )
 final_df = pd.DataFrame(output_texture_dict)
 
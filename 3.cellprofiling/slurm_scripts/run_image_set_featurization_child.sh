@@ -0,0 +1,35 @@
+#!/bin/bash
+
+patient=$1
+well_fov=$2
+use_GPU=$3
+features=${4:-all}
+
+echo "Image set featurization for patient: $patient, WellFOV: $well_fov, Features: $features, UseGPU: $use_GPU"
+module load miniforge
+conda init bash
+conda activate GFF_featurization
+
+git_root=$(git rev-parse --show-toplevel)
+if [ -z "$git_root" ]; then
+    echo "Error: Could not find the git root directory."
+    exit 1
+fi
+
+if [ "$use_GPU" = "TRUE" ]; then
+    processor_type="GPU"
+else
+    processor_type="CPU"
+fi
+
+# start the timer
+start_timestamp=$(date +%s)
+python "$git_root"/3.cellprofiling/scripts/featurize_image_set.py \
+    --patient "$patient" \
+    --well_fov "$well_fov" \
+    --processor_type "$processor_type" \
+    --features "$features"
+end=$(date +%s)
+echo "Time taken to run the featurization: (($end-$start_timestamp))"
+
+conda deactivate